@@ -3,28 +3,64 @@
 
 # 使用方法：
 # 1. 安装依赖：pip install PyQt6 PyQt6-WebEngine requests markdown
+#    （可选）安装 Pygments 后代码块会按语言高亮：pip install Pygments
+#    （可选）文档检索需要 NumPy 和一个嵌入模型：pip install numpy，ollama pull nomic-embed-text
 # 2. 运行：python OllamaAIChatTool.py
+# 3. 批处理（无需图形界面）：python OllamaAIChatTool.py --batch prompts.jsonl --models llama3 --output results.jsonl
+# 4. 性能测试（使用本地模拟服务器，不需要Ollama）：python ollama_bench.py transport 或 python ollama_bench.py ui
+# 5. 启动耗时分析：python OllamaAIChatTool.py --profile-startup
+# 6. 打包：pyinstaller OllamaAIChatTool.spec（单文件），pyinstaller OllamaAIChatTool.spec -- --onedir（目录版，启动时不需要解压）
+# 7. 模型参数自动调优（也可以在界面中点击"模型参数"）：python ollama_profiles.py tune --model llama3
+# 8. 本地网关（Ollama和OpenAI兼容接口，也可以在界面中勾选"本地网关"）：python OllamaAIChatTool.py --gateway --port 11435
 
 # 注意：
 # 1. 请确保Ollama服务已启动（运行 'ollama serve'）
 # 2. 请点击\"选择模型\"按钮选择一个已安装的模型
 
 import sys
-import requests
-import markdown
+import ollama_startup
+
+# 批处理模式不需要图形界面，在导入PyQt6之前处理
+if __name__ == '__main__' and '--batch' in sys.argv:
+    from ollama_batch import main as batch_main
+    sys.exit(batch_main(sys.argv[1:]))
+if __name__ == '__main__' and '--gateway' in sys.argv:
+    from ollama_gateway import main as gateway_main
+    sys.exit(gateway_main(sys.argv[1:]))
+
+import os
 import time
 import json
 import logging
-from typing import List, Dict, Optional, Any
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Optional, Any, Tuple, Set
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QTextEdit, QPushButton, QLabel, QMessageBox,
-                            QComboBox, QDialog, QDialogButtonBox)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QTimer
-from PyQt6.QtWebEngineWidgets import QWebEngineView
+                            QComboBox, QDialog, QDialogButtonBox, QInputDialog,
+                            QFileDialog, QCheckBox, QLineEdit, QListWidget, QListWidgetItem,
+                            QSplitter, QFormLayout, QSpinBox)
+from PyQt6.QtCore import Qt, QObject, pyqtSignal, QTimer
 from PyQt6.QtGui import QIcon
+ollama_startup.mark("导入PyQt6")
+from ollama_engine import (DEFAULT_SERVER_URL, DEFAULT_KEEP_ALIVE,
+                           CHAT_MODE_CHAT, CHAT_MODE_GENERATE, CONTEXT_TOKEN_BUDGET,
+                           OllamaResponseError, GenerationCancelled, parse_server_urls,
+                           Conversation, ChatMessage,
+                           GenerationResult, MetricsAggregator)
+from ollama_cache import ResponseCache, ModelCatalogue, DETERMINISTIC_OPTIONS
+from ollama_store import ConversationStore
+from ollama_transport import StreamTransport
+from ollama_compare import ComparisonRun, ComparisonAnswer
+from ollama_gateway import OllamaGateway
+from ollama_rag import DEFAULT_EMBED_MODEL, RAG_TOP_K, DocumentIndex, RetrievalSettings
+from ollama_profiles import (OBJECTIVE_TOKENS_PER_SECOND, OBJECTIVE_TTFT, ModelProfiles, TuneTrial,
+                             merge_options, context_budget, tune_grid, pick_best, tune_record)
+from ollama_render import (RENDER_WORKERS, StreamingDocument, render_markdown, render_placeholder,
+                           highlight_css)
+ollama_startup.mark("导入程序模块")
 
 # 常量定义
-DEFAULT_SERVER_URL = "http://localhost:11434"
 DEFAULT_WINDOW_WIDTH = 800
 DEFAULT_WINDOW_HEIGHT = 600
 DEFAULT_WINDOW_X = 100
@@ -32,7 +68,27 @@ DEFAULT_WINDOW_Y = 100
 INPUT_MAX_HEIGHT = 100
 SEND_BUTTON_MIN_WIDTH = 150
 MODELS_DIALOG_MIN_WIDTH = 400
+HISTORY_DIALOG_MIN_WIDTH = 500
+PROFILE_DIALOG_MIN_WIDTH = 480
+DOCUMENTS_DIALOG_MIN_WIDTH = 520
+RAG_MAX_TOP_K = 20  # 文档对话框中可以设置的最大片段数
+# 模型参数对话框中的参数：名称、显示文本和最大值
+PROFILE_FIELDS = [('num_thread', "线程数 (num_thread)", 512),
+                  ('num_ctx', "上下文长度 (num_ctx)", 1048576),
+                  ('num_batch', "批大小 (num_batch)", 16384),
+                  ('num_predict', "最大生成长度 (num_predict)", 131072)]
+COMPARE_DIALOG_SIZE = (1100, 700)  # 模型比较窗口的默认大小
+COMPARE_COLUMN_MIN_WIDTH = 260  # 比较窗口中每个模型一栏的最小宽度
+LOAD_OLDER_THRESHOLD = 200  # 距离页面顶部小于该距离（像素）时加载更早的消息
 SCROLL_DELAY = 500  # 滚动延迟时间（毫秒）
+RENDER_CACHE_SIZE = 512  # 已完成消息的HTML渲染缓存条数上限
+QUEUE_STATUS_INTERVAL = 500  # 状态栏中排队信息和模型加载进度的刷新间隔（毫秒）
+# 模型保持加载的时间；Ollama按Go的时长格式解析字符串，必须带单位，负数表示一直保持
+KEEP_ALIVE_CHOICES = [("保持5分钟", "5m"), ("保持30分钟", "30m"), ("保持2小时", "2h"), ("一直保持", "-1m")]
+KEEP_ALIVE_PING_INTERVAL = 4 * 60 * 1000  # 常驻模型的保活请求间隔（毫秒），小于最短的keep_alive
+VIRTUAL_MARGIN = 1500  # 视口上下该距离（像素）以内的消息保留完整内容，更远的替换为占位块
+# 页面和内存中最多保留的消息数：跟随最新消息时移除更早的消息，向上滚动时再从数据库分页加载
+MAX_LOADED_MESSAGES = 200
 
 # 配置日志记录
 logging.basicConfig(
@@ -42,9 +98,17 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class ModelsDialog(QDialog):
-    def __init__(self, parent: Optional[QWidget] = None, server_url: str = DEFAULT_SERVER_URL) -> None:
+    """模型选择对话框：先显示缓存的模型列表，在后台刷新后原地更新"""
+    
+    def __init__(self, parent: Optional[QWidget], server_url: str, transport: StreamTransport,
+                 catalogue: Optional[ModelCatalogue], bridge: "StreamBridge") -> None:
         super().__init__(parent)
         self.server_url = server_url
+        self.transport = transport
+        self.catalogue = catalogue
+        self.bridge = bridge
+        self.models: List[Dict[str, Any]] = []
+        self.refresh_request: Optional[int] = None
         self.setWindowTitle("选择模型")
         self.setMinimumWidth(MODELS_DIALOG_MIN_WIDTH)
         
@@ -52,7 +116,9 @@ class ModelsDialog(QDialog):
         self.setWindowIcon(QIcon("ollamaICO.png"))
         
         self._init_ui()
-        self.load_models()
+        self.bridge.catalogue_ready.connect(self.handle_models_loaded)
+        self.bridge.catalogue_error.connect(self.handle_load_error)
+        self.show_cached_models()
         
     def _init_ui(self) -> None:
         """初始化UI组件"""
@@ -77,132 +143,815 @@ class ModelsDialog(QDialog):
         buttons.rejected.connect(self.reject)
         layout.addWidget(buttons)
 
+    def show_cached_models(self) -> None:
+        """立即显示缓存的模型列表，缓存过期或没有缓存时在后台刷新"""
+        cached = self.catalogue.get(self.server_url) if self.catalogue is not None else None
+        if cached is None:
+            self.load_models()
+            return
+        models, fetched = cached
+        self.show_models(models)
+        if self.catalogue.is_fresh(fetched):
+            return
+        self.load_models()
+        if self.models:
+            cached_at = time.strftime('%m-%d %H:%M', time.localtime(fetched))
+            self.info_label.setText(f"找到 {len(self.models)} 个模型（{cached_at} 的列表，正在刷新...）")
+
     def load_models(self) -> None:
-        """加载可用的模型列表"""
-        try:
-            self.info_label.setText("正在加载模型列表...")
-            self.model_combo.clear()
-            self.model_combo.addItem("正在加载...", "")
-            
-            response = requests.get(f'{self.server_url}/api/tags')
-            response.raise_for_status()  # 抛出HTTP错误
-            
-            models = response.json().get("models", [])
+        """在后台刷新模型列表，完成后原地更新，不阻塞界面"""
+        if self.refresh_request is not None:
+            return
+        self.refresh_btn.setEnabled(False)
+        self.info_label.setText("正在加载模型列表...")
+        self.refresh_request = self.transport.list_models(
+            self.server_url, self.bridge.catalogue_ready.emit, self.bridge.catalogue_error.emit,
+            catalogue=self.catalogue, known=self.models
+        )
+        
+    def handle_models_loaded(self, request_id: int, models: List[Dict[str, Any]]) -> None:
+        if request_id != self.refresh_request:
+            return
+        self.refresh_request = None
+        self.refresh_btn.setEnabled(True)
+        self.show_models(models)
+        if not models:
             self.model_combo.clear()
+            self.model_combo.addItem("未找到模型", "")
+            self.info_label.setText("未找到任何可用模型，请先使用 'ollama pull' 命令安装模型")
             
-            if not models:
-                self.model_combo.addItem("未找到模型", "")
-                self.info_label.setText("未找到任何可用模型，请先使用 'ollama pull' 命令安装模型")
-                return
-                
-            for model in models:
-                self.model_combo.addItem(
-                    f"{model['name']} ({model.get('size', '未知大小')})", 
-                    model['name']
-                )
-            self.info_label.setText(f"找到 {len(models)} 个模型")
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"加载模型列表时出错: {str(e)}")
-            self.model_combo.clear()
-            self.model_combo.addItem("连接错误", "")
-            self.info_label.setText(f"连接 Ollama 服务时出错: {str(e)}")
+    def handle_load_error(self, request_id: int, error: Exception) -> None:
+        if request_id != self.refresh_request:
+            return
+        self.refresh_request = None
+        self.refresh_btn.setEnabled(True)
+        logger.error(f"加载模型列表时出错: {str(error)}")
+        if self.models:
+            self.info_label.setText(f"刷新失败，显示的是上次的模型列表: {str(error)}")
+            return
+        self.model_combo.clear()
+        self.model_combo.addItem("连接错误", "")
+        self.info_label.setText(f"连接 Ollama 服务时出错: {str(error)}")
+
+    def show_models(self, models: List[Dict[str, Any]]) -> None:
+        """用新的列表替换下拉框的内容，保留当前选中的模型"""
+        self.models = models
+        if not models:
+            return
+        selected = self.model_combo.currentData()
+        multiple_endpoints = len(parse_server_urls(self.server_url)) > 1
+        self.model_combo.clear()
+        for model in models:
+            self.model_combo.addItem(self.model_label(model, multiple_endpoints), model['name'])
+        index = self.model_combo.findData(selected) if selected else -1
+        if index >= 0:
+            self.model_combo.setCurrentIndex(index)
+        self.info_label.setText(f"找到 {len(models)} 个模型")
+
+    @staticmethod
+    def model_label(model: Dict[str, Any], multiple_endpoints: bool = False) -> str:
+        """模型名称加上参数量、量化方式、上下文长度和文件大小"""
+        details = model.get('details') or {}
+        info = [details.get('parameter_size'), details.get('quantization_level')]
+        if model.get('context_length'):
+            info.append(f"上下文 {model['context_length']}")
+        info.append(f"{model['size'] / 2**30:.1f} GB" if model.get('size') else '未知大小')
+        label = f"{model['name']} ({' · '.join(item for item in info if item)})"
+        if multiple_endpoints:
+            label += f" [{len(model['endpoints'])} 个端点]"
+        return label
             
     def get_selected_model(self) -> str:
         """获取选中的模型名称"""
         return self.model_combo.currentData()
 
-class OllamaThread(QThread):
-    response_ready = pyqtSignal(str)
-    response_chunk = pyqtSignal(str)
-    response_complete = pyqtSignal(str, float)
+    def done(self, result: int) -> None:
+        """关闭时断开信号；后台刷新会继续完成并写入缓存"""
+        self.bridge.catalogue_ready.disconnect(self.handle_models_loaded)
+        self.bridge.catalogue_error.disconnect(self.handle_load_error)
+        super().done(result)
+
+class HistoryDialog(QDialog):
+    """历史会话列表，支持全文搜索和删除"""
     
-    def __init__(self, prompt: str, model: str, server_url: str) -> None:
-        super().__init__()
-        self.prompt = prompt
-        self.model = model
-        self.server_url = server_url
-        self.start_time: Optional[float] = None
+    def __init__(self, store: ConversationStore, parent: Optional[QWidget] = None) -> None:
+        super().__init__(parent)
+        self.store = store
+        self.deleted: Set[int] = set()
+        self.setWindowTitle("历史会话")
+        self.setMinimumWidth(HISTORY_DIALOG_MIN_WIDTH)
+        self.setWindowIcon(QIcon("ollamaICO.png"))
         
-    def run(self) -> None:
-        try:
-            # 检查服务可用性
-            self._check_service()
+        self._init_ui()
+        self.show_recent()
+        
+    def _init_ui(self) -> None:
+        """初始化UI组件"""
+        layout = QVBoxLayout(self)
+        
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("搜索全部会话...")
+        self.search_input.returnPressed.connect(self.search)
+        layout.addWidget(self.search_input)
+        
+        self.result_list = QListWidget()
+        self.result_list.itemDoubleClicked.connect(self.accept)
+        layout.addWidget(self.result_list)
+        
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Open | QDialogButtonBox.StandardButton.Cancel)
+        delete_button = buttons.addButton("删除", QDialogButtonBox.ButtonRole.ActionRole)
+        delete_button.clicked.connect(self.delete_selected)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+        
+    def delete_selected(self) -> None:
+        """确认后删除选中的会话"""
+        conversation_id = self.get_selected_conversation()
+        if conversation_id is None:
+            return
+        reply = QMessageBox.question(self, "删除会话", "确定要删除这个会话吗？删除后无法恢复。")
+        if reply != QMessageBox.StandardButton.Yes:
+            return
+        self.store.delete_conversation(conversation_id)
+        self.deleted.add(conversation_id)
+        for row in reversed(range(self.result_list.count())):
+            if self.result_list.item(row).data(Qt.ItemDataRole.UserRole) == conversation_id:
+                self.result_list.takeItem(row)
+        
+    def _add_item(self, text: str, conversation_id: int) -> None:
+        item = QListWidgetItem(text)
+        item.setData(Qt.ItemDataRole.UserRole, conversation_id)
+        self.result_list.addItem(item)
+        
+    def show_recent(self) -> None:
+        """显示最近更新的会话"""
+        self.result_list.clear()
+        for conversation in self.store.list_conversations():
+            updated = time.strftime('%Y-%m-%d %H:%M', time.localtime(conversation['updated']))
+            self._add_item(f"{updated}  {conversation['title']}", conversation['id'])
             
-            # 发送生成请求
-            self._send_generate_request()
+    def search(self) -> None:
+        """全文搜索消息内容"""
+        query = self.search_input.text().strip()
+        if not query:
+            self.show_recent()
+            return
+        self.result_list.clear()
+        for result in self.store.search(query):
+            self._add_item(f"{result['title']}：{result['snippet']}", result['conversation_id'])
+        if not self.result_list.count():
+            self.result_list.addItem("没有找到匹配的消息")
             
-        except Exception as e:
-            logger.error(f"生成响应时出错: {str(e)}")
-            self.response_ready.emit(f"错误：{str(e)}\n请确保已安装所需的模型（使用 'ollama pull {self.model}' 命令）")
+    def get_selected_conversation(self) -> Optional[int]:
+        """获取选中的会话ID"""
+        item = self.result_list.currentItem()
+        return item.data(Qt.ItemDataRole.UserRole) if item else None
+
+class CompareDialog(QDialog):
+    """多模型比较：同一个提示词同时（或依次）发送给多个模型，每个模型的回答在各自的一栏中流式显示"""
+    
+    def __init__(self, parent: "ChatWindow") -> None:
+        super().__init__(parent)
+        self.chat_window = parent
+        self.transport = parent.transport
+        self.bridge = parent.bridge
+        self.run: Optional[ComparisonRun] = None
+        self.columns: Dict[str, Tuple[QTextEdit, QLabel]] = {}
+        self.catalogue_request: Optional[int] = None
+        self.setWindowTitle("模型比较")
+        self.resize(*COMPARE_DIALOG_SIZE)
+        self.setWindowIcon(QIcon("ollamaICO.png"))
+        
+        self._init_ui()
+        self.bridge.response_chunk.connect(self.handle_chunk)
+        self.bridge.response_complete.connect(self.handle_complete)
+        self.bridge.response_error.connect(self.handle_error)
+        self.bridge.catalogue_ready.connect(self.handle_models_loaded)
+        self.load_models()
+        
+    def _init_ui(self) -> None:
+        """初始化UI组件"""
+        layout = QVBoxLayout(self)
+        
+        top_layout = QHBoxLayout()
+        self.model_list = QListWidget()
+        self.model_list.setMaximumHeight(INPUT_MAX_HEIGHT)
+        top_layout.addWidget(self.model_list, 1)
+        
+        prompt_layout = QVBoxLayout()
+        self.system_input = QLineEdit(self.chat_window.conversation.context_manager.system_prompt)
+        self.system_input.setPlaceholderText("系统提示词（可选）")
+        prompt_layout.addWidget(self.system_input)
+        self.prompt_input = QTextEdit()
+        self.prompt_input.setPlaceholderText("输入要比较的提示词...")
+        self.prompt_input.setMaximumHeight(INPUT_MAX_HEIGHT)
+        prompt_layout.addWidget(self.prompt_input)
+        top_layout.addLayout(prompt_layout, 2)
+        layout.addLayout(top_layout)
+        
+        button_layout = QHBoxLayout()
+        self.sequential_checkbox = QCheckBox("依次运行")
+        self.sequential_checkbox.setToolTip("显存放不下所有模型时逐个运行，避免模型反复换入换出影响速度")
+        button_layout.addWidget(self.sequential_checkbox)
+        self.deterministic_checkbox = QCheckBox("确定性回答")
+        self.deterministic_checkbox.setToolTip("使用temperature=0和固定seed，便于比较")
+        self.deterministic_checkbox.setChecked(True)
+        button_layout.addWidget(self.deterministic_checkbox)
+        self.info_label = QLabel("")
+        button_layout.addWidget(self.info_label, 1)
+        self.run_button = QPushButton("开始比较")
+        self.run_button.clicked.connect(self.start_comparison)
+        button_layout.addWidget(self.run_button)
+        self.stop_button = QPushButton("停止")
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.stop_comparison)
+        button_layout.addWidget(self.stop_button)
+        self.export_button = QPushButton("导出结果")
+        self.export_button.setEnabled(False)
+        self.export_button.clicked.connect(self.export_results)
+        button_layout.addWidget(self.export_button)
+        layout.addLayout(button_layout)
+        
+        self.splitter = QSplitter(Qt.Orientation.Horizontal)
+        layout.addWidget(self.splitter, 1)
+        
+    def load_models(self) -> None:
+        """用缓存的模型列表填充选择框，缓存过期或没有缓存时在后台刷新"""
+        server_url = self.chat_window.get_server_url()
+        catalogue = self.chat_window.get_model_catalogue()
+        cached = catalogue.get(server_url) if catalogue is not None else None
+        if cached is not None:
+            self.show_models(cached[0])
+        if cached is None or not catalogue.is_fresh(cached[1]):
+            self.catalogue_request = self.transport.list_models(
+                server_url, self.bridge.catalogue_ready.emit, self.bridge.catalogue_error.emit,
+                catalogue=catalogue, known=cached[0] if cached is not None else None
+            )
+            
+    def handle_models_loaded(self, request_id: int, models: List[Dict[str, Any]]) -> None:
+        if request_id == self.catalogue_request:
+            self.catalogue_request = None
+            self.show_models(models)
             
-    def _check_service(self) -> None:
-        """检查Ollama服务是否可用"""
+    def show_models(self, models: List[Dict[str, Any]]) -> None:
+        """显示可选的模型，保留已勾选的模型，第一次显示时勾选当前模型"""
+        checked = set(self.selected_models()) if self.model_list.count() else {self.chat_window.current_model}
+        self.model_list.clear()
+        for model in models:
+            item = QListWidgetItem(ModelsDialog.model_label(model))
+            item.setData(Qt.ItemDataRole.UserRole, model['name'])
+            item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+            item.setCheckState(Qt.CheckState.Checked if model['name'] in checked else Qt.CheckState.Unchecked)
+            self.model_list.addItem(item)
+            
+    def selected_models(self) -> List[str]:
+        return [self.model_list.item(i).data(Qt.ItemDataRole.UserRole)
+                for i in range(self.model_list.count())
+                if self.model_list.item(i).checkState() == Qt.CheckState.Checked]
+        
+    def _add_column(self, model: str) -> None:
+        column = QWidget()
+        column.setMinimumWidth(COMPARE_COLUMN_MIN_WIDTH)
+        column_layout = QVBoxLayout(column)
+        column_layout.setContentsMargins(0, 0, 0, 0)
+        title = QLabel(f"<b>{model}</b>")
+        column_layout.addWidget(title)
+        text = QTextEdit()
+        text.setReadOnly(True)
+        column_layout.addWidget(text, 1)
+        status = QLabel("排队中...")
+        status.setWordWrap(True)
+        column_layout.addWidget(status)
+        self.splitter.addWidget(column)
+        self.columns[model] = (text, status)
+        
+    def start_comparison(self) -> None:
+        """把提示词发送给所有勾选的模型，每个模型一栏"""
+        prompt = self.prompt_input.toPlainText().strip()
+        models = self.selected_models()
+        if not prompt or not models:
+            self.info_label.setText("请输入提示词并至少勾选一个模型")
+            return
+        if self.run is not None and not self.run.done:
+            return
+        options = dict(DETERMINISTIC_OPTIONS) if self.deterministic_checkbox.isChecked() else None
+        self.run = ComparisonRun(prompt, models, self.system_input.text().strip(), options,
+                                 self.sequential_checkbox.isChecked())
+        while self.splitter.count():
+            column = self.splitter.widget(0)
+            column.setParent(None)
+            column.deleteLater()
+        self.columns.clear()
+        # 依次运行时所有请求共用一个调度队列，否则每个模型按各自的并发槽位同时执行
+        queue_key = ('compare', id(self.run)) if self.run.sequential else None
+        for model in models:
+            self._add_column(model)
+            self.run.answers[model].request_id = self.transport.generate(
+                self.chat_window.get_server_url(), model, prompt,
+                self.bridge.response_chunk.emit, self.bridge.response_complete.emit,
+                self.bridge.response_error.emit, options=self.chat_window.model_options(model, options),
+                messages=self.run.messages(),
+                keep_alive=self.chat_window.keep_alive_combo.currentData(), queue_key=queue_key
+            )
+        self.run_button.setEnabled(False)
+        self.stop_button.setEnabled(True)
+        self.export_button.setEnabled(False)
+        self.info_label.setText(f"正在比较 {len(models)} 个模型...")
+        
+    def _answer(self, request_id: int) -> Optional[ComparisonAnswer]:
+        return self.run.by_request(request_id) if self.run is not None else None
+        
+    def handle_chunk(self, request_id: int, chunk: str) -> None:
+        answer = self._answer(request_id)
+        if answer is None:
+            return
+        text, status = self.columns[answer.model]
+        if not answer.chunks:
+            status.setText("生成中...")
+        answer.chunks.append(chunk)
+        cursor = text.textCursor()
+        cursor.movePosition(cursor.MoveOperation.End)
+        cursor.insertText(chunk)
+        
+    def handle_complete(self, request_id: int, result: GenerationResult) -> None:
+        answer = self._answer(request_id)
+        if answer is None:
+            return
+        answer.finish(result.text, result.metrics)
+        self.chat_window.metrics_aggregator.record(result.metrics, self.run.options)
+        text, status = self.columns[answer.model]
+        text.setMarkdown(result.text)
+        status.setText(result.metrics.format_summary())
+        self._check_finished()
+        
+    def handle_error(self, request_id: int, error: Exception) -> None:
+        answer = self._answer(request_id)
+        if answer is None:
+            return
+        if not isinstance(error, (OllamaResponseError, GenerationCancelled)):
+            logger.error(f"比较模型 {answer.model} 时出错: {str(error)}")
+        answer.error = str(error)
+        self.columns[answer.model][1].setText(str(error))
+        self._check_finished()
+        
+    def _check_finished(self) -> None:
+        if not self.run.done:
+            return
+        self.run_button.setEnabled(True)
+        self.stop_button.setEnabled(False)
+        self.export_button.setEnabled(True)
+        self.info_label.setText("比较完成")
+        
+    def stop_comparison(self) -> None:
+        """停止所有未完成的回答"""
+        if self.run is None:
+            return
+        for answer in self.run.answers.values():
+            if not answer.done:
+                self.transport.cancel(answer.request_id)
+                
+    def export_results(self) -> None:
+        """把提示词、每个模型的回答和统计信息导出为JSON或Markdown"""
+        if self.run is None:
+            return
+        path, selected_filter = QFileDialog.getSaveFileName(
+            self, "导出比较结果", "ollama_compare.json", "JSON (*.json);;Markdown (*.md)"
+        )
+        if not path:
+            return
+        if path.endswith('.md') or selected_filter.startswith("Markdown"):
+            content = self.run.to_markdown()
+        else:
+            content = self.run.to_json()
         try:
-            response = requests.get(f'{self.server_url}/api/tags')
-            if response.status_code != 200:
-                raise Exception("Ollama服务未正常运行，请确保已启动ollama serve命令")
-        except requests.exceptions.ConnectionError:
-            raise Exception("无法连接到Ollama服务，请确保已启动ollama serve命令")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            self.info_label.setText(f"结果已导出到 {path}")
+        except OSError as e:
+            logger.error(f"导出比较结果时出错: {str(e)}")
+            QMessageBox.warning(self, "导出失败", str(e))
+            
+    def done(self, result: int) -> None:
+        """关闭时停止未完成的回答并断开信号"""
+        self.stop_comparison()
+        self.bridge.response_chunk.disconnect(self.handle_chunk)
+        self.bridge.response_complete.disconnect(self.handle_complete)
+        self.bridge.response_error.disconnect(self.handle_error)
+        self.bridge.catalogue_ready.disconnect(self.handle_models_loaded)
+        self.chat_window.compare_dialog = None
+        super().done(result)
+
+class ProfileDialog(QDialog):
+    """一个模型的请求参数：手动设置，或自动调优num_thread/num_batch后保存"""
+    
+    def __init__(self, parent: "ChatWindow", model: str) -> None:
+        super().__init__(parent)
+        self.chat_window = parent
+        self.model = model
+        self.transport = parent.transport
+        self.bridge = parent.bridge
+        self.profiles = parent.model_profiles
+        self.tune_request: Optional[int] = None
+        self.tune_total = 0
+        self.setWindowTitle(f"模型参数 - {model}")
+        self.setMinimumWidth(PROFILE_DIALOG_MIN_WIDTH)
+        self.setWindowIcon(QIcon("ollamaICO.png"))
+        
+        self._init_ui()
+        self.bridge.tune_progress.connect(self.handle_trial)
+        self.bridge.tune_done.connect(self.handle_tune_done)
+        self.show_options(self.profiles.get(model))
+        tuned = self.profiles.tuned(model)
+        if tuned:
+            tuned_at = time.strftime('%Y-%m-%d %H:%M', time.localtime(tuned['tuned_at']))
+            self.info_label.setText(f"上次自动调优: {tuned_at}")
+        
+    def _init_ui(self) -> None:
+        """初始化UI组件"""
+        layout = QVBoxLayout(self)
+        
+        form = QFormLayout()
+        self.spin_boxes: Dict[str, QSpinBox] = {}
+        for key, label, maximum in PROFILE_FIELDS:
+            spin_box = QSpinBox()
+            spin_box.setRange(0, maximum)
+            spin_box.setSpecialValueText("服务器默认")
+            form.addRow(label, spin_box)
+            self.spin_boxes[key] = spin_box
+        layout.addLayout(form)
+        
+        tune_layout = QHBoxLayout()
+        self.objective_combo = QComboBox()
+        self.objective_combo.addItem("解码速度最高", OBJECTIVE_TOKENS_PER_SECOND)
+        self.objective_combo.addItem("首字延迟最低", OBJECTIVE_TTFT)
+        tune_layout.addWidget(self.objective_combo, 1)
+        self.tune_button = QPushButton("自动调优")
+        self.tune_button.setToolTip("用标准提示词测试一组num_thread/num_batch组合，保存最好的组合")
+        self.tune_button.clicked.connect(self.start_tune)
+        tune_layout.addWidget(self.tune_button)
+        self.stop_button = QPushButton("停止")
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.stop_tune)
+        tune_layout.addWidget(self.stop_button)
+        layout.addLayout(tune_layout)
+        
+        self.trial_list = QListWidget()
+        layout.addWidget(self.trial_list)
+        
+        self.info_label = QLabel("")
+        self.info_label.setWordWrap(True)
+        layout.addWidget(self.info_label)
+        
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Save | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.save)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+        
+    def show_options(self, options: Dict[str, Any]) -> None:
+        for key, spin_box in self.spin_boxes.items():
+            spin_box.setValue(options.get(key) or 0)
             
-    def _send_generate_request(self) -> None:
-        """发送生成请求并处理响应"""
-        self.start_time = time.time()
-        response = requests.post(
-            f'{self.server_url}/api/generate',
-            json={
-                'model': self.model,
-                'prompt': self.prompt,
-                'stream': True
-            },
-            stream=True
+    def options(self) -> Dict[str, int]:
+        """界面中设置的参数，0表示使用服务器默认值"""
+        return {key: spin_box.value() for key, spin_box in self.spin_boxes.items() if spin_box.value()}
+        
+    def _store(self, options: Dict[str, Any], tuned: Optional[Dict[str, Any]] = None) -> bool:
+        try:
+            self.profiles.set(self.model, options, tuned)
+        except OSError as e:
+            logger.error(f"保存模型参数时出错: {str(e)}")
+            QMessageBox.warning(self, "保存失败", str(e))
+            return False
+        if self.model == self.chat_window.current_model:
+            self.chat_window.apply_model_profile()
+        return True
+        
+    def start_tune(self) -> None:
+        """在后台依次测试每个组合，其他参数（如num_ctx）使用界面中的设置"""
+        grid = tune_grid()
+        base_options = {key: value for key, value in self.options().items()
+                        if key not in ('num_thread', 'num_batch')}
+        self.tune_total = len(grid)
+        self.trial_list.clear()
+        self.tune_request = self.transport.tune(
+            self.chat_window.get_server_url(), self.model,
+            self.bridge.tune_done.emit, self.bridge.tune_done.emit, grid=grid,
+            on_trial=self.bridge.tune_progress.emit, base_options=base_options,
+            keep_alive=self.chat_window.keep_alive_combo.currentData()
         )
+        self.tune_button.setEnabled(False)
+        self.stop_button.setEnabled(True)
+        self.info_label.setText(f"正在测试 {self.tune_total} 个组合，每个组合需要重新加载模型...")
         
-        if response.status_code != 200:
-            self._handle_error_response(response)
+    def stop_tune(self) -> None:
+        if self.tune_request is not None:
+            self.transport.cancel(self.tune_request)
+            
+    def handle_trial(self, request_id: int, trial: TuneTrial) -> None:
+        if request_id != self.tune_request:
+            return
+        self.trial_list.addItem(trial.describe())
+        self.info_label.setText(f"已测试 {self.trial_list.count()}/{self.tune_total} 个组合...")
+        
+    def handle_tune_done(self, request_id: int, result: Any) -> None:
+        """选出最好的组合，显示在界面中并立即保存"""
+        if request_id != self.tune_request:
             return
+        self.tune_request = None
+        self.tune_button.setEnabled(True)
+        self.stop_button.setEnabled(False)
+        if isinstance(result, Exception):
+            if not isinstance(result, GenerationCancelled):
+                logger.error(f"自动调优时出错: {str(result)}")
+            self.info_label.setText(f"自动调优未完成: {str(result)}")
+            return
+        objective = self.objective_combo.currentData()
+        best = pick_best(result, objective)
+        if best is None:
+            self.info_label.setText("所有组合都测试失败，参数没有修改")
+            return
+        for key, value in best.options.items():
+            self.spin_boxes[key].setValue(value)
+        if self._store(self.options(), tune_record(result, best, objective)):
+            self.info_label.setText(f"最佳组合已保存: {best.describe()}")
             
-        self._process_response_stream(response)
-        
-    def _process_response_stream(self, response: requests.Response) -> None:
-        """处理流式响应"""
-        full_response = ""
-        for line in response.iter_lines():
-            if not line:
-                continue
-                
-            try:
-                chunk = line.decode('utf-8')
-                if chunk.startswith('data: '):
-                    chunk = chunk[6:]
-                if chunk == '[DONE]':
-                    break
-                    
-                response_data = json.loads(chunk)
-                if 'response' in response_data:
-                    chunk_text = response_data['response']
-                    full_response += chunk_text
-                    self.response_chunk.emit(chunk_text)
-                    
-            except Exception as e:
-                logger.error(f"处理响应块时出错: {str(e)}")
-                continue
-                
-        elapsed_time = time.time() - self.start_time
-        self.response_complete.emit(full_response, elapsed_time)
+    def save(self) -> None:
+        if self._store(self.options()):
+            self.accept()
+            
+    def done(self, result: int) -> None:
+        """关闭时停止未完成的调优并断开信号"""
+        self.stop_tune()
+        self.bridge.tune_progress.disconnect(self.handle_trial)
+        self.bridge.tune_done.disconnect(self.handle_tune_done)
+        super().done(result)
+
+class DocumentsDialog(QDialog):
+    """文档检索的来源和索引：添加文件或文件夹后增量更新索引，只处理有变化的文件"""
+    
+    def __init__(self, parent: "ChatWindow", index: DocumentIndex) -> None:
+        super().__init__(parent)
+        self.chat_window = parent
+        self.index = index
+        self.transport = parent.transport
+        self.bridge = parent.bridge
+        self.ingest_request: Optional[int] = None
+        self.setWindowTitle("文档检索")
+        self.setMinimumWidth(DOCUMENTS_DIALOG_MIN_WIDTH)
+        self.setWindowIcon(QIcon("ollamaICO.png"))
         
-    def _handle_error_response(self, response: requests.Response) -> None:
-        """处理错误响应"""
-        error_msg = f"错误：服务器返回状态码 {response.status_code}"
-        try:
-            error_detail = response.json().get('error', '未知错误')
-            error_msg += f"\n详细信息：{error_detail}"
+        self._init_ui()
+        self.bridge.ingest_progress.connect(self.handle_progress)
+        self.bridge.ingest_done.connect(self.handle_ingest_done)
+        self.show_sources()
+        self.show_stats()
+        
+    def _init_ui(self) -> None:
+        """初始化UI组件"""
+        layout = QVBoxLayout(self)
+        
+        layout.addWidget(QLabel("文档来源（文件夹中的文本、markdown和代码文件）:"))
+        self.source_list = QListWidget()
+        layout.addWidget(self.source_list)
+        
+        source_layout = QHBoxLayout()
+        add_folder_button = QPushButton("添加文件夹")
+        add_folder_button.clicked.connect(self.add_folder)
+        source_layout.addWidget(add_folder_button)
+        add_files_button = QPushButton("添加文件")
+        add_files_button.clicked.connect(self.add_files)
+        source_layout.addWidget(add_files_button)
+        remove_button = QPushButton("移除")
+        remove_button.clicked.connect(self.remove_source)
+        source_layout.addWidget(remove_button)
+        layout.addLayout(source_layout)
+        
+        form = QFormLayout()
+        self.embed_model_input = QLineEdit(self.index.setting('embed_model') or DEFAULT_EMBED_MODEL)
+        self.embed_model_input.setToolTip("计算向量的模型（例如 ollama pull nomic-embed-text），修改后需要重新计算全部文件")
+        form.addRow("嵌入模型:", self.embed_model_input)
+        self.top_k_spin = QSpinBox()
+        self.top_k_spin.setRange(1, RAG_MAX_TOP_K)
+        self.top_k_spin.setValue(int(self.index.setting('top_k', str(RAG_TOP_K))))
+        form.addRow("每条消息注入的片段数:", self.top_k_spin)
+        layout.addLayout(form)
+        
+        update_layout = QHBoxLayout()
+        self.info_label = QLabel("")
+        self.info_label.setWordWrap(True)
+        update_layout.addWidget(self.info_label, 1)
+        self.update_button = QPushButton("更新索引")
+        self.update_button.clicked.connect(self.start_ingest)
+        update_layout.addWidget(self.update_button)
+        self.stop_button = QPushButton("停止")
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.stop_ingest)
+        update_layout.addWidget(self.stop_button)
+        layout.addLayout(update_layout)
+        
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Close)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+        
+    def show_sources(self) -> None:
+        self.source_list.clear()
+        self.source_list.addItems(self.index.sources())
+        
+    def show_stats(self) -> None:
+        stats = self.index.stats()
+        self.info_label.setText(f"索引中共 {stats['files']} 个文件，{stats['chunks']} 个片段"
+                                f"（向量 {stats['bytes'] / 1024 ** 2:.1f} MB）")
+        
+    def add_folder(self) -> None:
+        path = QFileDialog.getExistingDirectory(self, "添加文件夹")
+        if path:
+            self.index.add_source(path)
+            self.show_sources()
             
-            if "model not found" in error_detail.lower():
-                error_msg += f"\n\n请使用 'ollama pull {self.model}' 命令来安装此模型"
-        except:
-            pass
-        self.response_ready.emit(error_msg)
+    def add_files(self) -> None:
+        paths, _ = QFileDialog.getOpenFileNames(self, "添加文件")
+        for path in paths:
+            self.index.add_source(path)
+        self.show_sources()
+        
+    def remove_source(self) -> None:
+        """移除选中的来源，其中的文件在下次更新索引时从索引中删除"""
+        item = self.source_list.currentItem()
+        if item is None:
+            return
+        self.index.remove_source(item.text())
+        self.show_sources()
+        self.info_label.setText("已移除，更新索引后生效")
+        
+    def start_ingest(self) -> None:
+        """在后台更新索引：新增和修改的文件重新计算向量，删除的文件从索引中移除"""
+        model = self.embed_model_input.text().strip()
+        if not model or self.ingest_request is not None:
+            return
+        self.ingest_request = self.transport.ingest(
+            self.chat_window.get_server_url(), self.index, model,
+            self.bridge.ingest_done.emit, self.bridge.ingest_done.emit,
+            on_progress=self.bridge.ingest_progress.emit
+        )
+        self.update_button.setEnabled(False)
+        self.stop_button.setEnabled(True)
+        self.info_label.setText("正在检查文件...")
+        
+    def stop_ingest(self) -> None:
+        if self.ingest_request is not None:
+            self.transport.cancel(self.ingest_request)
+            
+    def handle_progress(self, request_id: int, progress: Dict[str, Any]) -> None:
+        if request_id != self.ingest_request:
+            return
+        self.info_label.setText(f"已处理 {progress['done']}/{progress['files']} 个有变化的文件，"
+                                f"{progress['chunks']} 个片段")
+        
+    def handle_ingest_done(self, request_id: int, result: Any) -> None:
+        if request_id != self.ingest_request:
+            return
+        self.ingest_request = None
+        self.update_button.setEnabled(True)
+        self.stop_button.setEnabled(False)
+        if isinstance(result, Exception):
+            if not isinstance(result, GenerationCancelled):
+                logger.error(f"更新文档索引时出错: {str(result)}")
+            self.info_label.setText(f"更新未完成，已完成的文件已保存: {str(result)}")
+            return
+        self.show_stats()
+        summary = (f"更新了 {result['done'] - result['failed']} 个文件，删除了 {result['removed']} 个。"
+                   + self.info_label.text())
+        if result['failed']:
+            summary += f" {result['failed']} 个文件失败，详见日志"
+        self.info_label.setText(summary)
+        
+    def done(self, result: int) -> None:
+        """关闭时保存检索参数，停止未完成的更新并断开信号"""
+        self.index.set_setting('top_k', self.top_k_spin.value())
+        self.stop_ingest()
+        self.bridge.ingest_progress.disconnect(self.handle_progress)
+        self.bridge.ingest_done.disconnect(self.handle_ingest_done)
+        super().done(result)
+
+class MessageRenderer(QObject):
+    """在后台线程池中把消息渲染为HTML，主线程只负责把结果插入页面
+    
+    已完成的消息按(消息ID, 版本)缓存；正在生成的消息同一时间只有一个渲染任务，
+    任务进行中收到的新内容在任务完成后合并为一次渲染。
+    """
+    rendered = pyqtSignal(int, str)  # 消息ID和渲染好的HTML
+    _finished = pyqtSignal(object)  # 工作线程完成一个任务，转到主线程处理
+    
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE, workers: int = RENDER_WORKERS) -> None:
+        super().__init__()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ollama-render")
+        self._cache: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+        self._documents: Dict[int, StreamingDocument] = {}
+        self._running: Set[int] = set()
+        self._queued: Dict[int, ChatMessage] = {}
+        self._generation = 0
+        self._finished.connect(self._on_finished)
+        
+    def cached(self, message_id: int, message: ChatMessage) -> Optional[str]:
+        """读取已完成消息的缓存"""
+        if not message.done:
+            return None
+        key = (message_id, message.revision)
+        html = self._cache.get(key)
+        if html is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return html
+        
+    def render(self, message_id: int, message: ChatMessage) -> str:
+        """返回可以立即插入页面的HTML：缓存命中时是渲染结果，否则先返回纯文本，
+        后台渲染完成后通过rendered信号更新"""
+        html = self.cached(message_id, message)
+        if html is not None:
+            return html
+        self.schedule(message_id, message)
+        return render_placeholder(message.to_markdown())
+        
+    def schedule(self, message_id: int, message: ChatMessage) -> None:
+        """提交后台渲染，同一条消息已有任务在进行时等它完成后再渲染最新内容"""
+        if message_id in self._running:
+            self._queued[message_id] = message
+            return
+        self._running.add(message_id)
+        text, revision, done = message.to_markdown(), message.revision, message.done
+        if done:
+            self._documents.pop(message_id, None)
+            future = self._pool.submit(render_markdown, text)
+        else:
+            document = self._documents.setdefault(message_id, StreamingDocument())
+            future = self._pool.submit(document.render, text)
+        job = (self._generation, message_id, revision, done)
+        future.add_done_callback(lambda f: self._finished.emit(job + (f,)))
+        
+    def _on_finished(self, job: Tuple[int, int, int, bool, Future]) -> None:
+        generation, message_id, revision, done, future = job
+        if generation != self._generation:
+            # 会话已经切换，消息ID可能已经属于新会话的消息
+            return
+        self._running.discard(message_id)
+        try:
+            html: Optional[str] = future.result()
+        except Exception as e:
+            logger.error(f"渲染消息时出错: {str(e)}")
+            html = None
+        if html is not None and done:
+            self._cache[(message_id, revision)] = html
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        queued = self._queued.pop(message_id, None)
+        if queued is not None:
+            self.schedule(message_id, queued)
+        if html is not None:
+            self.rendered.emit(message_id, html)
+        
+    def clear(self) -> None:
+        """清空缓存，丢弃进行中任务的结果"""
+        self._generation += 1
+        self._cache.clear()
+        self._documents.clear()
+        self._running.clear()
+        self._queued.clear()
+        
+    def preload(self) -> None:
+        """在渲染线程中提前导入markdown，第一条消息不需要等待"""
+        self._pool.submit(render_markdown, "")
+        
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+class PendingResponse:
+    """一个进行中的生成请求在界面中的状态"""
+    
+    def __init__(self, prompt: str, model: str, options: Optional[Dict[str, Any]] = None) -> None:
+        self.prompt = prompt
+        self.model = model
+        self.options = options
+        self.message_id: Optional[int] = None  # 页面中的消息ID，收到第一个数据块时分配，加载更早的消息时不变
+
+class StreamBridge(QObject):
+    """把传输层在事件循环线程中的回调转换为Qt信号，按请求ID在主线程中处理"""
+    response_chunk = pyqtSignal(int, str)
+    response_complete = pyqtSignal(int, object)
+    response_error = pyqtSignal(int, object)
+    summary_ready = pyqtSignal(int, object)
+    warm_up_ready = pyqtSignal(int, object)
+    catalogue_ready = pyqtSignal(int, object)
+    catalogue_error = pyqtSignal(int, object)
+    tune_progress = pyqtSignal(int, object)
+    tune_done = pyqtSignal(int, object)
+    ingest_progress = pyqtSignal(int, object)
+    ingest_done = pyqtSignal(int, object)
 
 class ChatWindow(QMainWindow):
     def __init__(self) -> None:
@@ -216,15 +965,51 @@ class ChatWindow(QMainWindow):
         
         # 初始化属性
         self.current_model: str = ""
-        self.current_response: str = ""
-        self.current_response_start_time: Optional[float] = None
         self.server_url: str = DEFAULT_SERVER_URL
-        self.chat_history: List[str] = []
-        self.ollama_thread: Optional[OllamaThread] = None
+        self.chat_history: List[ChatMessage] = []
+        self.metrics_aggregator = MetricsAggregator()
+        self.response_cache: Optional[ResponseCache] = None
+        self.model_catalogue: Optional[ModelCatalogue] = None
+        self.compare_dialog: Optional[CompareDialog] = None
+        self.model_profiles: Optional[ModelProfiles] = self._open_profiles()
+        self.document_index: Optional[DocumentIndex] = None
+        self.gateway: Optional[OllamaGateway] = None
+        self.gateway_server_url = ""
+        self.conversation = Conversation()
+        self.transport = StreamTransport()
+        self.bridge = StreamBridge()
+        self.bridge.response_chunk.connect(self.handle_response_chunk)
+        self.bridge.response_complete.connect(self.handle_response_complete)
+        self.bridge.response_error.connect(self.handle_error)
+        self.bridge.summary_ready.connect(self.handle_summary_ready)
+        self.bridge.warm_up_ready.connect(self.handle_warm_up_ready)
+        self.pending: Dict[int, PendingResponse] = {}  # 进行中的生成请求，按请求ID索引
+        self.summary_request: Optional[Tuple[int, int]] = None  # 进行中的摘要请求ID和摘要覆盖到的位置
+        self.warm_up_request: Optional[Tuple[int, float]] = None  # 进行中的预热请求ID和开始时间
+        self.model_status: str = ""  # 当前模型的加载状态，显示在模型名称后面
+        self.renderer = MessageRenderer()
+        self.renderer.rendered.connect(self._on_message_rendered)
+        self._page_ready: bool = False
+        self._pending_scripts: List[str] = []
+        self._pending_html: Optional[str] = None  # 网页视图创建之前生成的完整页面
+        self._display_scheduled: bool = False
+        self.store: Optional[ConversationStore] = self._open_store()
+        self.conversation_id: Optional[int] = None
+        self.history_base: int = 0  # chat_history[0]在页面中的消息ID，加载更早的消息时减小
+        self.oldest_loaded_seq: Optional[int] = None  # 已加载的最早一条消息的序号，None表示没有更早的消息
         
         self._init_ui()
         self.show_startup_message()
         
+        # 定时在状态栏显示调度器中排队的请求数和等待时间
+        self.queue_timer = QTimer(self)
+        self.queue_timer.timeout.connect(self.update_queue_status)
+        self.queue_timer.start(QUEUE_STATUS_INTERVAL)
+        
+        # 常驻模型定时发送保活请求
+        self.keep_alive_timer = QTimer(self)
+        self.keep_alive_timer.timeout.connect(self.ping_pinned_model)
+        
     def _init_ui(self) -> None:
         """初始化UI组件"""
         main_widget = QWidget()
@@ -252,7 +1037,7 @@ class ChatWindow(QMainWindow):
         
         self.server_input = QTextEdit()
         self.server_input.setMaximumHeight(30)
-        self.server_input.setPlaceholderText("输入Ollama服务器地址...")
+        self.server_input.setPlaceholderText("输入Ollama服务器地址，多个地址用逗号分隔...")
         self.server_input.setText(self.server_url)
         server_layout.addWidget(self.server_input)
         
@@ -267,16 +1052,104 @@ class ChatWindow(QMainWindow):
         self.model_button.clicked.connect(self.select_model)
         model_layout.addWidget(self.model_button)
         
+        self.keep_alive_combo = QComboBox()
+        for label, value in KEEP_ALIVE_CHOICES:
+            self.keep_alive_combo.addItem(label, value)
+        self.keep_alive_combo.setCurrentIndex(self.keep_alive_combo.findData(DEFAULT_KEEP_ALIVE))
+        self.keep_alive_combo.setToolTip("模型在最后一次请求后保持加载的时间")
+        self.keep_alive_combo.currentIndexChanged.connect(self.warm_up_model)
+        model_layout.addWidget(self.keep_alive_combo)
+        
+        self.pin_checkbox = QCheckBox("常驻")
+        self.pin_checkbox.setToolTip("定时发送保活请求，让当前模型一直保持加载")
+        self.pin_checkbox.toggled.connect(self.toggle_pinned)
+        model_layout.addWidget(self.pin_checkbox)
+        
         model_layout.addStretch(1)
         
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItem("多轮对话 (/api/chat)", CHAT_MODE_CHAT)
+        self.mode_combo.addItem("多轮对话 (/api/generate + context)", CHAT_MODE_GENERATE)
+        model_layout.addWidget(self.mode_combo)
+        
+        self.cache_checkbox = QCheckBox("确定性回答并缓存")
+        self.cache_checkbox.setToolTip("使用temperature=0和固定seed生成，相同的问题直接从本地缓存回放")
+        model_layout.addWidget(self.cache_checkbox)
+        
+        self.profile_button = QPushButton("模型参数")
+        self.profile_button.setToolTip("设置当前模型的num_thread、num_ctx等参数，或自动调优")
+        self.profile_button.clicked.connect(self.edit_model_profile)
+        self.profile_button.setEnabled(self.model_profiles is not None)
+        model_layout.addWidget(self.profile_button)
+        
+        self.rag_checkbox = QCheckBox("检索文档")
+        self.rag_checkbox.setToolTip("发送前在本地文档索引中检索相关片段，放进这一次的提示词")
+        model_layout.addWidget(self.rag_checkbox)
+        
+        self.documents_button = QPushButton("文档")
+        self.documents_button.clicked.connect(self.open_documents)
+        model_layout.addWidget(self.documents_button)
+        
+        self.system_prompt_button = QPushButton("系统提示词")
+        self.system_prompt_button.clicked.connect(self.edit_system_prompt)
+        model_layout.addWidget(self.system_prompt_button)
+        
+        self.compare_button = QPushButton("模型比较")
+        self.compare_button.clicked.connect(self.open_comparison)
+        model_layout.addWidget(self.compare_button)
+        
+        self.gateway_checkbox = QCheckBox("本地网关")
+        self.gateway_checkbox.setToolTip("在本机提供Ollama和OpenAI兼容的接口，其他工具的请求与这里的对话一起排队")
+        self.gateway_checkbox.toggled.connect(self.toggle_gateway)
+        model_layout.addWidget(self.gateway_checkbox)
+        
+        self.export_metrics_button = QPushButton("导出统计")
+        self.export_metrics_button.clicked.connect(self.export_metrics)
+        model_layout.addWidget(self.export_metrics_button)
+        
+        self.history_button = QPushButton("历史会话")
+        self.history_button.clicked.connect(self.open_history)
+        self.history_button.setEnabled(self.store is not None)
+        model_layout.addWidget(self.history_button)
+        
+        self.clear_button = QPushButton("新对话")
+        self.clear_button.clicked.connect(self.clear_history)
+        model_layout.addWidget(self.clear_button)
+        
         top_layout.addLayout(model_layout)
         parent_layout.addLayout(top_layout)
         
     def _init_chat_display(self, parent_layout: QVBoxLayout) -> None:
-        """初始化聊天显示区域"""
+        """初始化聊天显示区域：先放一个占位控件，窗口第一次绘制后再创建网页视图"""
+        self.chat_display: Optional[Any] = None
+        self._chat_layout = parent_layout
+        self._chat_placeholder = QLabel("正在加载...")
+        self._chat_placeholder.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self._chat_placeholder.setStyleSheet("background-color: #1a1a1a; color: #888888;")
+        parent_layout.addWidget(self._chat_placeholder, 1)
+        
+    def paintEvent(self, event: Any) -> None:
+        super().paintEvent(event)
+        if self.chat_display is None and not self._display_scheduled:
+            self._display_scheduled = True
+            ollama_startup.mark("首次绘制窗口")
+            # 输入框已经可以使用，WebEngine的导入和初始化放到下一轮事件循环
+            QTimer.singleShot(0, self._create_chat_display)
+            
+    def _create_chat_display(self) -> None:
+        """导入QtWebEngine并创建网页视图，替换占位控件"""
+        from PyQt6.QtWebEngineWidgets import QWebEngineView
+        ollama_startup.mark("导入QtWebEngine")
         self.chat_display = QWebEngineView()
-        self.chat_display.setHtml(self.get_initial_html())
-        parent_layout.addWidget(self.chat_display)
+        self.chat_display.loadFinished.connect(self._on_page_loaded)
+        self.chat_display.titleChanged.connect(self._on_title_changed)
+        self._chat_layout.replaceWidget(self._chat_placeholder, self.chat_display)
+        self._chat_placeholder.deleteLater()
+        self.chat_display.setHtml(self._pending_html or self.get_initial_html())
+        self._pending_html = None
+        ollama_startup.mark("创建网页视图")
+        # 让一个渲染线程提前导入markdown
+        self.renderer.preload()
         
     def _init_input_area(self, parent_layout: QVBoxLayout) -> None:
         """初始化输入区域"""
@@ -292,147 +1165,135 @@ class ChatWindow(QMainWindow):
         self.send_button.setMinimumHeight(INPUT_MAX_HEIGHT)
         self.send_button.setMinimumWidth(SEND_BUTTON_MIN_WIDTH)
         self.send_button.clicked.connect(self.send_message)
-        input_layout.addWidget(self.send_button)
+        
+        self.stop_button = QPushButton("停止")
+        self.stop_button.setMinimumHeight(INPUT_MAX_HEIGHT)
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.stop_generation)
+        
+        button_layout = QVBoxLayout()
+        button_layout.addWidget(self.send_button)
+        button_layout.addWidget(self.stop_button)
+        input_layout.addLayout(button_layout)
         
         parent_layout.addLayout(input_layout)
         
     def get_server_url(self) -> str:
-        """获取用户输入的服务器地址"""
-        url = self.server_input.toPlainText().strip()
-        return url.rstrip('/') if url else DEFAULT_SERVER_URL
+        """获取用户输入的服务器地址，多个地址之间用逗号分隔"""
+        return ",".join(parse_server_urls(self.server_input.toPlainText()))
         
     def select_model(self) -> None:
         """打开模型选择对话框"""
-        dialog = ModelsDialog(self, self.get_server_url())
+        dialog = ModelsDialog(self, self.get_server_url(), self.transport,
+                              self.get_model_catalogue(), self.bridge)
         if dialog.exec():
             selected_model = dialog.get_selected_model()
             if selected_model:
+                if selected_model != self.current_model:
+                    self.conversation.reset_model_state()
                 self.current_model = selected_model
-                self.model_label.setText(f"当前模型: {self.current_model}")
                 self.add_system_message(f"已选择模型: {self.current_model}")
+                self.apply_model_profile()
+                
+    def model_options(self, model: str, options: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """发送给模型的参数：模型配置加上本次请求的参数"""
+        profile = self.model_profiles.get(model) if self.model_profiles is not None else None
+        return merge_options(profile, options)
+        
+    def apply_model_profile(self) -> None:
+        """按当前模型的num_ctx调整对话历史预算，并用新参数重新加载模型"""
+        profile = self.model_profiles.get(self.current_model) if self.model_profiles is not None else None
+        with self.conversation.lock:
+            self.conversation.context_manager.budget = context_budget(profile, CONTEXT_TOKEN_BUDGET)
+        self.warm_up_model()
         
+    def edit_model_profile(self) -> None:
+        """打开当前模型的参数对话框"""
+        if not self.current_model:
+            self.add_system_message("请先选择一个模型")
+            return
+        ProfileDialog(self, self.current_model).exec()
+                
+    def warm_up_model(self) -> None:
+        """选择模型或修改保持时间后，在后台加载模型，第一条消息不再等待模型加载"""
+        if not self.current_model:
+            return
+        request_id = self.transport.warm_up(
+            self.get_server_url(), self.current_model,
+            self.bridge.warm_up_ready.emit, self.bridge.warm_up_ready.emit,
+            keep_alive=self.keep_alive_combo.currentData(), options=self.model_options(self.current_model)
+        )
+        self.warm_up_request = (request_id, time.monotonic())
+        self.model_status = ""
+        self.update_model_label()
+        
+    def handle_warm_up_ready(self, request_id: int, result: Any) -> None:
+        """显示预热结果和/api/ps中的驻留状态"""
+        if self.warm_up_request is None or self.warm_up_request[0] != request_id:
+            return
+        self.warm_up_request = None
+        if isinstance(result, Exception):
+            logger.error(f"加载模型时出错: {str(result)}")
+            self.model_status = "加载失败"
+        else:
+            parts = ["已加载"]
+            if result['load_duration'] >= 0.1:
+                parts.append(f"加载用时 {result['load_duration']:.1f}秒")
+            running = result['running']
+            if running:
+                size_vram = running.get('size_vram', 0)
+                if size_vram:
+                    parts.append(f"显存 {size_vram / 1024 ** 3:.1f} GB")
+                if running.get('size') and size_vram < running['size']:
+                    parts.append("部分在CPU上运行")
+            self.model_status = " · ".join(parts)
+        self.update_model_label()
+        
+    def update_model_label(self) -> None:
+        """显示当前模型和加载状态，预热中时显示已用时间"""
+        text = f"当前模型: {self.current_model}"
+        if self.warm_up_request is not None:
+            text += f"（正在加载… {time.monotonic() - self.warm_up_request[1]:.0f}秒）"
+        elif self.model_status:
+            text += f"（{self.model_status}）"
+        self.model_label.setText(text)
+        
+    def toggle_pinned(self, pinned: bool) -> None:
+        """开启常驻后定时发送保活请求"""
+        if pinned:
+            self.keep_alive_timer.start(KEEP_ALIVE_PING_INTERVAL)
+            self.warm_up_model()
+        else:
+            self.keep_alive_timer.stop()
+            
+    def ping_pinned_model(self) -> None:
+        """保活请求：没有进行中的请求时重新发送预热，刷新模型的keep_alive"""
+        if self.pending or self.warm_up_request is not None:
+            return
+        self.warm_up_model()
+        
+    def edit_system_prompt(self) -> None:
+        """编辑固定的系统提示词（不会被移出上下文窗口）"""
+        prompt, ok = QInputDialog.getMultiLineText(
+            self, "系统提示词", "系统提示词:", self.conversation.context_manager.system_prompt
+        )
+        if ok:
+            with self.conversation.lock:
+                self.conversation.context_manager.set_system_prompt(prompt)
+            self.add_system_message("已更新系统提示词" if prompt.strip() else "已清除系统提示词")
+            
     def add_system_message(self, message: str) -> None:
         """添加系统消息"""
-        self.chat_history.append(f"**System:** {message}")
-        self.update_chat_display()
+        self.chat_history.append(ChatMessage('system', message))
+        self.append_message_to_display(len(self.chat_history) - 1)
         
     def show_startup_message(self) -> None:
         """显示启动消息"""
-        self.chat_history.append("**System:** 欢迎使用AI聊天助手！\n\n使用前请确保：\n1. Ollama服务已启动（运行 'ollama serve'）\n2. 请点击\"选择模型\"按钮选择一个已安装的模型")
-        self.update_chat_display()
-        
-        # 等待页面加载完成后再执行滚动
-        self.chat_display.loadFinished.connect(
-            lambda: self.chat_display.page().runJavaScript("scrollToBottom();")
-        )
+        self.add_system_message("欢迎使用AI聊天助手！\n\n使用前请确保：\n1. Ollama服务已启动（运行 'ollama serve'）\n2. 请点击\"选择模型\"按钮选择一个已安装的模型")
         
     def get_initial_html(self) -> str:
-        """获取初始HTML模板"""
-        return """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <style>
-                html {
-                    height: 100%;
-                    scroll-behavior: smooth;
-                }
-                body {
-                    font-family: Arial, sans-serif;
-                    margin: 0;
-                    padding: 20px;
-                    line-height: 1.6;
-                    background-color: #1a1a1a;
-                    color: #ffffff;
-                    min-height: 100%;
-                    display: flex;
-                    flex-direction: column;
-                }
-                .message {
-                    margin-bottom: 15px;
-                    padding: 10px;
-                    border-radius: 5px;
-                }
-                .user-message {
-                    background-color: #2b2b2b;
-                    margin-left: 20%;
-                    border: 1px solid #3b3b3b;
-                }
-                .ai-message {
-                    background-color: #2b2b2b;
-                    margin-right: 20%;
-                    border: 1px solid #3b3b3b;
-                }
-                .system-message {
-                    background-color: #2b2b2b;
-                    margin: 10px 0;
-                    padding: 10px;
-                    border-radius: 5px;
-                    border: 1px solid #3b3b3b;
-                }
-                .time-info {
-                    font-size: 0.8em;
-                    color: #888;
-                    margin-top: 5px;
-                    text-align: right;
-                }
-                code {
-                    background-color: #2d2d2d;
-                    padding: 2px 5px;
-                    border-radius: 3px;
-                    border: 1px solid #3b3b3b;
-                }
-                pre {
-                    background-color: #2d2d2d;
-                    padding: 10px;
-                    border-radius: 5px;
-                    overflow-x: auto;
-                    border: 1px solid #3b3b3b;
-                }
-                a {
-                    color: #66b3ff;
-                }
-                blockquote {
-                    border-left: 4px solid #3b3b3b;
-                    margin: 0;
-                    padding-left: 10px;
-                    color: #cccccc;
-                }
-                #chat-container {
-                    flex: 1;
-                    display: flex;
-                    flex-direction: column;
-                    gap: 15px;
-                    margin-bottom: 20px;
-                }
-                #scroll-anchor {
-                    height: 1px;
-                    width: 100%;
-                }
-                .spacer {
-                    flex-grow: 1;
-                }
-            </style>
-            <script>
-                function scrollToBottom() {
-                    window.scrollTo({
-                        top: document.body.scrollHeight,
-                        behavior: 'smooth'
-                    });
-                }
-                // 页面加载完成后执行滚动
-                document.addEventListener('DOMContentLoaded', function() {
-                    scrollToBottom();
-                });
-            </script>
-        </head>
-        <body>
-            <div id="chat-container"></div>
-            <div id="scroll-anchor"></div>
-        </body>
-        </html>
-        """
+        """获取初始HTML模板（页面外壳只加载一次，之后通过JavaScript增量更新）"""
+        return self._generate_full_html("")
         
     def send_message(self) -> None:
         """发送用户消息并获取AI响应"""
@@ -445,68 +1306,485 @@ class ChatWindow(QMainWindow):
             return
             
         # 添加用户消息到历史
-        self.chat_history.append(f"**You:** {user_message}")
-        self.update_chat_display()
+        message = ChatMessage('user', user_message)
+        self.chat_history.append(message)
+        self.append_message_to_display(len(self.chat_history) - 1, force_scroll=True)
+        self._store_user_message(message)
         
         # 清空输入框
         self.input_field.clear()
         
-        # 创建并启动Ollama线程
-        self.ollama_thread = OllamaThread(user_message, self.current_model, self.get_server_url())
-        self.ollama_thread.response_chunk.connect(self.handle_response_chunk)
-        self.ollama_thread.response_complete.connect(self.handle_response_complete)
-        self.ollama_thread.response_ready.connect(self.handle_error)
-        self.ollama_thread.start()
-        
-        # 记录开始时间
-        self.current_response_start_time = time.time()
-        self.current_response = ""
-        
-    def handle_response_chunk(self, chunk: str) -> None:
-        """处理AI响应的文本块"""
-        if not self.chat_history or not self.chat_history[-1].startswith(f"**{self.current_model}:**"):
-            self.chat_history.append(f"**{self.current_model}:** ")
-        self.current_response += chunk
-        self.chat_history[-1] = f"**{self.current_model}:** {self.current_response}"
-        self.update_chat_display()
+        # 提交到传输层，同一会话的消息按顺序排队，结果按请求ID分发
+        with self.conversation.lock:
+            self.conversation.mode = self.mode_combo.currentData()
+        options, cache = self.model_options(self.current_model), None
+        if self.cache_checkbox.isChecked():
+            options, cache = self.model_options(self.current_model, DETERMINISTIC_OPTIONS), self.get_response_cache()
+        request_id = self.transport.generate(
+            self.get_server_url(), self.current_model, user_message,
+            self.bridge.response_chunk.emit, self.bridge.response_complete.emit,
+            self.bridge.response_error.emit, options=options, cache=cache,
+            conversation=self.conversation, keep_alive=self.keep_alive_combo.currentData(),
+            retrieval=self.document_retrieval() if self.rag_checkbox.isChecked() else None
+        )
+        self.pending[request_id] = PendingResponse(user_message, self.current_model, options)
+        self.stop_button.setEnabled(True)
+        
+    def stop_generation(self) -> None:
+        """停止所有进行中的回答，已经收到的部分会保留并标记为未完成"""
+        for request_id in self.pending:
+            self.transport.cancel(request_id)
+        
+    def _open_store(self) -> Optional[ConversationStore]:
+        """打开会话数据库，失败时只在内存中保存当前会话"""
+        try:
+            return ConversationStore()
+        except Exception as e:
+            logger.error(f"打开会话数据库时出错: {str(e)}")
+            return None
+            
+    def _open_profiles(self) -> Optional[ModelProfiles]:
+        """读取模型参数配置，文件损坏时不使用配置"""
+        try:
+            return ModelProfiles()
+        except (OSError, ValueError) as e:
+            logger.error(f"读取模型参数配置时出错: {str(e)}")
+            return None
+            
+    def _store_user_message(self, message: ChatMessage) -> None:
+        """保存用户消息，当前没有会话时用这条消息作为标题新建一个"""
+        if self.store is None:
+            return
+        if self.conversation_id is None:
+            self.conversation_id = self.store.create_conversation(message.text, self.current_model)
+        message.store_id = self.store.append_message(self.conversation_id, 'user', message.text)
         
-        # 使用节流的滚动函数，避免频繁跳动
-        self.chat_display.page().runJavaScript("scrollToBottom();")
+    def get_model_catalogue(self) -> Optional[ModelCatalogue]:
+        """第一次打开模型对话框时才打开模型列表缓存"""
+        if self.model_catalogue is None:
+            try:
+                self.model_catalogue = ModelCatalogue()
+            except Exception as e:
+                logger.error(f"打开模型列表缓存时出错: {str(e)}")
+                return None
+        return self.model_catalogue
         
-    def handle_response_complete(self, response: str, elapsed_time: float) -> None:
+    def get_document_index(self) -> Optional[DocumentIndex]:
+        """第一次使用文档检索时才打开索引（同时导入NumPy）"""
+        if self.document_index is None:
+            try:
+                self.document_index = DocumentIndex()
+            except Exception as e:
+                logger.error(f"打开文档索引时出错: {str(e)}")
+                self.add_system_message(f"无法打开文档索引: {str(e)}")
+                return None
+        return self.document_index
+        
+    def document_retrieval(self) -> Optional[RetrievalSettings]:
+        """本条消息的检索参数，索引为空时不检索"""
+        index = self.get_document_index()
+        if index is None:
+            return None
+        if not index.stats()['chunks']:
+            self.add_system_message("文档索引为空，请先点击\"文档\"添加文件并更新索引")
+            return None
+        return RetrievalSettings(index, index.setting('embed_model'), int(index.setting('top_k', str(RAG_TOP_K))))
+        
+    def open_documents(self) -> None:
+        """打开文档检索对话框"""
+        index = self.get_document_index()
+        if index is not None:
+            DocumentsDialog(self, index).exec()
+            
+    def get_response_cache(self) -> Optional[ResponseCache]:
+        """第一次启用缓存时才打开缓存文件"""
+        if self.response_cache is None:
+            try:
+                self.response_cache = ResponseCache()
+            except Exception as e:
+                logger.error(f"打开响应缓存时出错: {str(e)}")
+                return None
+        return self.response_cache
+        
+    def handle_response_chunk(self, request_id: int, chunk: str) -> None:
+        """处理AI响应的文本块（只增量更新正在生成的消息）"""
+        pending = self.pending.get(request_id)
+        if pending is None:
+            # 会话已经切换，忽略旧请求的输出
+            return
+        if pending.message_id is None:
+            message = ChatMessage('assistant', chunk, pending.model)
+            self.chat_history.append(message)
+            pending.message_id = self.history_base + len(self.chat_history) - 1
+            self.append_message_to_display(len(self.chat_history) - 1)
+        else:
+            index = pending.message_id - self.history_base
+            message = self.chat_history[index]
+            message.append(chunk)
+            self.update_message_in_display(index)
+            
+        # 数据块由存储层分批在后台写入数据库，程序崩溃时最多丢失最近几秒的内容
+        if self.store is not None and self.conversation_id is not None:
+            if message.store_id is None:
+                message.store_id = self.store.append_message(
+                    self.conversation_id, 'assistant', chunk, model=pending.model, done=False
+                )
+            else:
+                self.store.append_chunk(message.store_id, chunk)
+                
+    def handle_response_complete(self, request_id: int, result: GenerationResult) -> None:
         """处理AI响应完成事件"""
-        self.chat_history[-1] = f"**{self.current_model}:** {response}\n\n*生成时间: {elapsed_time:.2f}秒*"
+        pending = self.pending.pop(request_id, None)
+        if pending is None:
+            return
+        self.stop_button.setEnabled(bool(self.pending))
+        # 成功完成的一轮已经由传输层写入对话（被停止的回答不写入，保持历史前缀稳定）
+        truncated = result.metrics.truncated
+        
+        # 记录本次生成的性能统计并加入按模型的汇总，被停止的生成会估算节省的计算量
+        self.metrics_aggregator.record(result.metrics, pending.options)
+        if self.response_cache is not None:
+            stats = self.response_cache.stats()
+            self.cache_checkbox.setToolTip(
+                f"缓存命中 {stats['hits']} 次，未命中 {stats['misses']} 次，"
+                f"共 {stats['entries']} 条 ({stats['bytes'] / 1024:.0f} KB)"
+            )
+            
+        time_info = result.metrics.format_summary()
+        if result.sources:
+            names = dict.fromkeys(os.path.basename(source['path']) for source in result.sources)
+            time_info += f" · 参考: {', '.join(names)}"
+        if pending.message_id is None:
+            message = ChatMessage('assistant', model=pending.model)
+            message.finish(result.text, time_info, result.metrics, truncated)
+            self.chat_history.append(message)
+            self.append_message_to_display(len(self.chat_history) - 1)
+        else:
+            # 生成结束后消息进入渲染缓存，之后不再重复解析
+            index = pending.message_id - self.history_base
+            message = self.chat_history[index]
+            message.finish(result.text, time_info, result.metrics, truncated)
+            self.update_message_in_display(index)
+        self._finish_stored_response(message, {
+            'summary': time_info,
+            'truncated': truncated,
+            'metrics': result.metrics.to_dict()
+        })
+        self.start_background_summary()
+        
+    def _finish_stored_response(self, message: ChatMessage, meta: Dict[str, Any]) -> None:
+        """写入完整回答，没有收到任何数据块时补写一条"""
+        if self.store is None or self.conversation_id is None:
+            return
+        if message.store_id is None:
+            message.store_id = self.store.append_message(self.conversation_id, 'assistant', message.text,
+                                                         model=message.model, meta=meta)
+        else:
+            self.store.finish_message(message.store_id, message.text, meta)
+        
+    def start_background_summary(self) -> None:
+        """模型空闲时在后台为移出窗口的旧消息生成摘要"""
+        if self.summary_request is not None or self.pending or not self.current_model:
+            return
+        context_manager = self.conversation.context_manager
+        with self.conversation.lock:
+            messages = context_manager.pending_summary()
+            if not messages:
+                return
+            transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+            prompt = (
+                "请把下面的对话压缩成一段简洁的摘要，保留事实、结论和用户的要求，不要添加新内容。\n\n"
+                f"已有摘要：\n{context_manager.summary or '（无）'}\n\n新增对话：\n{transcript}"
+            )
+            upto = context_manager.window_start
+        # 摘要以低优先级排队，用户发送的消息会先执行
+        request_id = self.transport.complete(
+            self.get_server_url(), self.current_model, prompt,
+            self.bridge.summary_ready.emit, self.bridge.summary_ready.emit,
+            keep_alive=self.keep_alive_combo.currentData(), options=self.model_options(self.current_model)
+        )
+        self.summary_request = (request_id, upto)
+        
+    def handle_summary_ready(self, request_id: int, result: Any) -> None:
+        """保存后台生成的对话摘要"""
+        if self.summary_request is None or self.summary_request[0] != request_id:
+            return
+        upto = self.summary_request[1]
+        self.summary_request = None
+        if isinstance(result, Exception):
+            logger.error(f"生成对话摘要时出错: {str(result)}")
+            return
+        with self.conversation.lock:
+            self.conversation.context_manager.apply_summary(result, upto)
+        logger.info(f"已更新对话摘要，上下文约 {self.conversation.context_manager.window_tokens} tokens")
+        
+    def update_queue_status(self) -> None:
+        """在状态栏显示排队中的请求数和最长等待时间"""
+        if self.warm_up_request is not None:
+            self.update_model_label()
+        if self.gateway is not None and self.get_server_url() != self.gateway_server_url:
+            # 网关使用界面中当前填写的服务器地址，修改后在事件循环线程中生效
+            self.gateway_server_url = self.get_server_url()
+            self.gateway.set_server_url(self.gateway_server_url)
+        status = self.transport.queue_status()
+        if status['queued']:
+            self.statusBar().showMessage(
+                f"排队中 {status['queued']} 个请求（其中对话 {status['queued_interactive']} 个），"
+                f"最长已等待 {status['oldest_wait']:.1f}秒 · 执行中 {status['running']} 个"
+            )
+        elif status['running']:
+            self.statusBar().showMessage(f"执行中 {status['running']} 个请求")
+        else:
+            self.statusBar().clearMessage()
+            
+    def toggle_gateway(self, enabled: bool) -> None:
+        """启动或停止本地网关，网关与界面共用传输层、模型参数配置和性能统计"""
+        if not enabled:
+            if self.gateway is not None:
+                self.gateway.stop()
+                self.gateway = None
+            self.gateway_checkbox.setToolTip("在本机提供Ollama和OpenAI兼容的接口，其他工具的请求与这里的对话一起排队")
+            return
+        self.gateway_server_url = self.get_server_url()
+        gateway = OllamaGateway(self.transport, self.gateway_server_url,
+                                metrics=self.metrics_aggregator, profiles=self.model_profiles)
+        try:
+            gateway.start()
+        except OSError as e:
+            logger.error(f"启动本地网关时出错: {str(e)}")
+            QMessageBox.warning(self, "本地网关", f"无法监听 {gateway.url}：{str(e)}")
+            self.gateway_checkbox.setChecked(False)
+            return
+        self.gateway = gateway
+        self.gateway_checkbox.setToolTip(f"Ollama接口: {gateway.url}\nOpenAI接口: {gateway.url}/v1")
+        
+    def open_comparison(self) -> None:
+        """打开多模型比较窗口（非模态，可以同时继续对话）"""
+        if self.compare_dialog is None:
+            self.compare_dialog = CompareDialog(self)
+            self.compare_dialog.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+        self.compare_dialog.show()
+        self.compare_dialog.raise_()
+        
+    def export_metrics(self) -> None:
+        """将按模型汇总的统计数据导出为JSON或Prometheus文本"""
+        path, selected_filter = QFileDialog.getSaveFileName(
+            self, "导出统计", "ollama_metrics.json", "JSON (*.json);;Prometheus (*.prom)"
+        )
+        if not path:
+            return
+        if path.endswith('.prom') or selected_filter.startswith("Prometheus"):
+            content = self.metrics_aggregator.to_prometheus()
+        else:
+            content = self.metrics_aggregator.to_json()
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            self.add_system_message(f"统计数据已导出到 {path}")
+        except OSError as e:
+            logger.error(f"导出统计数据时出错: {str(e)}")
+            QMessageBox.warning(self, "导出失败", str(e))
+            
+    def handle_error(self, request_id: int, error: Exception) -> None:
+        """处理生成请求的错误"""
+        pending = self.pending.pop(request_id, None)
+        if pending is None:
+            return
+        self.stop_button.setEnabled(bool(self.pending))
+        if isinstance(error, (OllamaResponseError, GenerationCancelled)):
+            error_message = str(error)
+        else:
+            logger.error(f"生成响应时出错: {str(error)}")
+            error_message = f"错误：{str(error)}\n请确保已安装所需的模型（使用 'ollama pull {pending.model}' 命令）"
+        if pending.message_id is not None:
+            # 生成中途出错时保留已经收到的部分
+            index = pending.message_id - self.history_base
+            message = self.chat_history[index]
+            message.finish(truncated=True)
+            self.update_message_in_display(index)
+            if message.store_id is not None:
+                self._finish_stored_response(message, {'error': error_message, 'truncated': True})
+        self.chat_history.append(ChatMessage('system', error_message))
+        # 错误信息也需要滚动到底部
+        self.append_message_to_display(len(self.chat_history) - 1, force_scroll=True)
+        
+    def clear_history(self) -> None:
+        """开始新的会话（显式操作，执行一次完整的页面重载），之前的会话仍保存在数据库中"""
+        self._reset_session()
         self.update_chat_display()
         
-        # 在回答完成时滚动到底部
-        self.chat_display.page().runJavaScript("scrollToBottom();")
+    def _reset_session(self) -> None:
+        """清空当前会话在内存中的状态"""
+        self.chat_history.clear()
+        self.conversation.clear()
+        self.conversation_id = None
+        for request_id in self.pending:
+            # 旧会话的回答不再显示，停止生成以免继续占用服务器
+            self.transport.cancel(request_id)
+        self.pending.clear()
+        self.stop_button.setEnabled(False)
+        self.summary_request = None
+        self.history_base = 0
+        self.oldest_loaded_seq = None
+        self.renderer.clear()
+        
+    def open_history(self) -> None:
+        """打开历史会话对话框"""
+        if self.store is None:
+            return
+        dialog = HistoryDialog(self.store, self)
+        accepted = dialog.exec()
+        if self.conversation_id in dialog.deleted:
+            # 当前会话已被删除，之后的消息保存到一个新的会话中
+            self.conversation_id = None
+        if accepted:
+            conversation_id = dialog.get_selected_conversation()
+            if conversation_id is not None:
+                self.open_conversation(conversation_id)
+                
+    def open_conversation(self, conversation_id: int) -> None:
+        """打开一个历史会话，只加载最近一页消息，更早的消息在向上滚动时再加载"""
+        if self.pending:
+            self.add_system_message("请等待当前回答完成后再切换会话")
+            return
+        info = self.store.get_conversation(conversation_id)
+        if info is None:
+            return
+        page = self.store.load_page(conversation_id)
+        self._reset_session()
+        self.conversation_id = conversation_id
+        self.chat_history = [ChatMessage.from_stored(message) for message in page]
+        self.oldest_loaded_seq = page[0]['seq'] if page and page[0]['seq'] > 0 else None
         
-    def handle_error(self, error_message: str) -> None:
-        """处理错误消息"""
-        self.chat_history.append(f"**System:** {error_message}")
+        # 用最近一页重建发送给模型的上下文，更早的内容超出上下文预算时本来也会被移出窗口
+        for message in page:
+            if message['role'] in ('user', 'assistant') and message['done']:
+                self.conversation.context_manager.add(message['role'], message['content'])
+        if info['model'] and not self.current_model:
+            self.current_model = info['model']
+            self.warm_up_model()
         self.update_chat_display()
-        # 错误信息也需要滚动到底部
-        self.chat_display.page().runJavaScript("scrollToBottom();")
+        
+    def load_older_messages(self) -> None:
+        """向上滚动到顶部时加载更早的一页消息，插入到页面最前面"""
+        if self.store is None or self.conversation_id is None or self.oldest_loaded_seq is None:
+            self._run_script("setHasOlder(false);")
+            return
+        page = self.store.load_page(self.conversation_id, before_seq=self.oldest_loaded_seq)
+        self.oldest_loaded_seq = page[0]['seq'] if page and page[0]['seq'] > 0 else None
+        older = [ChatMessage.from_stored(message) for message in page]
+        self.chat_history[:0] = older
+        self.history_base -= len(older)
+        items = [
+            [self.history_base + index, self._get_message_class(message), self._render_message(index)]
+            for index, message in enumerate(older)
+        ]
+        self._run_script(
+            f"prependMessages({json.dumps(items)}); setHasOlder({json.dumps(self.oldest_loaded_seq is not None)});"
+        )
+        
+    def _on_title_changed(self, title: str) -> None:
+        """页面通过修改标题通知向上滚动到了顶部，或移除了最早的消息"""
+        if title.startswith("load-older:"):
+            self.load_older_messages()
+        elif title.startswith("trimmed:"):
+            self.drop_messages_before(int(title.split(":")[1]))
+            
+    def drop_messages_before(self, message_id: int) -> None:
+        """页面已移除message_id之前的消息，同样从内存中移除，之后向上滚动时从数据库重新加载"""
+        # 进行中的回答还要更新，不能移除
+        pending_ids = [pending.message_id for pending in self.pending.values() if pending.message_id is not None]
+        count = min([message_id] + pending_ids) - self.history_base
+        if self.store is None or count <= 0:
+            return
+        dropped = self.chat_history[:count]
+        del self.chat_history[:count]
+        self.history_base += count
+        # 剩下的第一条已保存的消息之前的消息都可以重新加载（序号为0时没有更早的消息）
+        seq: Optional[int] = None
+        first = next((message.store_id for message in self.chat_history if message.store_id is not None), None)
+        if first is not None:
+            seq = self.store.message_seq(first)
+        else:
+            last = next((message.store_id for message in reversed(dropped) if message.store_id is not None), None)
+            if last is not None and self.store.message_seq(last) is not None:
+                seq = self.store.message_seq(last) + 1
+        self.oldest_loaded_seq = seq or None
+        self._run_script(f"setHasOlder({json.dumps(self.oldest_loaded_seq is not None)});")
         
     def update_chat_display(self) -> None:
-        """更新聊天显示区域的内容"""
+        """完整重新渲染聊天显示区域（仅用于清空记录等显式操作）"""
         messages_html = self._generate_messages_html()
         html_content = self._generate_full_html(messages_html)
+        self._page_ready = False
+        self._pending_scripts.clear()
+        if self.chat_display is None:
+            self._pending_html = html_content
+            return
         self.chat_display.setHtml(html_content)
         
+    def append_message_to_display(self, index: int, force_scroll: bool = False) -> None:
+        """将一条新消息作为DOM节点追加到页面"""
+        message = self.chat_history[index]
+        self._run_script(
+            f"appendMessage({self.history_base + index}, {json.dumps(self._get_message_class(message))}, "
+            f"{json.dumps(self._render_message(index))}, {json.dumps(force_scroll)});"
+        )
+        
+    def update_message_in_display(self, index: int) -> None:
+        """只替换指定消息的DOM内容，需要重新渲染时在渲染完成后替换"""
+        message_id = self.history_base + index
+        html = self.renderer.cached(message_id, self.chat_history[index])
+        if html is None:
+            self.renderer.schedule(message_id, self.chat_history[index])
+            return
+        self._on_message_rendered(message_id, html)
+        
+    def _on_message_rendered(self, message_id: int, html: str) -> None:
+        """后台渲染完成，把HTML插入页面"""
+        self._run_script(f"updateMessage({message_id}, {json.dumps(html)});")
+        
+    def _run_script(self, script: str) -> None:
+        """在页面中执行JavaScript，页面未加载完成时先排队"""
+        if not self._page_ready:
+            self._pending_scripts.append(script)
+            return
+        self.chat_display.page().runJavaScript(script)
+        
+    def _on_page_loaded(self, ok: bool) -> None:
+        """页面外壳加载完成后执行排队中的脚本"""
+        self._page_ready = True
+        scripts, self._pending_scripts = self._pending_scripts, []
+        scripts.append(f"setHasOlder({json.dumps(self.oldest_loaded_seq is not None)});")
+        # 没有数据库时移除的消息无法重新加载，保留全部消息
+        scripts.append(f"setCanTrim({json.dumps(self.store is not None)});")
+        scripts.append("scrollToBottom();")
+        self.chat_display.page().runJavaScript("\n".join(scripts))
+        if ollama_startup.PROFILE_STARTUP:
+            ollama_startup.mark("页面加载完成")
+            print(ollama_startup.report(), file=sys.stderr)
+            QApplication.quit()
+        
+    def _get_message_class(self, message: ChatMessage) -> str:
+        """根据消息角色获取样式类名"""
+        if message.role == 'user':
+            return "user-message"
+        elif message.role == 'system':
+            return "system-message"
+        return "ai-message"
+        
+    def _render_message(self, index: int) -> str:
+        """返回消息的HTML，没有缓存时先返回纯文本，后台渲染完成后再替换"""
+        return self.renderer.render(self.history_base + index, self.chat_history[index])
+        
     def _generate_messages_html(self) -> str:
         """生成消息的HTML内容"""
         messages_html = ""
-        for message in self.chat_history:
-            # 转换markdown为HTML
-            message_html = markdown.markdown(message)
-            # 添加消息样式
-            if message.startswith("**You:**"):
-                messages_html += f'<div class="message user-message">{message_html}</div>'
-            elif message.startswith("**System:**"):
-                messages_html += f'<div class="message system-message">{message_html}</div>'
-            else:  # AI模型的消息
-                messages_html += f'<div class="message ai-message">{message_html}</div>'
+        for index, message in enumerate(self.chat_history):
+            messages_html += (
+                f'<div id="msg-{self.history_base + index}" class="message {self._get_message_class(message)}">'
+                f'{self._render_message(index)}</div>'
+            )
         return messages_html
         
     def _generate_full_html(self, messages_html: str) -> str:
@@ -519,7 +1797,6 @@ class ChatWindow(QMainWindow):
             <style>
                 html {{
                     height: 100%;
-                    scroll-behavior: smooth;
                 }}
                 body {{
                     font-family: Arial, sans-serif;
@@ -536,6 +1813,10 @@ class ChatWindow(QMainWindow):
                     margin-bottom: 15px;
                     padding: 10px;
                     border-radius: 5px;
+                    box-sizing: border-box;
+                }}
+                .message.placeholder {{
+                    visibility: hidden;
                 }}
                 .user-message {{
                     background-color: #2b2b2b;
@@ -573,6 +1854,15 @@ class ChatWindow(QMainWindow):
                     overflow-x: auto;
                     border: 1px solid #3b3b3b;
                 }}
+                pre code {{
+                    background-color: transparent;
+                    padding: 0;
+                    border: none;
+                }}
+                .rendering {{
+                    white-space: pre-wrap;
+                }}
+                {highlight_css()}
                 a {{
                     color: #66b3ff;
                 }}
@@ -598,17 +1888,146 @@ class ChatWindow(QMainWindow):
                 }}
             </style>
             <script>
+                var scrollPending = false;
+                function isAtBottom() {{
+                    return window.innerHeight + window.scrollY >= document.body.scrollHeight - 40;
+                }}
+                // 每帧最多滚动一次，且只在用户停留在底部时跟随
                 function scrollToBottom() {{
-                    window.scrollTo({{
-                        top: document.body.scrollHeight,
-                        behavior: 'smooth'
+                    if (scrollPending) {{
+                        return;
+                    }}
+                    scrollPending = true;
+                    window.requestAnimationFrame(function() {{
+                        scrollPending = false;
+                        window.scrollTo(0, document.body.scrollHeight);
+                    }});
+                }}
+                // 虚拟列表：离开视口附近的消息替换为按测量高度固定的空占位块，
+                // HTML保存在parked中，重新靠近视口时恢复并自然地重新测量，
+                // 因此页面中需要排版的内容只和视口附近的消息数量有关；
+                // 页面中的消息数（包括parked）由trimOldest限制在{MAX_LOADED_MESSAGES}条以内
+                var parked = {{}};
+                var observer = new IntersectionObserver(function(entries) {{
+                    entries.forEach(function(entry) {{
+                        if (entry.isIntersecting) {{
+                            rehydrate(entry.target);
+                        }} else {{
+                            park(entry.target);
+                        }}
                     }});
+                }}, {{ rootMargin: '{VIRTUAL_MARGIN}px 0px' }});
+                function park(node) {{
+                    if (node.id in parked) {{
+                        return;
+                    }}
+                    parked[node.id] = node.innerHTML;
+                    node.style.height = node.offsetHeight + 'px';
+                    node.innerHTML = '';
+                    node.classList.add('placeholder');
+                }}
+                function rehydrate(node) {{
+                    if (!(node.id in parked)) {{
+                        return;
+                    }}
+                    node.innerHTML = parked[node.id];
+                    delete parked[node.id];
+                    node.style.height = '';
+                    node.classList.remove('placeholder');
+                }}
+                function setContent(node, html) {{
+                    if (node.id in parked) {{
+                        parked[node.id] = html;
+                    }} else {{
+                        node.innerHTML = html;
+                    }}
+                }}
+                function createMessage(id, className, html) {{
+                    var node = document.createElement('div');
+                    node.id = 'msg-' + id;
+                    node.className = 'message ' + className;
+                    node.innerHTML = html;
+                    return node;
                 }}
-                // 确保页面加载完成后立即定义函数
                 document.addEventListener('DOMContentLoaded', function() {{
-                    window.scrollToBottom = scrollToBottom;
-                    scrollToBottom();
+                    document.querySelectorAll('#chat-container > .message').forEach(function(node) {{
+                        observer.observe(node);
+                    }});
+                }});
+                function appendMessage(id, className, html, force) {{
+                    var follow = force || isAtBottom();
+                    var node = createMessage(id, className, html);
+                    document.getElementById('chat-container').appendChild(node);
+                    observer.observe(node);
+                    if (follow) {{
+                        trimOldest();
+                        scrollToBottom();
+                    }}
+                }}
+                // 停留在底部时移除超出上限的最早的消息（不影响看到的内容），通过标题通知程序；
+                // 程序随后调用setHasOlder，向上滚动时从数据库重新加载
+                var canTrim = false;
+                function setCanTrim(value) {{
+                    canTrim = value;
+                }}
+                function trimOldest() {{
+                    var container = document.getElementById('chat-container');
+                    var excess = container.children.length - {MAX_LOADED_MESSAGES};
+                    if (!canTrim || excess <= 0) {{
+                        return;
+                    }}
+                    for (var i = 0; i < excess; i++) {{
+                        var node = container.firstElementChild;
+                        observer.unobserve(node);
+                        delete parked[node.id];
+                        container.removeChild(node);
+                    }}
+                    document.title = 'trimmed:' + container.firstElementChild.id.slice(4) + ':' + Date.now();
+                }}
+                // 向上滚动到顶部附近时通过修改标题通知程序加载更早的消息
+                var hasOlder = false;
+                var loadingOlder = false;
+                function setHasOlder(value) {{
+                    hasOlder = value;
+                    loadingOlder = false;
+                }}
+                window.addEventListener('scroll', function() {{
+                    if (isAtBottom()) {{
+                        // 向上浏览时加载的更早的消息，回到底部后再移除
+                        trimOldest();
+                    }}
+                    if (hasOlder && !loadingOlder && window.scrollY < {LOAD_OLDER_THRESHOLD}) {{
+                        loadingOlder = true;
+                        document.title = 'load-older:' + Date.now();
+                    }}
                 }});
+                function prependMessages(items) {{
+                    var container = document.getElementById('chat-container');
+                    var previousHeight = document.body.scrollHeight;
+                    var fragment = document.createDocumentFragment();
+                    var nodes = items.map(function(item) {{
+                        var node = createMessage(item[0], item[1], item[2]);
+                        fragment.appendChild(node);
+                        return node;
+                    }});
+                    container.insertBefore(fragment, container.firstChild);
+                    nodes.forEach(function(node) {{
+                        observer.observe(node);
+                    }});
+                    // 保持当前看到的内容位置不变
+                    window.scrollBy(0, document.body.scrollHeight - previousHeight);
+                }}
+                function updateMessage(id, html) {{
+                    var node = document.getElementById('msg-' + id);
+                    if (!node) {{
+                        return;
+                    }}
+                    var follow = isAtBottom();
+                    setContent(node, html);
+                    if (follow) {{
+                        scrollToBottom();
+                    }}
+                }}
             </script>
         </head>
         <body>
@@ -632,14 +2051,32 @@ class ChatWindow(QMainWindow):
         else:
             # 其他按键正常处理
             QTextEdit.keyPressEvent(self.input_field, event)
+            
+    def closeEvent(self, event: Any) -> None:
+        """关闭窗口时停止本地网关，取消进行中的请求并停止传输层的事件循环"""
+        if self.gateway is not None:
+            self.gateway.stop()
+        self.transport.close()
+        self.renderer.shutdown()
+        if self.document_index is not None:
+            self.document_index.close()
+        super().closeEvent(event)
 
-if __name__ == '__main__':
-    app = QApplication(sys.argv)
+def create_application(argv: List[str]) -> QApplication:
+    """创建QApplication；QtWebEngine在窗口显示后才导入，需要先设置共享OpenGL上下文"""
+    QApplication.setAttribute(Qt.ApplicationAttribute.AA_ShareOpenGLContexts)
+    app = QApplication(argv)
     
     # 设置应用图标
     app_icon = QIcon("ollamaICO.png")
     app.setWindowIcon(app_icon)
+    ollama_startup.mark("创建QApplication")
+    return app
+
+if __name__ == '__main__':
+    app = create_application(sys.argv)
     
     window = ChatWindow()
+    ollama_startup.mark("创建主窗口")
     window.show()
     sys.exit(app.exec()) 
\ No newline at end of file
@@ -1,12 +1,19 @@
 # -*- mode: python ; coding: utf-8 -*-
+# 默认打包为单个exe；pyinstaller OllamaAIChatTool.spec -- --onedir 打包为目录，
+# 启动时不需要把QtWebEngine解压到临时目录，启动更快
+import argparse
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--onedir', action='store_true')
+options = parser.parse_args()
 
 a = Analysis(
     ['OllamaAIChatTool.py'],
     pathex=[],
     binaries=[],
     datas=[('ollamaICO.png', '.')],
-    hiddenimports=[],
+    hiddenimports=['markdown.extensions.fenced_code', 'markdown.extensions.tables',
+                   'markdown.extensions.codehilite'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -16,12 +23,14 @@ a = Analysis(
 )
 pyz = PYZ(a.pure)
 
+if options.onedir:
+    exe_contents = [pyz, a.scripts, []]
+else:
+    exe_contents = [pyz, a.scripts, a.binaries, a.datas, []]
+
 exe = EXE(
-    pyz,
-    a.scripts,
-    a.binaries,
-    a.datas,
-    [],
+    *exe_contents,
+    exclude_binaries=options.onedir,
     name='OllamaAIChatTool',
     debug=False,
     bootloader_ignore_signals=False,
@@ -37,3 +46,14 @@ exe = EXE(
     entitlements_file=None,
     icon=['ollamaICO.png'],
 )
+
+if options.onedir:
+    coll = COLLECT(
+        exe,
+        a.binaries,
+        a.datas,
+        strip=False,
+        upx=True,
+        upx_exclude=[],
+        name='OllamaAIChatTool',
+    )
@@ -0,0 +1,156 @@
+# Ollama AI Chat Tool 的批处理模式：从JSONL文件读取提示词，并发生成后把结果逐行写入JSONL
+# 用法：python OllamaAIChatTool.py --batch prompts.jsonl --models llama3,qwen2 --output results.jsonl
+#
+# 输入的每一行是一个JSON对象：
+#   {"id": "q1", "prompt": "你好", "model": "llama3", "system": "可选的系统提示词", "options": {"temperature": 0}}
+# 没有指定model时使用 --models 中的每个模型各运行一次
+
+import sys
+import json
+import time
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Dict, Optional, Any, Iterator, TextIO, Set
+
+from ollama_engine import DEFAULT_SERVER_URL, ChatEngine, MetricsAggregator
+from ollama_cache import RESPONSE_CACHE_PATH, ResponseCache
+from ollama_profiles import ModelProfiles, merge_options
+
+BATCH_WORKERS = 2  # 默认并发数，单槽位的Ollama服务器上更多的并发只会排队
+
+logger = logging.getLogger(__name__)
+
+def read_jobs(path: str, default_models: List[str]) -> Iterator[Dict[str, Any]]:
+    """逐行读取输入文件，展开为（提示词, 模型）任务"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error(f"第 {line_number} 行不是有效的JSON: {str(e)}")
+                continue
+            if isinstance(item, str):
+                item = {'prompt': item}
+            models = [item['model']] if item.get('model') else default_models
+            if not models:
+                logger.error(f"第 {line_number} 行没有指定模型，请使用 --models 参数")
+                continue
+            for model in models:
+                yield {
+                    'id': item.get('id', line_number),
+                    'prompt': item.get('prompt', ''),
+                    'system': item.get('system'),
+                    'options': item.get('options'),
+                    'model': model
+                }
+
+def apply_profiles(jobs: Iterator[Dict[str, Any]], profiles: ModelProfiles) -> Iterator[Dict[str, Any]]:
+    """在每个任务的参数前加上该模型保存的参数配置，输入行中的options优先"""
+    for job in jobs:
+        job['options'] = merge_options(profiles.get(job['model']), job['options'])
+        yield job
+
+def run_job(engine: ChatEngine, job: Dict[str, Any]) -> Dict[str, Any]:
+    """执行一个任务，出错时把错误写入结果而不是抛出"""
+    result: Dict[str, Any] = dict(job)
+    messages = [{'role': 'system', 'content': job['system']}] if job.get('system') else None
+    try:
+        generation = engine.generate(job['model'], job['prompt'], messages=messages,
+                                     options=job.get('options'))
+        result['response'] = generation.text
+        result['metrics'] = generation.metrics.to_dict()
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+class BatchRunner:
+    """用有界的线程池运行批处理任务，结果按完成顺序写出"""
+
+    def __init__(self, engine: ChatEngine, output: TextIO, workers: int = BATCH_WORKERS) -> None:
+        self.engine = engine
+        self.output = output
+        self.workers = max(1, workers)
+        self.completed = 0
+        self.failed = 0
+        self.eval_tokens = 0
+        self._lock = threading.Lock()
+
+    def _write(self, result: Dict[str, Any]) -> None:
+        with self._lock:
+            self.output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self.output.flush()
+            self.completed += 1
+            if 'error' in result:
+                self.failed += 1
+            elif not result['metrics']['cached']:
+                self.eval_tokens += result['metrics']['eval_count']
+
+    def run(self, jobs: Iterator[Dict[str, Any]]) -> float:
+        """运行全部任务，返回总耗时（秒）；同时在执行中的任务数不超过并发数的两倍"""
+        start = time.perf_counter()
+        pending: Set[Future] = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for job in jobs:
+                if len(pending) >= self.workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._write(future.result())
+                pending.add(executor.submit(run_job, self.engine, job))
+            for future in wait(pending).done:
+                self._write(future.result())
+        return time.perf_counter() - start
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Ollama AI Chat Tool 批处理模式")
+    parser.add_argument('--batch', required=True, metavar='INPUT', help="输入的JSONL文件")
+    parser.add_argument('--models', default='', help="逗号分隔的模型列表，用于没有指定model的行")
+    parser.add_argument('--output', default='-', help="输出的JSONL文件，默认为标准输出")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help="并发请求数")
+    parser.add_argument('--server', default=DEFAULT_SERVER_URL, help="Ollama服务器地址")
+    parser.add_argument('--metrics', default='', help="把按模型汇总的统计数据写入该JSON文件")
+    parser.add_argument('--cache', nargs='?', const=RESPONSE_CACHE_PATH, default='',
+                        help="启用确定性请求的响应缓存，可以指定缓存文件路径")
+    parser.add_argument('--no-profiles', action='store_true', help="不使用保存的模型参数配置")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    models = [model.strip() for model in args.models.split(',') if model.strip()]
+    cache = ResponseCache(args.cache) if args.cache else None
+    engine = ChatEngine(args.server, metrics=MetricsAggregator(), cache=cache)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        runner = BatchRunner(engine, output, args.workers)
+        jobs = read_jobs(args.batch, models)
+        if not args.no_profiles:
+            jobs = apply_profiles(jobs, ModelProfiles())
+        elapsed = runner.run(jobs)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(
+        f"完成 {runner.completed} 个请求（失败 {runner.failed} 个），耗时 {elapsed:.2f}秒，"
+        f"{runner.completed / elapsed if elapsed else 0:.2f} 请求/秒，"
+        f"{runner.eval_tokens / elapsed if elapsed else 0:.1f} tokens/秒",
+        file=sys.stderr
+    )
+    if cache is not None:
+        stats = cache.stats()
+        print(f"缓存命中 {stats['hits']} 次，未命中 {stats['misses']} 次，"
+              f"命中率 {stats['hit_rate']:.0%}", file=sys.stderr)
+    if args.metrics:
+        with open(args.metrics, 'w', encoding='utf-8') as f:
+            f.write(engine.metrics.to_json())
+    return 1 if runner.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
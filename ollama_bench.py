@@ -0,0 +1,352 @@
+# Ollama AI Chat Tool 的性能测试：连接本地模拟服务器（ollama_fake_server），测量传输层和界面的关键路径，
+# 结果追加到JSONL文件，可以和之前版本的结果比较
+#
+# 用法：
+#   python ollama_bench.py transport --streams 8 --rounds 5
+#   python ollama_bench.py ui --messages 50 --tokens 400          （界面在offscreen平台上运行）
+#   python ollama_bench.py ui --duration 1800 --compare           （长时间运行，检查内存增长并与上次比较）
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+from typing import List, Dict, Optional, Any, Tuple
+
+from ollama_engine import percentile
+from ollama_fake_server import FAKE_MODELS, FakeServerConfig, FakeOllamaServer
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BENCH_RESULTS_PATH = os.path.join(os.path.expanduser("~"), ".ollama_chat_tool", "bench_results.jsonl")
+REGRESSION_THRESHOLD = 0.10  # 与上次结果相比变差超过该比例时视为性能回退
+LAG_TIMER_INTERVAL = 10  # 测量事件循环延迟的定时器间隔（毫秒）
+SAMPLE_INTERVAL = 5.0  # 界面测试中采样内存和WebEngine往返延迟的间隔（秒）
+
+# 越大越好的指标，其余数值指标都是越小越好
+HIGHER_IS_BETTER = {'tokens_per_second', 'requests_per_second', 'messages_per_second'}
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """样本的p50/p95/最大值（毫秒）"""
+    return {
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'max_ms': max(values, default=0.0) * 1000,
+        'samples': len(values)
+    }
+
+def process_rss() -> int:
+    """当前进程的常驻内存（字节）"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # 只能得到峰值，Linux上单位为KB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def child_usage() -> Tuple[Optional[int], Optional[float]]:
+    """子进程（QtWebEngineProcess）的常驻内存和CPU时间，没有安装psutil时返回None"""
+    if psutil is None:
+        return None, None
+    rss, cpu = 0, 0.0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+            times = child.cpu_times()
+            cpu += times.user + times.system
+        except psutil.Error:
+            continue
+    return rss, cpu
+
+def version_info() -> Dict[str, Any]:
+    """记录在结果中的版本信息，用于区分不同版本的测试结果"""
+    info: Dict[str, Any] = {'python': platform.python_version(), 'platform': platform.platform()}
+    try:
+        info['git'] = subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or 'unknown'
+    except (OSError, subprocess.SubprocessError):
+        info['git'] = 'unknown'
+    return info
+
+def run_transport(server: FakeOllamaServer, args: argparse.Namespace) -> Dict[str, Any]:
+    """不启动界面，通过传输层同时运行多个流式请求，测量吞吐量、首字延迟和数据块间隔"""
+    from ollama_transport import StreamTransport
+
+    transport = StreamTransport(slots_per_model=args.streams)
+    lock = threading.Lock()
+    finished = threading.Event()
+    intervals: List[float] = []
+    ttfts: List[float] = []
+    last_chunk: Dict[int, float] = {}
+    totals = {'tokens': 0, 'completed': 0, 'failed': 0}
+    errors: Dict[str, int] = {}
+    expected = args.streams * args.rounds
+
+    def on_chunk(request_id: int, text: str) -> None:
+        now = time.perf_counter()
+        with lock:
+            if request_id in last_chunk:
+                intervals.append(now - last_chunk[request_id])
+            last_chunk[request_id] = now
+
+    def on_done(request_id: int, result: Any) -> None:
+        with lock:
+            totals['completed'] += 1
+            totals['tokens'] += result.metrics.generated_tokens
+            if result.metrics.ttft is not None:
+                ttfts.append(result.metrics.ttft)
+            if totals['completed'] + totals['failed'] >= expected:
+                finished.set()
+
+    def on_error(request_id: int, error: Exception) -> None:
+        with lock:
+            totals['failed'] += 1
+            errors[type(error).__name__] = errors.get(type(error).__name__, 0) + 1
+            if totals['completed'] + totals['failed'] >= expected:
+                finished.set()
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for round_index in range(args.rounds):
+        for stream in range(args.streams):
+            transport.generate(server.url, args.model, f"benchmark {round_index}-{stream}",
+                               on_chunk, on_done, on_error, messages=[])
+    finished.wait()
+    elapsed = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    transport.close()
+    return {
+        'elapsed_s': elapsed,
+        'requests_per_second': totals['completed'] / elapsed if elapsed else 0.0,
+        'tokens_per_second': totals['tokens'] / elapsed if elapsed else 0.0,
+        'cpu_s': cpu,
+        'cpu_ms_per_1k_tokens': cpu * 1000 / totals['tokens'] * 1000 if totals['tokens'] else 0.0,
+        'ttft': summarize(ttfts),
+        'chunk_interval': summarize(intervals),
+        'completed': totals['completed'],
+        'failed': totals['failed'],
+        'errors': errors
+    }
+
+def run_ui(server: FakeOllamaServer, args: argparse.Namespace) -> Dict[str, Any]:
+    """在offscreen平台上运行ChatWindow，连续发送消息，测量渲染延迟、事件循环延迟、CPU时间和内存增长"""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtCore import Qt, QTimer
+    import OllamaAIChatTool
+    from ollama_store import ConversationStore
+
+    app = QApplication.instance() or OllamaAIChatTool.create_application(sys.argv[:1])
+    window = OllamaAIChatTool.ChatWindow()
+    # 测试的对话写入临时数据库，不影响用户的历史会话
+    workdir = tempfile.mkdtemp(prefix="ollama-bench-")
+    if window.store is not None:
+        window.store.close()
+    window.store = ConversationStore(os.path.join(workdir, "conversations.sqlite3"))
+    window.server_input.setPlainText(server.url)
+    window.current_model = args.model
+    window.show()
+
+    render_latency: List[float] = []
+    loop_lag: List[float] = []
+    webengine_rtt: List[float] = []
+    memory: List[Dict[str, Any]] = []
+    unrendered: Dict[int, float] = {}  # 消息ID -> 最早一个还没有渲染的数据块的到达时间
+    state = {'sent': 0, 'last_tick': time.perf_counter(), 'done': False}
+    start = time.perf_counter()
+
+    def on_chunk(request_id: int, text: str) -> None:
+        # 在ChatWindow的处理函数之后调用，此时消息ID已经分配
+        pending = window.pending.get(request_id)
+        if pending is not None and pending.message_id is not None:
+            unrendered.setdefault(pending.message_id, time.perf_counter())
+
+    def on_rendered(message_id: int, html: str) -> None:
+        arrived = unrendered.pop(message_id, None)
+        if arrived is not None:
+            render_latency.append(time.perf_counter() - arrived)
+
+    def on_lag_tick() -> None:
+        now = time.perf_counter()
+        loop_lag.append(max(0.0, now - state['last_tick'] - LAG_TIMER_INTERVAL / 1000))
+        state['last_tick'] = now
+
+    def sample() -> None:
+        if window.chat_display is not None:
+            sent_at = time.perf_counter()
+            window.chat_display.page().runJavaScript(
+                "document.querySelectorAll('.message').length",
+                lambda result: webengine_rtt.append(time.perf_counter() - sent_at)
+            )
+        child_rss, child_cpu = child_usage()
+        memory.append({'t': time.perf_counter() - start, 'rss': process_rss(),
+                       'webengine_rss': child_rss, 'messages': len(window.chat_history)})
+
+    def drive() -> None:
+        if window.pending or not window._page_ready:
+            return
+        elapsed = time.perf_counter() - start
+        if (args.duration and elapsed >= args.duration) or (not args.duration and state['sent'] >= args.messages):
+            if not state['done']:
+                state['done'] = True
+                sample()
+                # 等待最后的渲染结果和WebEngine往返完成
+                QTimer.singleShot(500, app.quit)
+            return
+        state['sent'] += 1
+        window.input_field.setPlainText(f"benchmark message {state['sent']}")
+        window.send_message()
+
+    window.bridge.response_chunk.connect(on_chunk)
+    window.renderer.rendered.connect(on_rendered)
+    lag_timer = QTimer()
+    lag_timer.setTimerType(Qt.TimerType.PreciseTimer)
+    lag_timer.timeout.connect(on_lag_tick)
+    lag_timer.start(LAG_TIMER_INTERVAL)
+    sample_timer = QTimer()
+    sample_timer.timeout.connect(sample)
+    sample_timer.start(int(args.sample_interval * 1000))
+    drive_timer = QTimer()
+    drive_timer.timeout.connect(drive)
+    drive_timer.start(20)
+
+    sample()
+    cpu_start = time.process_time()
+    _, child_cpu_start = child_usage()
+    app.exec()
+    cpu = time.process_time() - cpu_start
+    _, child_cpu_end = child_usage()
+    elapsed = time.perf_counter() - start
+    window.close()
+
+    first, last = memory[0], memory[-1]
+    result: Dict[str, Any] = {
+        'elapsed_s': elapsed,
+        'messages': state['sent'],
+        'messages_per_second': state['sent'] / elapsed if elapsed else 0.0,
+        'cpu_s': cpu,
+        'render_latency': summarize(render_latency),
+        'event_loop_lag': summarize(loop_lag),
+        'webengine_rtt': summarize(webengine_rtt),
+        'rss_start_mb': first['rss'] / 2 ** 20,
+        'rss_end_mb': last['rss'] / 2 ** 20,
+        'rss_growth_mb': (last['rss'] - first['rss']) / 2 ** 20,
+        'render_cache_hits': window.renderer.hits,
+        'memory_samples': memory
+    }
+    if child_cpu_start is not None:
+        result['webengine_cpu_s'] = child_cpu_end - child_cpu_start
+        result['webengine_rss_growth_mb'] = (last['webengine_rss'] - first['webengine_rss']) / 2 ** 20
+    return result
+
+def flatten(metrics: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """把嵌套的指标展开为 名称.子名称 -> 数值，用于比较"""
+    flat: Dict[str, float] = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = float(value)
+    return flat
+
+def load_previous(path: str, scenario: str, config: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """读取同一场景、相同参数的上一次结果"""
+    previous = None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get('scenario') == scenario and record.get('config') == config:
+                    previous = record
+    except OSError:
+        return None
+    return previous
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any],
+            threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """打印与上次结果的差异，返回变差超过阈值的指标"""
+    before, after = flatten(previous['metrics']), flatten(current['metrics'])
+    regressions: List[str] = []
+    print(f"与 {previous['version'].get('git', 'unknown')} "
+          f"({time.strftime('%Y-%m-%d %H:%M', time.localtime(previous['timestamp']))}) 比较:", file=sys.stderr)
+    for name in sorted(after):
+        if name not in before or name.endswith('samples') or not before[name]:
+            continue
+        change = (after[name] - before[name]) / abs(before[name])
+        worse = -change if name.rsplit('.', 1)[-1] in HIGHER_IS_BETTER else change
+        marker = "  <-- 回退" if worse > threshold else ""
+        if worse > threshold:
+            regressions.append(name)
+        print(f"  {name}: {before[name]:.3f} -> {after[name]:.3f} ({change:+.1%}){marker}", file=sys.stderr)
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Ollama AI Chat Tool 性能测试")
+    parser.add_argument('scenario', choices=['transport', 'ui'])
+    parser.add_argument('--model', default=FAKE_MODELS[0])
+    parser.add_argument('--streams', type=int, default=4, help="transport: 同时进行的请求数")
+    parser.add_argument('--rounds', type=int, default=5, help="transport: 每个并发位置的请求次数")
+    parser.add_argument('--messages', type=int, default=20, help="ui: 发送的消息数")
+    parser.add_argument('--duration', type=float, default=0.0, help="ui: 运行时间（秒），指定时忽略--messages")
+    parser.add_argument('--sample-interval', type=float, default=SAMPLE_INTERVAL, help="ui: 内存采样间隔（秒）")
+    parser.add_argument('--tokens', type=int, default=200, help="每个回答的token数")
+    parser.add_argument('--tokens-per-second', type=float, default=200.0, help="模拟服务器的生成速度，0为不限速")
+    parser.add_argument('--chunk-tokens', type=int, default=1, help="每个数据块包含的token数")
+    parser.add_argument('--latency', type=float, default=0.02, help="首个数据块的延迟（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回HTTP 500的请求比例")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="中途断开连接的请求比例")
+    parser.add_argument('--results', default=BENCH_RESULTS_PATH, help="结果追加写入的JSONL文件")
+    parser.add_argument('--compare', action='store_true', help="与同一场景的上一次结果比较")
+    parser.add_argument('--fail-on-regression', action='store_true', help="有指标回退时返回非零退出码")
+    args = parser.parse_args(argv)
+
+    config = FakeServerConfig(
+        models=[args.model], tokens_per_second=args.tokens_per_second, chunk_tokens=args.chunk_tokens,
+        first_token_latency=args.latency, response_tokens=args.tokens,
+        error_rate=args.error_rate, drop_rate=args.drop_rate, seed=0
+    )
+    server = FakeOllamaServer(config).start()
+    try:
+        metrics = run_transport(server, args) if args.scenario == 'transport' else run_ui(server, args)
+    finally:
+        server.stop()
+
+    record = {
+        'scenario': args.scenario,
+        'timestamp': time.time(),
+        'version': version_info(),
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('results', 'compare', 'fail_on_regression', 'scenario')},
+        'server': server.stats.to_dict(),
+        'metrics': metrics
+    }
+    previous = load_previous(args.results, args.scenario, record['config']) if args.compare else None
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    with open(args.results, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    summary = {key: value for key, value in metrics.items() if key != 'memory_samples'}
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if previous is not None:
+        regressions = compare(record, previous)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+# Ollama AI Chat Tool 的响应缓存：确定性请求（temperature=0或固定seed）的结果保存在SQLite中，
+# 相同的模型、请求内容和参数再次请求时直接回放，不再占用模型生成；
+# 另外按服务器地址缓存模型列表，打开模型对话框时不需要等待服务器
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import List, Dict, Optional, Any, Tuple
+
+RESPONSE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".ollama_chat_tool", "response_cache.sqlite3")
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 缓存文件中回答内容的总大小上限，超出后按最近使用时间淘汰
+DETERMINISTIC_OPTIONS = {'temperature': 0, 'seed': 42}  # 界面中启用"确定性回答"时发送的参数
+MODEL_CATALOGUE_PATH = os.path.join(os.path.expanduser("~"), ".ollama_chat_tool", "model_catalogue.sqlite3")
+MODEL_CATALOGUE_TTL = 60  # 缓存的模型列表在该时间（秒）内视为最新，打开对话框时不再刷新
+
+logger = logging.getLogger(__name__)
+
+def is_deterministic(options: Optional[Dict[str, Any]]) -> bool:
+    """只有temperature为0或指定了seed的请求才会得到可重复的结果"""
+    if not options:
+        return False
+    return options.get('temperature') == 0 or options.get('seed') is not None
+
+def cache_key(digest: str, path: str, payload: Dict[str, Any]) -> str:
+    """由模型digest、接口路径和完整的请求体（含options）计算缓存键"""
+    material = json.dumps({'digest': digest, 'path': path, 'payload': payload},
+                          sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """基于SQLite的回答缓存，按内容寻址，超出大小上限时淘汰最久未使用的条目"""
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL,"
+            " final_chunk TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """读取缓存的回答和最后一个响应块，未命中返回None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, final_chunk FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        return row[0], json.loads(row[1])
+
+    def put(self, key: str, model: str, response: str, final_chunk: Dict[str, Any]) -> None:
+        """写入一条回答，然后按大小上限淘汰旧条目"""
+        final_json = json.dumps(final_chunk, ensure_ascii=False)
+        size = len(response.encode('utf-8')) + len(final_json)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, response, final_json, size, now, now)
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute(
+                "SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self) -> Dict[str, Any]:
+        """命中/未命中次数和当前缓存的条目数、大小"""
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': size
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+class ModelCatalogue:
+    """按服务器地址缓存的模型列表（包含/api/show中的参数量、量化方式和上下文长度）
+
+    先显示缓存的列表再在后台刷新（stale-while-revalidate），刷新结果写回缓存。
+    """
+
+    def __init__(self, path: str = MODEL_CATALOGUE_PATH, ttl: float = MODEL_CATALOGUE_TTL) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS catalogue ("
+            " server_url TEXT PRIMARY KEY, models TEXT NOT NULL, fetched REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, server_url: str) -> Optional[Tuple[List[Dict[str, Any]], float]]:
+        """返回缓存的模型列表和缓存时间，没有缓存时返回None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT models, fetched FROM catalogue WHERE server_url = ?", (server_url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def is_fresh(self, fetched: float) -> bool:
+        return time.time() - fetched < self.ttl
+
+    def put(self, server_url: str, models: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO catalogue VALUES (?, ?, ?)",
+                (server_url, json.dumps(models, ensure_ascii=False), time.time())
+            )
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
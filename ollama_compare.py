@@ -0,0 +1,100 @@
+# Ollama AI Chat Tool 的多模型比较：同一个提示词发送给多个模型，收集各自的回答和统计信息，
+# 结果可以导出为JSON（用于后续分析）或Markdown
+
+import json
+import time
+from typing import List, Dict, Optional, Any
+
+from ollama_engine import GenerationMetrics
+
+class ComparisonAnswer:
+    """比较中一个模型的回答"""
+    __slots__ = ('model', 'request_id', 'chunks', 'metrics', 'error')
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.request_id: Optional[int] = None
+        self.chunks: List[str] = []
+        self.metrics: Optional[GenerationMetrics] = None
+        self.error = ""
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    @property
+    def done(self) -> bool:
+        return self.metrics is not None or bool(self.error)
+
+    def finish(self, text: str, metrics: GenerationMetrics) -> None:
+        self.chunks = [text]
+        self.metrics = metrics
+
+    def to_dict(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {'model': self.model, 'response': self.text}
+        if self.metrics is not None:
+            result['metrics'] = self.metrics.to_dict()
+        if self.error:
+            result['error'] = self.error
+        return result
+
+class ComparisonRun:
+    """一次比较：同一个提示词、系统提示词和参数，按选择的顺序记录每个模型的回答"""
+
+    def __init__(self, prompt: str, models: List[str], system_prompt: str = "",
+                 options: Optional[Dict[str, Any]] = None, sequential: bool = False) -> None:
+        self.prompt = prompt
+        self.system_prompt = system_prompt
+        self.options = options
+        self.sequential = sequential
+        self.started_at = time.time()
+        self.answers: Dict[str, ComparisonAnswer] = {model: ComparisonAnswer(model) for model in models}
+
+    def messages(self) -> List[Dict[str, str]]:
+        """发送给/api/chat的历史消息（只有系统提示词）"""
+        return [{'role': 'system', 'content': self.system_prompt}] if self.system_prompt else []
+
+    def by_request(self, request_id: int) -> Optional[ComparisonAnswer]:
+        for answer in self.answers.values():
+            if answer.request_id == request_id:
+                return answer
+        return None
+
+    @property
+    def done(self) -> bool:
+        return all(answer.done for answer in self.answers.values())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'prompt': self.prompt,
+            'system': self.system_prompt,
+            'options': self.options,
+            'sequential': self.sequential,
+            'started_at': self.started_at,
+            'answers': [answer.to_dict() for answer in self.answers.values()]
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+
+    def to_markdown(self) -> str:
+        """统计表格加上每个模型的完整回答"""
+        lines = ["# 模型比较", "",
+                 f"时间: {time.strftime('%Y-%m-%d %H:%M', time.localtime(self.started_at))}", ""]
+        if self.system_prompt:
+            lines += ["**系统提示词:**", "", self.system_prompt, ""]
+        lines += ["**提示词:**", "", self.prompt, "",
+                  "| 模型 | 首字延迟 | tokens/秒 | 生成时间 | tokens | 状态 |",
+                  "| --- | --- | --- | --- | --- | --- |"]
+        for answer in self.answers.values():
+            metrics = answer.metrics
+            if metrics is None:
+                lines.append(f"| {answer.model} | - | - | - | - | {answer.error or '未完成'} |")
+                continue
+            ttft = f"{metrics.ttft:.2f}秒" if metrics.ttft is not None else "-"
+            status = "已停止" if metrics.truncated else "完成"
+            lines.append(f"| {answer.model} | {ttft} | {metrics.tokens_per_second:.1f} | "
+                         f"{metrics.total_time:.2f}秒 | {metrics.generated_tokens} | {status} |")
+        for answer in self.answers.values():
+            lines += ["", f"## {answer.model}", "", answer.text or answer.error]
+        return "\n".join(lines) + "\n"
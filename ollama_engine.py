@@ -0,0 +1,1043 @@
+# Ollama AI Chat Tool 的核心逻辑，不依赖Qt，可以在没有图形界面的环境中使用
+# 包含：HTTP客户端、流式生成、对话上下文管理和性能统计
+
+import re
+import time
+import json
+import math
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Any, Tuple, Callable, Set, TYPE_CHECKING
+from ollama_cache import ResponseCache, is_deterministic, cache_key
+
+if TYPE_CHECKING:
+    # requests在第一次创建客户端时才导入，图形界面启动时不需要
+    import requests
+
+# 常量定义
+DEFAULT_SERVER_URL = "http://localhost:11434"
+CHUNK_FLUSH_INTERVAL = 1 / 30  # 流式数据块合并后发送到界面的最小间隔（秒），约30Hz
+CHUNK_FLUSH_CHARS = 256  # 缓冲字符数达到该值时立即发送
+CONNECT_TIMEOUT = 5  # 连接超时（秒）
+READ_TIMEOUT = 300  # 读取超时（秒），需覆盖大模型首次加载时间
+HTTP_POOL_SIZE = 8  # 每个服务器的连接池大小
+HEALTH_CHECK_TTL = 30  # 端点可用状态、模型列表和/api/ps结果的缓存时间（秒）
+ENDPOINT_RETRY_DELAY = 10  # 端点连接失败后，多久之后再尝试使用（秒）
+TTFT_EWMA_ALPHA = 0.3  # 端点首字延迟的指数滑动平均系数
+CHAT_MODE_CHAT = "chat"  # 多轮对话：/api/chat 发送结构化消息
+CHAT_MODE_GENERATE = "generate"  # 多轮对话：/api/generate 携带上一轮返回的context
+CONTEXT_TOKEN_BUDGET = 3072  # 发送给模型的对话历史token预算（需小于num_ctx，给回答留出空间）
+CONTEXT_LOW_WATERMARK = 0.6  # 超出预算时一次性裁剪到预算的该比例，减少提示前缀的变化次数
+METRICS_WINDOW = 100  # 每个模型保留最近多少次生成的统计数据
+DEFAULT_KEEP_ALIVE = "30m"  # 模型在最后一次请求后保持加载的时间，每个请求都会携带（否则服务器按默认的5分钟重置）
+
+logger = logging.getLogger(__name__)
+
+class OllamaError(Exception):
+    """与Ollama服务通信时的错误"""
+
+class OllamaResponseError(OllamaError):
+    """服务器返回了错误状态码，消息中已包含给用户看的详细信息"""
+    
+    def __init__(self, message: str, status_code: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+class GenerationCancelled(OllamaError):
+    """请求在发送到服务器之前被取消"""
+
+class EndpointConnectError(ConnectionError):
+    """异步传输层无法建立到端点的连接（连接被拒绝、连接超时或地址无法解析）"""
+
+class OllamaClient:
+    """Ollama HTTP客户端，每个服务器地址共享一个带连接池和超时设置的会话"""
+    
+    _clients: Dict[str, "OllamaClient"] = {}
+    _clients_lock = threading.Lock()
+    
+    def __init__(self, server_url: str) -> None:
+        self.server_url = server_url.rstrip('/')
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+    @classmethod
+    def for_server(cls, server_url: str) -> "OllamaClient":
+        """获取指定服务器地址的共享客户端"""
+        key = server_url.rstrip('/')
+        with cls._clients_lock:
+            client = cls._clients.get(key)
+            if client is None:
+                client = cls(key)
+                cls._clients[key] = client
+            return client
+            
+    def request(self, method: str, path: str, **kwargs: Any) -> "requests.Response":
+        """发送请求，未指定时使用默认的连接/读取超时"""
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, f'{self.server_url}{path}', **kwargs)
+        
+    def get(self, path: str, **kwargs: Any) -> "requests.Response":
+        return self.request('GET', path, **kwargs)
+        
+    def post(self, path: str, **kwargs: Any) -> "requests.Response":
+        return self.request('POST', path, **kwargs)
+        
+    def list_models(self, timeout: Any = None) -> List[Dict[str, Any]]:
+        """获取已安装的模型列表"""
+        response = self.get('/api/tags', timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json().get("models", [])
+        
+    def list_running(self) -> List[Dict[str, Any]]:
+        """获取已加载到内存中的模型（/api/ps），旧版本服务器不支持时返回空列表"""
+        response = self.get('/api/ps', timeout=CONNECT_TIMEOUT)
+        if response.status_code != 200:
+            return []
+        return response.json().get("models", [])
+
+def failover_errors() -> Tuple[type, ...]:
+    """连接失败或流在开始输出前中断时，可以换一个端点重试"""
+    import requests
+    return (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError)
+
+def is_connect_error(error: BaseException) -> bool:
+    """是否为无法建立连接的错误（只有这种错误才把端点标记为不可用）；连接建立后
+    发送请求、等待响应头（例如模型加载较慢）或读取响应时出错，说明服务器本身是可达的"""
+    if isinstance(error, EndpointConnectError):
+        return True
+    import requests
+    from urllib3.exceptions import ConnectTimeoutError
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if (not isinstance(error, requests.exceptions.ConnectionError)
+            or isinstance(error, requests.exceptions.ChunkedEncodingError)):
+        return False
+    # 连接被拒绝、地址无法解析时urllib3的原因是NewConnectionError（ConnectTimeoutError的子类），
+    # 等待响应时连接被关闭则是ProtocolError
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    return isinstance(reason, ConnectTimeoutError)
+
+def parse_server_urls(text: str) -> List[str]:
+    """解析服务器地址，多个地址用逗号、分号或空白分隔"""
+    urls: List[str] = []
+    for url in re.split(r'[\s,;]+', text or ''):
+        url = url.strip().rstrip('/')
+        if url and url not in urls:
+            urls.append(url)
+    return urls or [DEFAULT_SERVER_URL]
+
+class Endpoint:
+    """端点池中的一个Ollama服务器，记录已安装/已加载的模型和负载情况"""
+    
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.client = OllamaClient.for_server(url)
+        self.models: Dict[str, Dict[str, Any]] = {}
+        self.resident: Set[str] = set()
+        self.outstanding = 0
+        self.ttft: Optional[float] = None
+        self.refreshed_at = 0.0
+        self.down_until = 0.0
+        
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+        
+    @property
+    def stale(self) -> bool:
+        return time.monotonic() - self.refreshed_at >= HEALTH_CHECK_TTL
+        
+    def refresh(self) -> None:
+        """通过/api/tags和/api/ps更新模型列表，同时作为健康检查"""
+        import requests
+        try:
+            models = self.client.list_models(timeout=(CONNECT_TIMEOUT, CONNECT_TIMEOUT))
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"端点 {self.url} 不可用: {str(e)}")
+            self.mark_down()
+            return
+        self.models = {model['name']: model for model in models}
+        try:
+            self.resident = {model.get('name') or model.get('model', '')
+                             for model in self.client.list_running()}
+        except requests.exceptions.RequestException:
+            pass
+        self.refreshed_at = time.monotonic()
+        self.down_until = 0.0
+        
+    def mark_down(self) -> None:
+        self.down_until = time.monotonic() + ENDPOINT_RETRY_DELAY
+        self.refreshed_at = 0.0
+        
+    def has_model(self, model: str) -> bool:
+        return model in self.models or (':' not in model and f"{model}:latest" in self.models)
+        
+    def is_resident(self, model: str) -> bool:
+        return model in self.resident or (':' not in model and f"{model}:latest" in self.resident)
+        
+    def score(self, model: str) -> Tuple[int, int, float]:
+        """排序依据：模型已加载优先，其次是进行中的请求数，最后是最近的首字延迟"""
+        return (0 if self.is_resident(model) else 1, self.outstanding, self.ttft or 0.0)
+
+class EndpointPool:
+    """多个Ollama服务器组成的端点池，按负载选择端点，连接失败时切换到其他端点"""
+    
+    _pools: Dict[Tuple[str, ...], "EndpointPool"] = {}
+    _pools_lock = threading.Lock()
+    
+    def __init__(self, urls: List[str]) -> None:
+        self.endpoints = [Endpoint(url) for url in urls]
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        
+    @classmethod
+    def for_servers(cls, server_url: str) -> "EndpointPool":
+        """获取服务器地址（可以是多个）对应的共享端点池"""
+        key = tuple(parse_server_urls(server_url))
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls(list(key))
+                cls._pools[key] = pool
+            return pool
+            
+    def refresh(self, force: bool = False) -> None:
+        """刷新过期端点的状态，多个端点并行刷新"""
+        with self._refresh_lock:
+            targets = [endpoint for endpoint in self.endpoints
+                       if force or (endpoint.stale and endpoint.available)]
+            if len(targets) == 1:
+                targets[0].refresh()
+            elif targets:
+                with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+                    list(executor.map(Endpoint.refresh, targets))
+                    
+    def choose(self, model: str, exclude: Optional[List[Endpoint]] = None) -> Endpoint:
+        """选择负载最低、并且最好已加载该模型的端点，并计入进行中的请求
+        
+        所有端点都被标记为不可用时，仍然尝试最早失败的那个端点，不直接报错；
+        只有本次请求已经尝试过所有端点时才抛出错误。
+        """
+        self.refresh()
+        remaining = [endpoint for endpoint in self.endpoints if endpoint not in (exclude or [])]
+        if not remaining:
+            raise OllamaError("无法连接到Ollama服务，请确保已启动ollama serve命令")
+        candidates = [endpoint for endpoint in remaining if endpoint.available and endpoint.refreshed_at]
+        if candidates:
+            # 没有端点安装该模型时仍然发送，由服务器返回具体的错误信息
+            candidates = [endpoint for endpoint in candidates if endpoint.has_model(model)] or candidates
+        else:
+            candidates = [min(remaining, key=lambda candidate: candidate.down_until)]
+        with self._lock:
+            endpoint = min(candidates, key=lambda candidate: candidate.score(model))
+            endpoint.outstanding += 1
+        return endpoint
+        
+    def choose_after(self, model: str, tried: List[Endpoint],
+                     error: Optional[BaseException]) -> Endpoint:
+        """故障切换时选择下一个端点；所有端点都已尝试过时，如果最后一次是连接后出错
+        （error不为None），抛出这个原始错误，而不是“无法连接”"""
+        try:
+            return self.choose(model, exclude=tried)
+        except OllamaError:
+            if error is None:
+                raise
+            raise error
+        
+    def release(self, endpoint: Endpoint, model: str = "", ttft: Optional[float] = None,
+                failed: bool = False) -> None:
+        """请求结束后更新端点的负载、首字延迟和已加载模型；failed表示无法连接到端点，
+        该端点在一段时间内不再优先使用"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if ttft is not None:
+                endpoint.ttft = ttft if endpoint.ttft is None else (
+                    TTFT_EWMA_ALPHA * ttft + (1 - TTFT_EWMA_ALPHA) * endpoint.ttft
+                )
+            if model and not failed:
+                endpoint.resident.add(model)
+        if failed:
+            endpoint.mark_down()
+            
+    def list_models(self) -> List[Dict[str, Any]]:
+        """合并所有端点的模型列表，每个模型附带所在的端点地址"""
+        self.refresh(force=True)
+        if not any(endpoint.refreshed_at for endpoint in self.endpoints):
+            raise OllamaError("无法连接到Ollama服务，请确保已启动ollama serve命令")
+        merged: Dict[str, Dict[str, Any]] = {}
+        for endpoint in self.endpoints:
+            for name, model in endpoint.models.items():
+                entry = merged.setdefault(name, dict(model, endpoints=[]))
+                entry['endpoints'].append(endpoint.url)
+        return list(merged.values())
+        
+    def model_digest(self, model: str) -> str:
+        """返回模型的digest，用于区分同名但内容不同的模型；未知时返回空字符串"""
+        self.refresh()
+        for endpoint in self.endpoints:
+            for name in (model, f"{model}:latest"):
+                if name in endpoint.models:
+                    return endpoint.models[name].get('digest', '')
+        return ''
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中日韩字符按1个token计算，其他字符约4个字符1个token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if ch >= '\u2e80')
+    return cjk + (len(text) - cjk + 3) // 4 + 4
+
+class ContextManager:
+    """对话上下文管理：按token预算维护滑动窗口，被移出窗口的旧消息交给后台摘要
+    
+    系统提示词固定在最前面，不会被移出窗口。窗口起点只在超出预算时一次性
+    向后移动到低水位，其余时间保持不变，使提示前缀稳定以便复用KV缓存。
+    """
+    
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET,
+                 low_watermark: float = CONTEXT_LOW_WATERMARK) -> None:
+        self.budget = budget
+        self.low_watermark = low_watermark
+        self.system_prompt = ""
+        self.summary = ""
+        self.messages: List[Dict[str, str]] = []
+        self._token_counts: List[int] = []
+        self._window_tokens = 0
+        self.window_start = 0
+        self.summarized_upto = 0
+        
+    def set_system_prompt(self, prompt: str) -> None:
+        self.system_prompt = prompt.strip()
+        
+    def add(self, role: str, content: str) -> None:
+        """追加一条消息并增量更新token计数"""
+        tokens = estimate_tokens(content)
+        self.messages.append({'role': role, 'content': content})
+        self._token_counts.append(tokens)
+        self._window_tokens += tokens
+        self._trim()
+        
+    def _fixed_tokens(self) -> int:
+        """固定部分（系统提示词和摘要）占用的token数"""
+        return estimate_tokens(self.system_prompt) + estimate_tokens(self.summary)
+        
+    def _trim(self) -> None:
+        """超出预算时将窗口起点后移到低水位，每次移动一整轮（用户+助手）"""
+        available = self.budget - self._fixed_tokens()
+        if self._window_tokens <= available:
+            return
+        target = available * self.low_watermark
+        while self.window_start < len(self.messages) - 1 and self._window_tokens > target:
+            self._window_tokens -= self._token_counts[self.window_start]
+            self.window_start += 1
+        # 窗口从用户消息开始，避免出现没有问题的回答
+        while (self.window_start < len(self.messages) - 1 and
+               self.messages[self.window_start]['role'] != 'user'):
+            self._window_tokens -= self._token_counts[self.window_start]
+            self.window_start += 1
+            
+    @property
+    def window_tokens(self) -> int:
+        return self._fixed_tokens() + self._window_tokens
+        
+    def build_messages(self) -> List[Dict[str, str]]:
+        """构建发送给/api/chat的消息列表"""
+        messages = []
+        system_parts = [part for part in (
+            self.system_prompt,
+            f"以下是之前对话的摘要：\n{self.summary}" if self.summary else ""
+        ) if part]
+        if system_parts:
+            messages.append({'role': 'system', 'content': "\n\n".join(system_parts)})
+        messages.extend(self.messages[self.window_start:])
+        return messages
+        
+    def pending_summary(self) -> List[Dict[str, str]]:
+        """已移出窗口但尚未被摘要的消息"""
+        return self.messages[self.summarized_upto:self.window_start]
+        
+    def apply_summary(self, summary: str, upto: int) -> None:
+        """写入后台生成的摘要，upto为摘要覆盖到的消息位置"""
+        if upto > len(self.messages):
+            # 摘要生成期间对话已被清空
+            return
+        self.summary = summary.strip()
+        self.summarized_upto = max(self.summarized_upto, upto)
+        self._trim()
+        
+    def clear(self) -> None:
+        self.summary = ""
+        self.messages.clear()
+        self._token_counts.clear()
+        self._window_tokens = 0
+        self.window_start = 0
+        self.summarized_upto = 0
+
+def percentile(values: List[float], pct: float) -> float:
+    """计算百分位数（最近秩法），空列表返回0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+class GenerationMetrics:
+    """单次生成的性能统计：客户端测得的首字延迟和数据块间隔，以及Ollama返回的耗时明细"""
+    
+    # Ollama在最后一个响应块中返回的统计字段，耗时单位为纳秒
+    SERVER_FIELDS = ('total_duration', 'load_duration', 'prompt_eval_count',
+                     'prompt_eval_duration', 'eval_count', 'eval_duration')
+    
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._last_chunk: Optional[float] = None
+        self.ttft: Optional[float] = None
+        self.total_time = 0.0
+        self.chunk_count = 0
+        self.chunk_intervals: List[float] = []
+        self.queue_wait = 0.0  # 在调度队列中等待的时间（秒），不计入首字延迟
+        self.server: Dict[str, int] = {}
+        self.cached = False
+        self.truncated = False
+        self.saved_tokens = 0  # 停止生成时估算的未生成token数
+        self.saved_seconds = 0.0  # 按该模型的解码速度估算节省的生成时间
+        
+    def record_chunk(self) -> None:
+        """记录收到一个文本块的时间"""
+        now = time.perf_counter()
+        if self._last_chunk is None:
+            self.ttft = now - self._start
+        else:
+            self.chunk_intervals.append(now - self._last_chunk)
+        self._last_chunk = now
+        self.chunk_count += 1
+        
+    def finish(self, final_chunk: Optional[Dict[str, Any]] = None) -> None:
+        """记录结束时间和服务器返回的统计字段"""
+        self.total_time = time.perf_counter() - self._start
+        if final_chunk:
+            self.server = {key: final_chunk[key] for key in self.SERVER_FIELDS if key in final_chunk}
+            
+    def cancel(self) -> None:
+        """生成被停止，只有客户端测得的数据可用，每个数据块约等于一个token"""
+        self.finish()
+        self.truncated = True
+        
+    @property
+    def generated_tokens(self) -> int:
+        return self.server.get('eval_count', self.chunk_count)
+            
+    def _seconds(self, key: str) -> float:
+        return self.server.get(key, 0) / 1e9
+        
+    @property
+    def tokens_per_second(self) -> float:
+        """解码速度（eval_count / eval_duration）"""
+        duration = self._seconds('eval_duration')
+        return self.server.get('eval_count', 0) / duration if duration else 0.0
+        
+    @property
+    def prompt_tokens_per_second(self) -> float:
+        """提示词处理速度（prompt_eval_count / prompt_eval_duration）"""
+        duration = self._seconds('prompt_eval_duration')
+        return self.server.get('prompt_eval_count', 0) / duration if duration else 0.0
+        
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'model': self.model,
+            'cached': self.cached,
+            'truncated': self.truncated,
+            'started_at': self.started_at,
+            'queue_wait': self.queue_wait,
+            'ttft': self.ttft,
+            'total_time': self.total_time,
+            'chunk_count': self.chunk_count,
+            'chunk_interval_p50': percentile(self.chunk_intervals, 50),
+            'chunk_interval_p95': percentile(self.chunk_intervals, 95),
+            'chunk_interval_p99': percentile(self.chunk_intervals, 99),
+            'load_duration': self._seconds('load_duration'),
+            'prompt_eval_count': self.server.get('prompt_eval_count', 0),
+            'prompt_eval_duration': self._seconds('prompt_eval_duration'),
+            'eval_count': self.server.get('eval_count', 0),
+            'eval_duration': self._seconds('eval_duration'),
+            'tokens_per_second': self.tokens_per_second,
+            'prompt_tokens_per_second': self.prompt_tokens_per_second,
+            'saved_tokens': self.saved_tokens,
+            'saved_seconds': self.saved_seconds,
+        }
+        
+    def format_summary(self) -> str:
+        """生成显示在消息下方的统计信息"""
+        if self.cached:
+            return f"来自缓存 · 回放时间: {self.total_time:.2f}秒"
+        if self.truncated:
+            parts = [f"已停止 · 生成时间: {self.total_time:.2f}秒", f"已生成约 {self.chunk_count} tokens"]
+            if self.saved_tokens:
+                parts.append(f"约节省 {self.saved_tokens} tokens ({self.saved_seconds:.1f}秒)")
+            return " · ".join(parts)
+        parts = [f"生成时间: {self.total_time:.2f}秒"]
+        if self.queue_wait >= 0.05:
+            parts.append(f"排队: {self.queue_wait:.2f}秒")
+        if self.ttft is not None:
+            parts.append(f"首字延迟: {self.ttft:.2f}秒")
+        if self.server.get('eval_count'):
+            parts.append(f"{self.server['eval_count']} tokens, {self.tokens_per_second:.1f} tokens/秒")
+        if 'prompt_eval_count' in self.server:
+            parts.append(f"提示词处理: {self.server['prompt_eval_count']} tokens "
+                         f"({self._seconds('prompt_eval_duration'):.2f}秒)")
+        if self._seconds('load_duration') >= 0.01:
+            parts.append(f"模型加载: {self._seconds('load_duration'):.2f}秒")
+        if self.chunk_intervals:
+            parts.append(f"块间隔 p50/p95: {percentile(self.chunk_intervals, 50) * 1000:.0f}/"
+                         f"{percentile(self.chunk_intervals, 95) * 1000:.0f}毫秒")
+        return " · ".join(parts)
+
+class MetricsAggregator:
+    """按模型汇总最近若干次生成的统计数据，可导出为JSON或Prometheus文本格式"""
+    
+    # 汇总时计算平均值和百分位数的字段
+    FIELDS = ('queue_wait', 'ttft', 'total_time', 'load_duration', 'prompt_eval_duration',
+              'eval_duration', 'tokens_per_second', 'prompt_tokens_per_second')
+    
+    def __init__(self, window: int = METRICS_WINDOW) -> None:
+        self.window = window
+        self._records: Dict[str, deque] = {}
+        self._totals: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        
+    def record(self, metrics: GenerationMetrics,
+               options: Optional[Dict[str, Any]] = None) -> None:
+        """记录一次生成；被停止的生成不计入性能窗口，只估算并累计节省的计算量"""
+        if metrics.cached:
+            # 缓存回放没有实际生成，不计入模型的性能统计
+            return
+        with self._lock:
+            records = self._records.setdefault(metrics.model, deque(maxlen=self.window))
+            totals = self._totals.setdefault(metrics.model, {
+                'requests': 0, 'prompt_eval_count': 0, 'eval_count': 0,
+                'cancelled': 0, 'saved_tokens': 0, 'saved_seconds': 0.0
+            })
+            totals['requests'] += 1
+            if metrics.truncated:
+                self._estimate_savings(metrics, records, options)
+                totals['cancelled'] += 1
+                totals['eval_count'] += metrics.generated_tokens
+                totals['saved_tokens'] += metrics.saved_tokens
+                totals['saved_seconds'] += metrics.saved_seconds
+                return
+            data = metrics.to_dict()
+            records.append(data)
+            totals['prompt_eval_count'] += data['prompt_eval_count']
+            totals['eval_count'] += data['eval_count']
+            
+    @staticmethod
+    def _estimate_savings(metrics: GenerationMetrics, records: deque,
+                          options: Optional[Dict[str, Any]]) -> None:
+        """按该模型最近完整回答的平均长度估算停止生成少生成的token数（不超过num_predict）"""
+        lengths = [r['eval_count'] for r in records if r['eval_count']]
+        expected = sum(lengths) / len(lengths) if lengths else 0
+        num_predict = (options or {}).get('num_predict') or 0
+        if num_predict > 0:
+            expected = min(expected, num_predict) if expected else num_predict
+        metrics.saved_tokens = max(0, int(expected) - metrics.generated_tokens)
+        speeds = [r['tokens_per_second'] for r in records if r['tokens_per_second']]
+        if speeds:
+            metrics.saved_seconds = metrics.saved_tokens / (sum(speeds) / len(speeds))
+            
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """返回每个模型的汇总数据"""
+        result: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            for model, records in self._records.items():
+                summary: Dict[str, Any] = dict(self._totals[model])
+                summary['window'] = len(records)
+                for field in self.FIELDS:
+                    values = [r[field] for r in records if r[field] is not None]
+                    summary[f'{field}_avg'] = sum(values) / len(values) if values else 0.0
+                    summary[f'{field}_p50'] = percentile(values, 50)
+                    summary[f'{field}_p95'] = percentile(values, 95)
+                result[model] = summary
+        return result
+        
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        
+    def to_prometheus(self) -> str:
+        """导出为Prometheus文本格式"""
+        lines: List[str] = []
+        snapshot = self.snapshot()
+        counters = ('requests', 'prompt_eval_count', 'eval_count',
+                    'cancelled', 'saved_tokens', 'saved_seconds')
+        for name in counters:
+            lines.append(f"# TYPE ollama_chat_{name}_total counter")
+            for model, summary in snapshot.items():
+                lines.append(f'ollama_chat_{name}_total{{model="{model}"}} {summary[name]}')
+        for field in self.FIELDS:
+            for stat in ('avg', 'p50', 'p95'):
+                name = f"ollama_chat_{field}_{stat}"
+                lines.append(f"# TYPE {name} gauge")
+                for model, summary in snapshot.items():
+                    lines.append(f'{name}{{model="{model}"}} {summary[f"{field}_{stat}"]:.6f}')
+        return "\n".join(lines) + "\n"
+
+class ChunkCoalescer:
+    """将流式响应的小数据块合并，按固定频率或字符数批量发送"""
+    
+    def __init__(self, flush_interval: float = CHUNK_FLUSH_INTERVAL,
+                 flush_chars: int = CHUNK_FLUSH_CHARS) -> None:
+        self.flush_interval = flush_interval
+        self.flush_chars = flush_chars
+        self.received_chunks = 0
+        self.emitted_chunks = 0
+        self._buffer: List[str] = []
+        self._buffered_chars = 0
+        self._last_flush = 0.0
+        
+    @property
+    def merged_chunks(self) -> int:
+        """被合并掉（没有单独发送）的数据块数量"""
+        return self.received_chunks - self.emitted_chunks
+        
+    def add(self, text: str, now: Optional[float] = None) -> Optional[str]:
+        """加入一个数据块，到达发送条件时返回合并后的文本"""
+        self.received_chunks += 1
+        self._buffer.append(text)
+        self._buffered_chars += len(text)
+        now = time.monotonic() if now is None else now
+        if (now - self._last_flush >= self.flush_interval or
+                self._buffered_chars >= self.flush_chars):
+            self._last_flush = now
+            return self.flush()
+        return None
+        
+    def flush(self) -> Optional[str]:
+        """立即取出缓冲区中的全部文本"""
+        if not self._buffer:
+            return None
+        text = "".join(self._buffer)
+        self._buffer.clear()
+        self._buffered_chars = 0
+        self.emitted_chunks += 1
+        return text
+
+def build_request(model: str, prompt: Optional[str],
+                  messages: Optional[List[Dict[str, Any]]] = None,
+                  context: Optional[List[int]] = None,
+                  options: Optional[Dict[str, Any]] = None,
+                  keep_alive: Optional[str] = None,
+                  extra: Optional[Dict[str, Any]] = None) -> Tuple[str, Dict[str, Any]]:
+    """构建请求路径和请求体
+    
+    提供messages时使用/api/chat发送完整的结构化对话，历史消息只追加不修改，
+    保证每轮的提示前缀与上一轮一致，Ollama可以复用KV缓存只处理新的一轮；
+    否则使用/api/generate，并携带上一轮返回的context。
+    prompt为None时messages已经包含最后一条用户消息（网关转发的请求）；
+    extra中的其他字段（format、images、system等）原样加入请求体。
+    """
+    if messages is not None:
+        path = '/api/chat'
+        payload: Dict[str, Any] = {
+            'model': model,
+            'messages': messages + ([{'role': 'user', 'content': prompt}] if prompt is not None else []),
+            'stream': True
+        }
+    else:
+        path = '/api/generate'
+        payload = {
+            'model': model,
+            'prompt': prompt,
+            'stream': True
+        }
+        if context:
+            payload['context'] = context
+    if options:
+        payload['options'] = options
+    if keep_alive is not None:
+        payload['keep_alive'] = keep_alive
+    for key, value in (extra or {}).items():
+        payload.setdefault(key, value)
+    return path, payload
+
+def build_complete_request(model: str, prompt: str,
+                           keep_alive: Optional[str] = None,
+                           options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """非流式/api/generate的请求体；prompt为空时Ollama只加载模型，用于预热
+    
+    预热也需要携带num_ctx等参数，否则Ollama会在第一个请求时按新参数重新加载模型。
+    """
+    payload: Dict[str, Any] = {'model': model, 'stream': False}
+    if prompt:
+        payload['prompt'] = prompt
+    if options:
+        payload['options'] = options
+    if keep_alive is not None:
+        payload['keep_alive'] = keep_alive
+    return payload
+
+def extract_text(response_data: Dict[str, Any]) -> str:
+    """从/api/generate或/api/chat的响应块中取出文本"""
+    if 'message' in response_data:
+        return response_data['message'].get('content', '')
+    return response_data.get('response', '')
+
+def describe_error_response(response: Any, model: str) -> str:
+    """把服务器的错误响应（requests.Response或AsyncResponse）转换为给用户看的说明"""
+    error_msg = f"错误：服务器返回状态码 {response.status_code}"
+    try:
+        error_detail = response.json().get('error', '未知错误')
+        error_msg += f"\n详细信息：{error_detail}"
+        
+        if "model not found" in error_detail.lower():
+            error_msg += f"\n\n请使用 'ollama pull {model}' 命令来安装此模型"
+    except Exception:
+        pass
+    return error_msg
+
+def model_context_length(show: Dict[str, Any]) -> Optional[int]:
+    """从/api/show的model_info中读取模型训练时的上下文长度，没有该信息时返回None"""
+    info = show.get('model_info') or {}
+    architecture = info.get('general.architecture')
+    if architecture and f"{architecture}.context_length" in info:
+        return info[f"{architecture}.context_length"]
+    for key, value in info.items():
+        if key.endswith('.context_length'):
+            return value
+    return None
+
+class StreamAccumulator:
+    """把流式响应逐行累积为完整回答，同步和异步的读取方式共用"""
+    
+    def __init__(self, metrics: GenerationMetrics, coalescer: ChunkCoalescer,
+                 on_chunk: Optional[Callable[[str], None]],
+                 on_data: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        self.metrics = metrics
+        self.coalescer = coalescer
+        self.on_chunk = on_chunk
+        self.on_data = on_data  # 收到每个原始响应块（包括最后一块）时调用，用于原样转发
+        self.forwarded = 0  # 已经交给on_data的响应块数
+        self.pieces: List[str] = []
+        self.final_chunk: Optional[Dict[str, Any]] = None
+        
+    def _emit(self, text: Optional[str]) -> None:
+        if text and self.on_chunk is not None:
+            self.on_chunk(text)
+            
+    def feed(self, line: bytes) -> bool:
+        """处理一行响应，流结束时返回True"""
+        if not line:
+            return False
+        try:
+            chunk = line.decode('utf-8')
+            if chunk.startswith('data: '):
+                chunk = chunk[6:]
+            if chunk == '[DONE]':
+                return True
+                
+            response_data = json.loads(chunk)
+            if self.on_data is not None:
+                self.forwarded += 1
+                self.on_data(response_data)
+            chunk_text = extract_text(response_data)
+            if chunk_text:
+                self.metrics.record_chunk()
+                self.pieces.append(chunk_text)
+                self._emit(self.coalescer.add(chunk_text))
+            if response_data.get('done'):
+                # 最后一块包含统计信息和/api/generate的context
+                self.final_chunk = response_data
+                return True
+        except Exception as e:
+            logger.error(f"处理响应块时出错: {str(e)}")
+        return False
+        
+    def finish(self) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """结束时立即发送缓冲区中剩余的文本，返回完整回答和最后一个响应块"""
+        self._emit(self.coalescer.flush())
+        return "".join(self.pieces), self.final_chunk
+
+class GenerationResult:
+    """一次生成的结果"""
+    
+    def __init__(self, text: str, metrics: GenerationMetrics,
+                 final_chunk: Optional[Dict[str, Any]], coalescer: ChunkCoalescer) -> None:
+        self.text = text
+        self.metrics = metrics
+        self.final_chunk = final_chunk or {}
+        self.coalescer = coalescer
+        self.sources: List[Dict[str, Any]] = []  # 注入到提示词中的文档片段
+
+class ChatEngine:
+    """流式生成的核心逻辑，Qt界面和批处理模式共用"""
+    
+    def __init__(self, server_url: str = DEFAULT_SERVER_URL,
+                 metrics: Optional[MetricsAggregator] = None,
+                 cache: Optional[ResponseCache] = None) -> None:
+        self.server_url = server_url
+        self.pool = EndpointPool.for_servers(server_url)
+        self.metrics = metrics
+        self.cache = cache
+        
+    def generate(self, model: str, prompt: str,
+                 messages: Optional[List[Dict[str, str]]] = None,
+                 context: Optional[List[int]] = None,
+                 options: Optional[Dict[str, Any]] = None,
+                 on_chunk: Optional[Callable[[str], None]] = None,
+                 flush_interval: float = CHUNK_FLUSH_INTERVAL,
+                 flush_chars: int = CHUNK_FLUSH_CHARS,
+                 keep_alive: Optional[str] = None) -> GenerationResult:
+        """发送生成请求并读取流式响应，合并后的文本块通过on_chunk回调输出
+        
+        连接失败或流在输出任何内容之前中断时，自动切换到端点池中的其他端点。
+        启用缓存且请求是确定性的时候，先查找缓存，命中则直接回放。
+        """
+        path, payload = build_request(model, prompt, messages, context, options, keep_alive)
+        key = self._cache_key(model, path, payload)
+        cached = self._cached_result(key, model, on_chunk, flush_interval, flush_chars)
+        if cached is not None:
+            return cached
+            
+        tried: List[Endpoint] = []
+        last_error: Optional[BaseException] = None
+        while True:
+            endpoint = self.pool.choose_after(model, tried, last_error)
+            metrics = GenerationMetrics(model)
+            coalescer = ChunkCoalescer(flush_interval, flush_chars)
+            try:
+                response = endpoint.client.post(path, json=payload, stream=True)
+                with response:
+                    if response.status_code != 200:
+                        raise OllamaResponseError(describe_error_response(response, model), response.status_code)
+                    text, final_chunk = self._read_stream(response, metrics, coalescer, on_chunk)
+            except failover_errors() as e:
+                # 只有连接失败才标记端点不可用，流中途断开时服务器仍然是可达的
+                connect_error = is_connect_error(e)
+                self.pool.release(endpoint, failed=connect_error)
+                if metrics.chunk_count:
+                    # 已经输出了部分内容，无法透明地切换端点
+                    raise
+                logger.warning(f"端点 {endpoint.url} 请求失败，尝试其他端点: {str(e)}")
+                tried.append(endpoint)
+                last_error = None if connect_error else e
+                continue
+            except Exception:
+                self.pool.release(endpoint)
+                raise
+            self.pool.release(endpoint, model, metrics.ttft)
+            return self._finish(key, model, text, final_chunk, metrics, coalescer)
+            
+    def _cached_result(self, key: Optional[str], model: str,
+                       on_chunk: Optional[Callable[[str], None]],
+                       flush_interval: float, flush_chars: int) -> Optional[GenerationResult]:
+        """缓存命中时回放缓存的回答，未命中返回None"""
+        if not key:
+            return None
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+        return self._replay(model, cached[0], cached[1], on_chunk, flush_interval, flush_chars)
+        
+    def _finish(self, key: Optional[str], model: str, text: str,
+                final_chunk: Optional[Dict[str, Any]], metrics: GenerationMetrics,
+                coalescer: ChunkCoalescer) -> GenerationResult:
+        """写入缓存、记录统计数据并生成结果"""
+        if key and final_chunk is not None:
+            self.cache.put(key, model, text, final_chunk)
+        metrics.finish(final_chunk)
+        if self.metrics is not None:
+            self.metrics.record(metrics)
+        logger.info(
+            f"响应数据块: 收到 {coalescer.received_chunks} 个，"
+            f"发送 {coalescer.emitted_chunks} 个，合并 {coalescer.merged_chunks} 个"
+        )
+        return GenerationResult(text, metrics, final_chunk, coalescer)
+        
+    def _cache_key(self, model: str, path: str, payload: Dict[str, Any]) -> Optional[str]:
+        """计算缓存键；未启用缓存、请求不确定或无法获得模型digest时返回None"""
+        if self.cache is None or not is_deterministic(payload.get('options')):
+            return None
+        digest = self.pool.model_digest(model)
+        if not digest:
+            return None
+        # keep_alive只影响模型驻留时间，不影响回答内容
+        payload = {key: value for key, value in payload.items() if key != 'keep_alive'}
+        return cache_key(digest, path, payload)
+        
+    def _replay(self, model: str, text: str, final_chunk: Dict[str, Any],
+                on_chunk: Optional[Callable[[str], None]],
+                flush_interval: float, flush_chars: int) -> GenerationResult:
+        """把缓存的回答按合并后的块大小通过on_chunk回放，界面处理方式与真实生成相同"""
+        metrics = GenerationMetrics(model)
+        metrics.cached = True
+        coalescer = ChunkCoalescer(flush_interval, flush_chars)
+        for start in range(0, len(text), flush_chars):
+            metrics.record_chunk()
+            coalescer.received_chunks += 1
+            coalescer.emitted_chunks += 1
+            if on_chunk is not None:
+                on_chunk(text[start:start + flush_chars])
+        metrics.finish(final_chunk)
+        return GenerationResult(text, metrics, final_chunk, coalescer)
+        
+    def _read_stream(self, response: "requests.Response", metrics: GenerationMetrics,
+                     coalescer: ChunkCoalescer,
+                     on_chunk: Optional[Callable[[str], None]]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """处理流式响应"""
+        accumulator = StreamAccumulator(metrics, coalescer, on_chunk)
+        for line in response.iter_lines():
+            if accumulator.feed(line):
+                break
+        return accumulator.finish()
+        
+    def complete(self, model: str, prompt: str, keep_alive: Optional[str] = None,
+                 options: Optional[Dict[str, Any]] = None) -> str:
+        """非流式生成，直接返回完整文本（用于摘要等后台任务）"""
+        tried: List[Endpoint] = []
+        last_error: Optional[BaseException] = None
+        while True:
+            endpoint = self.pool.choose_after(model, tried, last_error)
+            try:
+                response = endpoint.client.post('/api/generate', json=build_complete_request(
+                    model, prompt, keep_alive, options
+                ))
+            except failover_errors() as e:
+                connect_error = is_connect_error(e)
+                self.pool.release(endpoint, failed=connect_error)
+                logger.warning(f"端点 {endpoint.url} 请求失败，尝试其他端点: {str(e)}")
+                tried.append(endpoint)
+                last_error = None if connect_error else e
+                continue
+            self.pool.release(endpoint, model)
+            if response.status_code != 200:
+                raise OllamaResponseError(describe_error_response(response, model), response.status_code)
+            return response.json().get('response', '')
+
+class Conversation:
+    """一个会话的对话状态：/api/chat使用上下文窗口，/api/generate使用上一轮的context
+    
+    排队的请求在传输层的事件循环线程中读取和记录对话，界面线程修改上下文时需要持有lock。
+    """
+    
+    def __init__(self, mode: str = CHAT_MODE_CHAT, budget: int = CONTEXT_TOKEN_BUDGET) -> None:
+        self.mode = mode
+        self.context_manager = ContextManager(budget)
+        self.generate_context: Optional[List[int]] = None
+        self.lock = threading.RLock()
+        
+    def request_kwargs(self) -> Dict[str, Any]:
+        """下一轮请求需要携带的对话参数（传给ChatEngine.generate）"""
+        with self.lock:
+            if self.mode == CHAT_MODE_GENERATE:
+                return {'context': self.generate_context}
+            return {'messages': self.context_manager.build_messages()}
+            
+    def record_turn(self, prompt: str, response: str,
+                    final_chunk: Optional[Dict[str, Any]] = None) -> None:
+        """记录成功完成的一轮，保持历史前缀稳定"""
+        with self.lock:
+            self.context_manager.add('user', prompt)
+            self.context_manager.add('assistant', response)
+            context = (final_chunk or {}).get('context')
+            if context:
+                # context超出预算时Ollama会截断，直接重新开始比截断后的结果更可控
+                if len(context) > self.context_manager.budget:
+                    logger.info("context超出预算，下一轮重新开始")
+                    self.generate_context = None
+                else:
+                    self.generate_context = context
+                    
+    def reset_model_state(self) -> None:
+        """切换模型后，与模型相关的context不能继续使用"""
+        with self.lock:
+            self.generate_context = None
+            
+    def clear(self) -> None:
+        with self.lock:
+            self.context_manager.clear()
+            self.generate_context = None
+
+BLOCK_MARKERS = ('```', '~~~', '#', '|')  # 必须位于行首的markdown块标记
+
+class ChatMessage:
+    """界面和存储共用的一条消息
+
+    流式回答的文本块先追加到列表中，需要完整文本时才拼接一次；
+    revision在内容变化时递增，渲染缓存用它代替对整段文本求哈希。
+    """
+    __slots__ = ('role', 'model', 'created', 'finished', 'truncated', 'metrics', 'summary',
+                 'store_id', 'revision', '_chunks')
+    
+    LABELS = {'user': "You", 'system': "System"}
+    
+    def __init__(self, role: str, content: str = "", model: str = "",
+                 created: Optional[float] = None) -> None:
+        self.role = role
+        self.model = model
+        self.created = created if created is not None else time.time()
+        self.finished: Optional[float] = None if role == 'assistant' else self.created
+        self.truncated = False
+        self.metrics: Optional[GenerationMetrics] = None
+        self.summary = ""
+        self.store_id: Optional[int] = None
+        self.revision = 0
+        self._chunks: List[str] = [content] if content else []
+        
+    @classmethod
+    def from_stored(cls, message: Dict[str, Any]) -> "ChatMessage":
+        """由ConversationStore返回的消息创建"""
+        item = cls(message['role'], message['content'], message['model'], message['created'])
+        item.store_id = message['id']
+        item.summary = message['meta'].get('summary', '')
+        item.truncated = message['meta'].get('truncated', False) or not message['done']
+        return item
+        
+    @property
+    def text(self) -> str:
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+        
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+        
+    @property
+    def label(self) -> str:
+        return self.LABELS.get(self.role) or self.model or "AI"
+        
+    def append(self, chunk: str) -> None:
+        """追加一个流式文本块"""
+        self._chunks.append(chunk)
+        self.revision += 1
+        
+    def finish(self, text: Optional[str] = None, summary: str = "",
+               metrics: Optional[GenerationMetrics] = None, truncated: bool = False) -> None:
+        """生成结束，text为服务器返回的完整回答（不传时保留已收到的部分）"""
+        if text is not None:
+            self._chunks = [text] if text else []
+        self.summary = summary
+        self.metrics = metrics
+        self.truncated = truncated
+        self.finished = time.time()
+        self.revision += 1
+        
+    def to_markdown(self) -> str:
+        """显示用的markdown文本"""
+        body = self.text
+        # 以代码块、标题或表格开头的回答需要从新的一行开始，否则不会被识别
+        separator = "\n\n" if body.lstrip().startswith(BLOCK_MARKERS) else " "
+        text = f"**{self.label}:**{separator}{body}"
+        if self.summary:
+            text += f"\n\n*{self.summary}*"
+        elif self.truncated:
+            text += "\n\n*（回答未完成）*"
+        return text
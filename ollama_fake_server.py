@@ -0,0 +1,307 @@
+# Ollama AI Chat Tool 的本地模拟服务器：实现/api/tags、/api/generate、/api/chat、/api/embed等接口，
+# 按设定的速度、分块大小和延迟流式返回NDJSON，并可以注入错误，用于性能测试和长时间运行测试
+# 用法：python ollama_fake_server.py --port 11500 --tokens-per-second 50 --models llama3,qwen2
+
+import sys
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Dict, Optional, Any, Iterator, Set
+
+FAKE_MODELS = ['fake-llama:7b', 'fake-qwen:14b']  # 默认提供的模型
+FAKE_TOKENS_PER_SECOND = 50.0  # 默认生成速度，0表示不限速
+FAKE_RESPONSE_TOKENS = 200  # 请求没有指定num_predict时生成的token数
+FAKE_CONTEXT_LENGTH = 8192
+FAKE_EMBED_DIMENSION = 64  # /api/embed返回的向量维度
+# Go的time.ParseDuration接受的格式：除了"0"以外每一段数字都必须带单位
+GO_DURATION = re.compile(r'[-+]?(0|((\d+(\.\d*)?|\.\d+)(ns|us|µs|ms|s|m|h))+)')
+
+# 生成内容的素材：普通段落和代码块交替出现，覆盖markdown渲染和代码高亮
+PARAGRAPH_WORDS = ("the model streams tokens while the interface renders markdown "
+                   "and the scheduler keeps every conversation in order").split()
+CODE_LINES = ["def fibonacci(n):", "    a, b = 0, 1", "    for _ in range(n):",
+              "        a, b = b, a + b", "    return a"]
+
+class FakeServerConfig:
+    """模拟服务器的行为参数，运行中修改会影响之后的请求"""
+
+    def __init__(self, models: Optional[List[str]] = None,
+                 tokens_per_second: float = FAKE_TOKENS_PER_SECOND,
+                 chunk_tokens: int = 1, first_token_latency: float = 0.05,
+                 response_tokens: int = FAKE_RESPONSE_TOKENS, load_delay: float = 0.0,
+                 error_rate: float = 0.0, drop_rate: float = 0.0, seed: Optional[int] = None) -> None:
+        self.models = models or list(FAKE_MODELS)
+        self.tokens_per_second = tokens_per_second
+        self.chunk_tokens = max(1, chunk_tokens)  # 每个NDJSON行包含的token数
+        self.first_token_latency = first_token_latency  # 收到请求到第一个数据块的延迟（秒）
+        self.response_tokens = response_tokens
+        self.load_delay = load_delay  # 模型第一次使用时的加载时间（秒）
+        self.error_rate = error_rate  # 直接返回HTTP 500的请求比例
+        self.drop_rate = drop_rate  # 输出一半后断开连接的请求比例
+        self.random = random.Random(seed)
+
+class FakeServerStats:
+    """模拟服务器收到的请求和注入的错误次数"""
+
+    def __init__(self) -> None:
+        self.requests: Dict[str, int] = {}
+        self.errors = 0
+        self.dropped = 0
+        self.aborted = 0  # 客户端在生成中途断开的次数
+        self.loaded: Set[str] = set()  # 已经“加载”过的模型，第一次使用时模拟加载时间
+        self._lock = threading.Lock()
+
+    def count(self, path: str) -> None:
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'requests': dict(self.requests), 'errors': self.errors,
+                    'dropped': self.dropped, 'aborted': self.aborted}
+
+def keep_alive_error(value: Any) -> Optional[str]:
+    """与Ollama一样检查keep_alive：数字按秒计算，字符串按Go的时长格式解析"""
+    if value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)):
+        return None
+    if isinstance(value, str) and GO_DURATION.fullmatch(value):
+        return None
+    if isinstance(value, str) and re.fullmatch(r'[-+]?[\d.]+', value):
+        return f"time: missing unit in duration {json.dumps(value)}"
+    return f"time: invalid duration {json.dumps(value)}"
+
+def fake_tokens(count: int) -> Iterator[str]:
+    """生成count个token的markdown文本：段落之后跟一个代码块，循环出现"""
+    emitted = 0
+    while emitted < count:
+        for index in range(40):
+            word = PARAGRAPH_WORDS[index % len(PARAGRAPH_WORDS)]
+            yield word + (".\n\n" if index == 39 else " ")
+            emitted += 1
+            if emitted >= count:
+                return
+        for line in ["```python\n"] + [line + "\n" for line in CODE_LINES] + ["```\n\n"]:
+            yield line
+            emitted += 1
+            if emitted >= count:
+                return
+
+def fake_embedding(text: str) -> List[float]:
+    """词袋向量：每个词按哈希累加到一个维度上，包含相同词语的文本相似度更高"""
+    vector = [0.0] * FAKE_EMBED_DIMENSION
+    for word in text.lower().split():
+        vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % FAKE_EMBED_DIMENSION] += 1.0
+    return vector
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    """模拟Ollama的HTTP接口，行为由server.config控制"""
+    protocol_version = 'HTTP/1.1'
+    server: "FakeOllamaServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send_json(self, data: Any, status: int = 200) -> None:
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: Dict[str, Any]) -> None:
+        line = (json.dumps(data) + "\n").encode('utf-8')
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self) -> None:
+        config, stats = self.server.config, self.server.stats
+        stats.count(self.path)
+        if self.path == '/api/tags':
+            self._send_json({'models': [
+                {'name': name, 'model': name, 'size': 4 * 2 ** 30, 'digest': f"fake-{name}",
+                 'details': {'parameter_size': name.rsplit(':', 1)[-1].upper(),
+                             'quantization_level': 'Q4_0'}}
+                for name in config.models
+            ]})
+        elif self.path == '/api/ps':
+            self._send_json({'models': [
+                {'name': name, 'model': name, 'size': 4 * 2 ** 30, 'size_vram': 4 * 2 ** 30}
+                for name in sorted(stats.loaded)
+            ]})
+        elif self.path == '/api/version':
+            self._send_json({'version': '0.0.0-fake'})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def do_POST(self) -> None:
+        config, stats = self.server.config, self.server.stats
+        stats.count(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        error = keep_alive_error(body.get('keep_alive'))
+        if error is not None:
+            self._send_json({'error': error}, 400)
+            return
+        if self.path == '/api/show':
+            self._send_json({
+                'details': {'parameter_size': '7B', 'quantization_level': 'Q4_0', 'family': 'llama'},
+                'model_info': {'general.architecture': 'llama', 'llama.context_length': FAKE_CONTEXT_LENGTH}
+            })
+            return
+        if self.path == '/api/embed':
+            inputs = body.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self._send_json({'model': body.get('model'), 'embeddings': [fake_embedding(text) for text in inputs]})
+            return
+        if self.path not in ('/api/generate', '/api/chat'):
+            self._send_json({'error': 'not found'}, 404)
+            return
+        model = body.get('model', '')
+        if model not in config.models:
+            self._send_json({'error': f"model '{model}' not found"}, 404)
+            return
+        if config.random.random() < config.error_rate:
+            stats.errors += 1
+            self._send_json({'error': 'injected error'}, 500)
+            return
+
+        load_duration = 0.0
+        if model not in stats.loaded:
+            time.sleep(config.load_delay)
+            load_duration = config.load_delay
+            stats.loaded.add(model)
+        chat = self.path == '/api/chat'
+        if body.get('stream', True) is False:
+            self._respond_complete(body, chat, load_duration)
+            return
+        self._stream(body, chat, load_duration)
+
+    def _respond_complete(self, body: Dict[str, Any], chat: bool, load_duration: float) -> None:
+        """非流式请求（摘要、预热）：空提示词只加载模型"""
+        prompt = body.get('prompt', '') if not chat else 'chat'
+        text = "".join(fake_tokens(self.server.config.response_tokens)) if prompt else ''
+        result: Dict[str, Any] = {'model': body.get('model'), 'done': True,
+                                  'load_duration': int(load_duration * 1e9)}
+        if chat:
+            result['message'] = {'role': 'assistant', 'content': text}
+        else:
+            result['response'] = text
+        self._send_json(result)
+
+    def _stream(self, body: Dict[str, Any], chat: bool, load_duration: float) -> None:
+        config, stats = self.server.config, self.server.stats
+        options = body.get('options') or {}
+        count = options.get('num_predict', config.response_tokens)
+        if count is None or count < 0:
+            count = config.response_tokens
+        if not chat and not body.get('prompt'):
+            # 空提示词只加载模型
+            count = 0
+        drop_at = count // 2 if config.random.random() < config.drop_rate else None
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        start = time.perf_counter()
+        interval = config.chunk_tokens / config.tokens_per_second if config.tokens_per_second else 0.0
+        try:
+            time.sleep(config.first_token_latency)
+            tokens = fake_tokens(count)
+            emitted = 0
+            while emitted < count:
+                if drop_at is not None and emitted >= drop_at:
+                    stats.dropped += 1
+                    self.close_connection = True
+                    return
+                text = "".join(next(tokens, "") for _ in range(min(config.chunk_tokens, count - emitted)))
+                emitted += min(config.chunk_tokens, count - emitted)
+                if chat:
+                    self._write_chunk({'model': body.get('model'), 'done': False,
+                                       'message': {'role': 'assistant', 'content': text}})
+                else:
+                    self._write_chunk({'model': body.get('model'), 'done': False, 'response': text})
+                if interval:
+                    time.sleep(interval)
+            eval_duration = time.perf_counter() - start - config.first_token_latency
+            final: Dict[str, Any] = {
+                'model': body.get('model'), 'done': True, 'done_reason': 'stop',
+                'total_duration': int((time.perf_counter() - start + load_duration) * 1e9),
+                'load_duration': int(load_duration * 1e9),
+                'prompt_eval_count': 10, 'prompt_eval_duration': int(config.first_token_latency * 1e9),
+                'eval_count': count, 'eval_duration': int(max(eval_duration, 1e-6) * 1e9)
+            }
+            if chat:
+                final['message'] = {'role': 'assistant', 'content': ''}
+            else:
+                final['response'] = ''
+                final['context'] = list(range(10 + count))
+            self._write_chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            stats.aborted += 1
+            self.close_connection = True
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """在后台线程中运行的模拟服务器，port为0时使用随机端口"""
+    daemon_threads = True
+
+    def __init__(self, config: Optional[FakeServerConfig] = None,
+                 host: str = '127.0.0.1', port: int = 0) -> None:
+        super().__init__((host, port), FakeOllamaHandler)
+        self.config = config or FakeServerConfig()
+        self.stats = FakeServerStats()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllamaServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-ollama", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Ollama AI Chat Tool 模拟服务器")
+    parser.add_argument('--port', type=int, default=11500)
+    parser.add_argument('--models', default=",".join(FAKE_MODELS), help="逗号分隔的模型列表")
+    parser.add_argument('--tokens-per-second', type=float, default=FAKE_TOKENS_PER_SECOND)
+    parser.add_argument('--chunk-tokens', type=int, default=1, help="每个数据块包含的token数")
+    parser.add_argument('--latency', type=float, default=0.05, help="首个数据块的延迟（秒）")
+    parser.add_argument('--tokens', type=int, default=FAKE_RESPONSE_TOKENS, help="每个回答的token数")
+    parser.add_argument('--load-delay', type=float, default=0.0, help="模型第一次加载的时间（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回HTTP 500的请求比例")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="中途断开连接的请求比例")
+    args = parser.parse_args(argv)
+
+    config = FakeServerConfig(
+        models=[model.strip() for model in args.models.split(',') if model.strip()],
+        tokens_per_second=args.tokens_per_second, chunk_tokens=args.chunk_tokens,
+        first_token_latency=args.latency, response_tokens=args.tokens, load_delay=args.load_delay,
+        error_rate=args.error_rate, drop_rate=args.drop_rate
+    )
+    server = FakeOllamaServer(config, port=args.port)
+    print(f"模拟Ollama服务器运行在 {server.url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,541 @@
+# Ollama AI Chat Tool 的本地网关：在本机提供与Ollama相同的HTTP接口，以及OpenAI格式的
+# /v1/chat/completions（支持流式输出）和/v1/models。所有请求都经过本程序的端点池、调度器和统计，
+# 本机的其他工具连接网关而不是直接连接Ollama，同一个模型的请求统一排队，不会同时抢占模型槽位
+# 用法：python OllamaAIChatTool.py --gateway --port 11435 --server http://localhost:11434
+#       也可以在界面中勾选"本地网关"，与界面中的对话共用同一个传输层和调度队列
+# 其他工具中把Ollama地址改为 http://127.0.0.1:11435，OpenAI客户端的base_url改为 http://127.0.0.1:11435/v1
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import itertools
+from http.client import responses
+from urllib.parse import urlsplit
+from typing import List, Dict, Optional, Any, Callable, Awaitable
+
+from ollama_engine import (DEFAULT_SERVER_URL, CONNECT_TIMEOUT, OllamaError, OllamaResponseError,
+                           GenerationResult, MetricsAggregator)
+from ollama_transport import StreamTransport, AsyncResponse
+from ollama_profiles import ModelProfiles, merge_options
+
+GATEWAY_HOST = '127.0.0.1'  # 默认只接受本机的连接
+GATEWAY_PORT = 11435
+GATEWAY_MAX_BODY = 64 * 1024 * 1024  # 请求体大小上限（包含图片的请求可能较大）
+GATEWAY_IDLE_TIMEOUT = 60  # keep-alive连接等待下一个请求的时间（秒）
+# 转发时需要与该模型的生成请求一起排队的接口（同样占用模型的计算资源）
+SCHEDULED_PATHS = ('/api/embed', '/api/embeddings')
+# 生成接口中由build_request处理的字段，其他字段（format、images、system等）原样转发
+GENERATION_FIELDS = ('model', 'prompt', 'messages', 'context', 'options', 'keep_alive', 'stream')
+# OpenAI请求参数对应的Ollama options
+# 流式响应中分段返回的字段：合并为非流式响应时文本拼接、列表连接，其他字段取最后一个值
+STREAM_TEXT_FIELDS = ('response', 'thinking', 'content')
+STREAM_LIST_FIELDS = ('tool_calls', 'images')
+OPENAI_OPTIONS = {'temperature': 'temperature', 'top_p': 'top_p', 'seed': 'seed', 'stop': 'stop',
+                  'max_tokens': 'num_predict', 'max_completion_tokens': 'num_predict',
+                  'presence_penalty': 'presence_penalty', 'frequency_penalty': 'frequency_penalty'}
+
+logger = logging.getLogger(__name__)
+
+class GatewayRequest:
+    """网关收到的一个HTTP请求"""
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method: str, path: str, query: str, headers: Dict[str, str], body: bytes) -> None:
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> Any:
+        try:
+            return json.loads(self.body or b"{}")
+        except ValueError:
+            raise OllamaResponseError("请求体不是有效的JSON", 400)
+
+async def read_request(reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter) -> Optional[GatewayRequest]:
+    """读取一个请求，连接已关闭时返回None；请求体支持Content-Length和分块编码"""
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise ValueError(f"无效的请求行: {line[:100]!r}")
+    method, target, _ = parts
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(b"", None)
+        line = line.strip()
+        if not line:
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('expect', '').lower() == '100-continue':
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks: List[bytes] = []
+        total = 0
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            if size == 0:
+                while (await reader.readline()).strip():
+                    pass
+                break
+            total += size
+            if total > GATEWAY_MAX_BODY:
+                raise ValueError("请求体过大")
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b"".join(chunks)
+    else:
+        length = int(headers.get('content-length', 0))
+        if length > GATEWAY_MAX_BODY:
+            raise ValueError("请求体过大")
+        body = await reader.readexactly(length) if length else b""
+    url = urlsplit(target)
+    return GatewayRequest(method.upper(), url.path, url.query, headers, body)
+
+class ResponseWriter:
+    """写出一个响应：完整的响应体，或分块编码的流（NDJSON或SSE）"""
+
+    def __init__(self, writer: asyncio.StreamWriter, keep_alive: bool) -> None:
+        self.writer = writer
+        self.keep_alive = keep_alive
+        self.started = False
+        self.streaming = False
+
+    def _head(self, status: int, content_type: str, headers: List[str]) -> bytes:
+        lines = [f"HTTP/1.1 {status} {responses.get(status, '')}", f"Content-Type: {content_type}",
+                 *headers, f"Connection: {'keep-alive' if self.keep_alive else 'close'}"]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+    async def send(self, status: int, body: bytes,
+                   content_type: str = 'application/json; charset=utf-8') -> None:
+        self.started = True
+        self.writer.write(self._head(status, content_type, [f"Content-Length: {len(body)}"]) + body)
+        await self.writer.drain()
+
+    async def send_json(self, data: Any, status: int = 200) -> None:
+        await self.send(status, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+    async def start_stream(self, content_type: str, status: int = 200) -> None:
+        self.started = self.streaming = True
+        self.writer.write(self._head(status, content_type, ["Transfer-Encoding: chunked", "Cache-Control: no-cache"]))
+        await self.writer.drain()
+
+    async def write_chunk(self, data: bytes) -> None:
+        self.writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+        await self.writer.drain()
+
+    async def end_stream(self) -> None:
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+def ndjson(data: Dict[str, Any]) -> bytes:
+    return (json.dumps(data, ensure_ascii=False) + "\n").encode('utf-8')
+
+def sse(data: Any) -> bytes:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+def merge_chunks(chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """把流式响应的各个数据块合并为一个非流式响应，message等嵌套字段按同样的规则合并"""
+    merged: Dict[str, Any] = {}
+    texts: Dict[str, List[str]] = {}
+    lists: Dict[str, List[Any]] = {}
+    nested: Dict[str, List[Dict[str, Any]]] = {}
+    for chunk in chunks:
+        for key, value in chunk.items():
+            if key in STREAM_TEXT_FIELDS and isinstance(value, str):
+                texts.setdefault(key, []).append(value)
+            elif key in STREAM_LIST_FIELDS and isinstance(value, list):
+                lists.setdefault(key, []).extend(value)
+            elif isinstance(value, dict):
+                nested.setdefault(key, []).append(value)
+            else:
+                merged[key] = value
+    merged.update({key: "".join(values) for key, values in texts.items()})
+    merged.update(lists)
+    merged.update({key: merge_chunks(values) for key, values in nested.items()})
+    return merged
+
+def timestamp() -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+def openai_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    """把OpenAI格式的消息转换为Ollama的消息：内容分段合并为文本，data URL图片放入images"""
+    content = message.get('content')
+    result: Dict[str, Any] = {'role': message.get('role', 'user')}
+    if isinstance(content, list):
+        texts: List[str] = []
+        images: List[str] = []
+        for part in content:
+            if part.get('type') == 'text':
+                texts.append(part.get('text', ''))
+            elif part.get('type') == 'image_url':
+                url = part['image_url'].get('url', '') if isinstance(part.get('image_url'), dict) else ''
+                if url.startswith('data:'):
+                    images.append(url.split(',', 1)[-1])
+        result['content'] = "\n".join(texts)
+        if images:
+            result['images'] = images
+    else:
+        result['content'] = content or ""
+    return result
+
+def openai_options(body: Dict[str, Any]) -> Dict[str, Any]:
+    """OpenAI请求中的生成参数对应的Ollama options"""
+    options = {OPENAI_OPTIONS[key]: value for key, value in body.items()
+               if key in OPENAI_OPTIONS and value is not None}
+    if isinstance(options.get('stop'), str):
+        # OpenAI允许stop为单个字符串，Ollama只接受列表
+        options['stop'] = [options['stop']]
+    return options
+
+def openai_format(response_format: Optional[Dict[str, Any]]) -> Optional[Any]:
+    """OpenAI的response_format对应的Ollama format字段"""
+    if not response_format:
+        return None
+    if response_format.get('type') == 'json_object':
+        return 'json'
+    if response_format.get('type') == 'json_schema':
+        return (response_format.get('json_schema') or {}).get('schema')
+    return None
+
+class OllamaGateway:
+    """运行在传输层事件循环中的HTTP服务器
+
+    生成请求通过StreamTransport.generate提交（与界面的对话共用端点池、调度队列和连接池），
+    完成的生成计入metrics；其他接口原样转发，响应体边读边以分块编码写给客户端。
+    """
+
+    def __init__(self, transport: StreamTransport, server_url: str = DEFAULT_SERVER_URL,
+                 host: str = GATEWAY_HOST, port: int = GATEWAY_PORT,
+                 metrics: Optional[MetricsAggregator] = None,
+                 profiles: Optional[ModelProfiles] = None) -> None:
+        self.transport = transport
+        self.server_url = server_url  # 只在事件循环线程中读写，其他线程通过set_server_url修改
+        self.host = host
+        self.port = port
+        self.metrics = metrics if metrics is not None else MetricsAggregator()
+        self.profiles = profiles
+        self.requests = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: set = set()
+        self._ids = itertools.count(1)
+
+    def set_server_url(self, server_url: str) -> None:
+        """修改转发的服务器地址（可在任意线程调用），之后的请求使用新的地址"""
+        self.transport.call_soon(setattr, self, 'server_url', server_url)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> None:
+        """开始监听，端口被占用时抛出OSError（可在任意线程调用）"""
+        self.transport.run_coroutine(self._start()).result(timeout=CONNECT_TIMEOUT)
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self.transport.run_coroutine(self._stop()).result(timeout=CONNECT_TIMEOUT)
+
+    async def _start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"网关运行在 {self.url}，转发到 {self.server_url}")
+
+    async def _stop(self) -> None:
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """处理一个连接上的所有请求（HTTP/1.1 keep-alive）"""
+        self._connections.add(writer)
+        try:
+            while True:
+                request = await asyncio.wait_for(read_request(reader, writer), GATEWAY_IDLE_TIMEOUT)
+                if request is None:
+                    break
+                response = ResponseWriter(writer, request.headers.get('connection', '').lower() != 'close')
+                await self._dispatch(request, response)
+                if not response.keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, request: GatewayRequest, response: ResponseWriter) -> None:
+        self.requests += 1
+        openai = request.path.startswith('/v1/')
+        try:
+            if request.path in ('/', '') and request.method in ('GET', 'HEAD'):
+                # Ollama客户端用这个地址检查服务是否在运行
+                await response.send(200, b"Ollama is running", 'text/plain; charset=utf-8')
+            elif request.method == 'POST' and request.path in ('/api/generate', '/api/chat'):
+                await self._native_generate(request, response)
+            elif request.method == 'POST' and request.path == '/v1/chat/completions':
+                await self._openai_chat(request, response)
+            elif request.method == 'GET' and request.path == '/v1/models':
+                await self._openai_models(response)
+            elif request.method == 'GET' and request.path in ('/api/tags', '/api/ps'):
+                await self._native_models(response, request.path)
+            elif request.method == 'GET' and request.path == '/metrics':
+                await response.send(200, self.metrics.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+            elif request.method == 'GET' and request.path == '/gateway/status':
+                await response.send_json({'server_url': self.server_url, 'requests': self.requests,
+                                          'connections': len(self._connections),
+                                          'queue': self.transport.queue_status(),
+                                          'models': self.metrics.snapshot()})
+            elif openai or request.method == 'HEAD':
+                raise OllamaResponseError(f"不支持的接口: {request.method} {request.path}", 404)
+            else:
+                await self._forward(request, response)
+        except ConnectionError:
+            raise
+        except OllamaError as e:
+            await self._send_error(response, e, openai)
+        except Exception as e:
+            logger.error(f"网关处理 {request.method} {request.path} 时出错: {str(e)}")
+            await self._send_error(response, e, openai)
+
+    async def _send_error(self, response: ResponseWriter, error: Exception, openai: bool) -> None:
+        """返回错误；流已经开始时把错误作为最后一条数据写出"""
+        status = getattr(error, 'status_code', None) or (502 if isinstance(error, OllamaError) else 500)
+        body: Dict[str, Any] = ({'error': {'message': str(error), 'type': 'server_error', 'code': status}}
+                                if openai else {'error': str(error)})
+        if not response.started:
+            await response.send_json(body, status)
+        elif response.streaming:
+            await response.write_chunk(sse(body) if openai else ndjson(body))
+            await response.end_stream()
+
+    def _options(self, model: str, options: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """模型配置加上请求中的参数（请求优先）"""
+        return merge_options(self.profiles.get(model) if self.profiles is not None else None, options)
+
+    async def _call(self, submit: Callable[[Callable[[int, Any], None], Callable[[int, Any], None]], int]) -> Any:
+        """把传输层的回调接口转换为可以等待的结果（回调在同一个事件循环线程中调用）"""
+        future = asyncio.get_running_loop().create_future()
+
+        def resolve(request_id: int, result: Any) -> None:
+            if future.done():
+                return
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        request_id = submit(resolve, resolve)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self.transport.cancel(request_id)
+            raise
+
+    async def _generate(self, model: str, on_text: Optional[Callable[[str], Awaitable[None]]],
+                        options: Optional[Dict[str, Any]],
+                        on_data: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+                        **kwargs: Any) -> GenerationResult:
+        """通过传输层提交生成请求，流式输出时把合并后的文本块交给on_text，
+        或者把上游的每个原始响应块交给on_data；写入客户端失败（连接已断开）时取消生成"""
+        # 队列中的每一项为(处理函数, 值)，处理函数为None时值是最终结果或错误
+        queue: asyncio.Queue = asyncio.Queue()
+        if on_data is not None:
+            kwargs['on_data'] = lambda data: queue.put_nowait((on_data, data))
+
+        def on_chunk(request_id: int, text: str) -> None:
+            if on_text is not None:
+                queue.put_nowait((on_text, text))
+
+        request_id = self.transport.generate(
+            self.server_url, model, kwargs.pop('prompt', None), on_chunk,
+            lambda _, result: queue.put_nowait((None, result)),
+            lambda _, error: queue.put_nowait((None, error)),
+            options=options, **kwargs
+        )
+        try:
+            while True:
+                handler, value = await queue.get()
+                if handler is not None:
+                    await handler(value)
+                    continue
+                if isinstance(value, Exception):
+                    raise value
+                self.metrics.record(value.metrics, options)
+                return value
+        except BaseException:
+            self.transport.cancel(request_id)
+            raise
+
+    async def _native_generate(self, request: GatewayRequest, response: ResponseWriter) -> None:
+        """/api/generate和/api/chat：请求和响应格式与Ollama相同"""
+        body = request.json()
+        model = body.get('model')
+        if not model:
+            raise OllamaResponseError("缺少model字段", 400)
+        chat = request.path == '/api/chat'
+        stream = body.get('stream', True) is not False
+        chunks: List[Dict[str, Any]] = []
+
+        async def forward_data(data: Dict[str, Any]) -> None:
+            # 上游的响应块原样转发（保留tool_calls、thinking等字段），只改写model
+            data = dict(data, model=model)
+            if 'created_at' not in data:
+                data['created_at'] = timestamp()
+            if stream:
+                await response.write_chunk(ndjson(data))
+            else:
+                chunks.append(data)
+
+        if stream:
+            await response.start_stream('application/x-ndjson')
+        await self._generate(
+            model, None, self._options(model, body.get('options')), on_data=forward_data,
+            prompt=None if chat else body.get('prompt', ''),
+            messages=body.get('messages') or [] if chat else None,
+            context=body.get('context'), keep_alive=body.get('keep_alive'),
+            extra={key: value for key, value in body.items() if key not in GENERATION_FIELDS}
+        )
+        if stream:
+            await response.end_stream()
+            return
+        await response.send_json(merge_chunks(chunks))
+
+    async def _openai_chat(self, request: GatewayRequest, response: ResponseWriter) -> None:
+        """OpenAI格式的/v1/chat/completions，stream为true时以SSE输出"""
+        body = request.json()
+        model = body.get('model')
+        messages = body.get('messages')
+        if not model or not isinstance(messages, list):
+            raise OllamaResponseError("缺少model或messages字段", 400)
+        options = openai_options(body)
+        extra: Dict[str, Any] = {}
+        response_format = openai_format(body.get('response_format'))
+        if response_format is not None:
+            extra['format'] = response_format
+        completion_id = f"chatcmpl-{next(self._ids)}"
+        created = int(time.time())
+        stream = bool(body.get('stream'))
+
+        def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+            return {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+
+        async def write_text(text: str) -> None:
+            await response.write_chunk(sse(chunk({'content': text})))
+
+        if stream:
+            await response.start_stream('text/event-stream')
+            await response.write_chunk(sse(chunk({'role': 'assistant', 'content': ''})))
+        result = await self._generate(
+            model, write_text if stream else None, self._options(model, options or None),
+            messages=[openai_message(message) for message in messages],
+            keep_alive=body.get('keep_alive'), extra=extra
+        )
+        finish_reason = 'length' if result.final_chunk.get('done_reason') == 'length' else 'stop'
+        server = result.metrics.server
+        usage = {'prompt_tokens': server.get('prompt_eval_count', 0),
+                 'completion_tokens': server.get('eval_count', 0),
+                 'total_tokens': server.get('prompt_eval_count', 0) + server.get('eval_count', 0)}
+        if stream:
+            await response.write_chunk(sse(chunk({}, finish_reason)))
+            if (body.get('stream_options') or {}).get('include_usage'):
+                await response.write_chunk(sse({'id': completion_id, 'object': 'chat.completion.chunk',
+                                                'created': created, 'model': model, 'choices': [],
+                                                'usage': usage}))
+            await response.write_chunk(b"data: [DONE]\n\n")
+            await response.end_stream()
+            return
+        await response.send_json({
+            'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': result.text},
+                         'finish_reason': finish_reason}],
+            'usage': usage
+        })
+
+    async def _models(self, path: str = '/api/tags') -> List[Dict[str, Any]]:
+        """端点池中所有端点的模型（/api/tags格式），生成请求会被发送到有该模型的端点；
+        path为/api/ps时返回所有端点已加载的模型"""
+        models: List[Dict[str, Any]] = await self._call(
+            lambda done, error: self.transport.tags(self.server_url, done, error, path)
+        )
+        return [{key: value for key, value in model.items() if key != 'endpoints'} for model in models]
+
+    async def _native_models(self, response: ResponseWriter, path: str) -> None:
+        await response.send_json({'models': await self._models(path)})
+
+    async def _openai_models(self, response: ResponseWriter) -> None:
+        """把合并后的模型列表转换为OpenAI格式"""
+        models = await self._models()
+        created = int(time.time())
+        await response.send_json({'object': 'list', 'data': [
+            {'id': model['name'], 'object': 'model', 'created': created, 'owned_by': 'ollama'}
+            for model in models
+        ]})
+
+    async def _forward(self, request: GatewayRequest, response: ResponseWriter) -> None:
+        """其他接口原样转发到端点池，计算向量的接口与该模型的生成请求一起排队"""
+        payload = request.json() if request.body else None
+        model = ""
+        if isinstance(payload, dict):
+            model = payload.get('model') or payload.get('name') or ""
+        path = request.path + (f"?{request.query}" if request.query else "")
+
+        async def relay(upstream: AsyncResponse) -> None:
+            # /api/pull、/api/create等接口持续输出进度，边读边转发，不在内存中保留整个响应体
+            await response.start_stream(upstream.headers.get('content-type', 'application/json; charset=utf-8'),
+                                        upstream.status_code)
+            async for data in upstream.iter_raw():
+                await response.write_chunk(data)
+            await response.end_stream()
+
+        await self._call(lambda done, error: self.transport.forward(
+            self.server_url, request.method, path, payload, done, error,
+            model=model, scheduled=bool(model) and request.path in SCHEDULED_PATHS, consume=relay
+        ))
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Ollama AI Chat Tool 本地网关")
+    parser.add_argument('--gateway', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--host', default=GATEWAY_HOST, help="监听地址，默认只接受本机的连接")
+    parser.add_argument('--port', type=int, default=GATEWAY_PORT)
+    parser.add_argument('--server', default=DEFAULT_SERVER_URL, help="Ollama服务器地址，多个地址用逗号分隔")
+    parser.add_argument('--no-profiles', action='store_true', help="不使用保存的模型参数配置")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    transport = StreamTransport()
+    gateway = OllamaGateway(transport, args.server, args.host, args.port,
+                            profiles=None if args.no_profiles else ModelProfiles())
+    try:
+        gateway.start()
+    except OSError as e:
+        logger.error(f"无法监听 {args.host}:{args.port}: {str(e)}")
+        transport.close()
+        return 1
+    print(f"网关运行在 {gateway.url}（OpenAI接口: {gateway.url}/v1），按Ctrl+C停止", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.stop()
+        transport.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
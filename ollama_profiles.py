@@ -0,0 +1,212 @@
+# Ollama AI Chat Tool 的模型参数配置：按模型保存num_thread、num_ctx、num_batch、num_predict，
+# 发送给该模型的每个请求（对话、摘要、预热）都会携带，避免参数不同导致Ollama重新加载模型；
+# 自动调优在一组num_thread/num_batch组合上运行同一个标准提示词，按解码速度或首字延迟选出最好的组合
+# 用法：python ollama_profiles.py tune --model llama3 --objective tokens_per_second
+#       python ollama_profiles.py show
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import threading
+from typing import List, Dict, Optional, Any
+
+MODEL_PROFILES_PATH = os.path.join(os.path.expanduser("~"), ".ollama_chat_tool", "model_profiles.json")
+PROFILE_OPTIONS = ('num_thread', 'num_ctx', 'num_batch', 'num_predict')  # 配置中可以保存的参数
+CONTEXT_BUDGET_RATIO = 0.75  # 配置了num_ctx时，对话历史预算占上下文长度的比例，其余留给回答
+
+OBJECTIVE_TOKENS_PER_SECOND = "tokens_per_second"  # 调优目标：解码速度最高
+OBJECTIVE_TTFT = "ttft"  # 调优目标：首字延迟最低
+TUNE_BATCH_SIZES = [128, 256, 512]  # 自动调优尝试的num_batch
+TUNE_TOKENS = 64  # 每次测试生成的token数
+TUNE_RUNS = 2  # 每个组合在模型加载后测试的次数，结果取平均
+# 标准提示词：足够长，首字延迟能反映提示词处理速度
+TUNE_PROMPT = ("Explain step by step how a hash map handles collisions, compare separate chaining "
+               "with open addressing, and describe when a resize is triggered and what it costs. "
+               "Use short paragraphs and finish with a small Python example.")
+
+logger = logging.getLogger(__name__)
+
+def thread_candidates(cpu_count: Optional[int] = None) -> List[int]:
+    """自动调优尝试的num_thread：逻辑核心数的1/4、1/2、3/4和全部"""
+    cpu_count = cpu_count or os.cpu_count() or 1
+    return sorted({max(1, cpu_count * share // 4) for share in (1, 2, 3, 4)})
+
+def tune_grid(threads: Optional[List[int]] = None,
+              batches: Optional[List[int]] = None) -> List[Dict[str, int]]:
+    """所有需要测试的num_thread/num_batch组合"""
+    return [{'num_thread': thread, 'num_batch': batch}
+            for thread in threads or thread_candidates()
+            for batch in batches or TUNE_BATCH_SIZES]
+
+def merge_options(profile: Optional[Dict[str, Any]],
+                  options: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """模型配置加上本次请求的参数（同名时以本次请求为准），都没有时返回None"""
+    merged = dict(profile or {})
+    merged.update(options or {})
+    return merged or None
+
+def context_budget(profile: Optional[Dict[str, Any]], default: int) -> int:
+    """按配置的num_ctx计算对话历史的token预算，没有配置时使用默认预算"""
+    num_ctx = (profile or {}).get('num_ctx')
+    return int(num_ctx * CONTEXT_BUDGET_RATIO) if num_ctx else default
+
+class TuneTrial:
+    """自动调优中一个参数组合的测试结果"""
+    __slots__ = ('options', 'tokens_per_second', 'ttft', 'prompt_tokens_per_second',
+                 'load_duration', 'error')
+
+    def __init__(self, options: Dict[str, int]) -> None:
+        self.options = options
+        self.tokens_per_second = 0.0
+        self.ttft: Optional[float] = None
+        self.prompt_tokens_per_second = 0.0
+        self.load_duration = 0.0  # 用该组合加载模型的时间，不计入测试结果
+        self.error = ""
+
+    def add_runs(self, runs: List[Any]) -> None:
+        """用若干次生成的GenerationMetrics计算平均值"""
+        self.tokens_per_second = sum(run.tokens_per_second for run in runs) / len(runs)
+        self.prompt_tokens_per_second = sum(run.prompt_tokens_per_second for run in runs) / len(runs)
+        ttfts = [run.ttft for run in runs if run.ttft is not None]
+        self.ttft = sum(ttfts) / len(ttfts) if ttfts else None
+
+    def describe(self) -> str:
+        settings = ", ".join(f"{key}={value}" for key, value in self.options.items())
+        if self.error:
+            return f"{settings}: {self.error}"
+        ttft = f"{self.ttft:.2f}秒" if self.ttft is not None else "-"
+        return f"{settings}: {self.tokens_per_second:.1f} tokens/秒, 首字延迟 {ttft}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'options': self.options, 'tokens_per_second': self.tokens_per_second, 'ttft': self.ttft,
+                'prompt_tokens_per_second': self.prompt_tokens_per_second,
+                'load_duration': self.load_duration, 'error': self.error}
+
+def pick_best(trials: List[TuneTrial], objective: str = OBJECTIVE_TOKENS_PER_SECOND) -> Optional[TuneTrial]:
+    """按调优目标选出最好的组合，全部失败时返回None"""
+    if objective == OBJECTIVE_TTFT:
+        valid = [trial for trial in trials if not trial.error and trial.ttft is not None]
+        return min(valid, key=lambda trial: trial.ttft) if valid else None
+    valid = [trial for trial in trials if not trial.error and trial.tokens_per_second > 0]
+    return max(valid, key=lambda trial: trial.tokens_per_second) if valid else None
+
+class ModelProfiles:
+    """按模型名称保存的请求参数，存放在JSON文件中，可以手动编辑
+
+    文件格式：{"模型名": {"options": {"num_thread": 8, ...}, "tuned": {自动调优的结果}}}
+    """
+
+    def __init__(self, path: str = MODEL_PROFILES_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self._profiles = json.load(f)
+
+    def get(self, model: str) -> Dict[str, Any]:
+        """模型的请求参数（可以在任意线程调用），没有配置时为空字典"""
+        with self._lock:
+            return dict(self._profiles.get(model, {}).get('options', {}))
+
+    def tuned(self, model: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._profiles.get(model, {}).get('tuned')
+
+    def models(self) -> List[str]:
+        with self._lock:
+            return sorted(self._profiles)
+
+    def set(self, model: str, options: Dict[str, Any],
+            tuned: Optional[Dict[str, Any]] = None) -> None:
+        """保存模型的参数，值为0或None的参数不保存（使用服务器默认值）"""
+        options = {key: value for key, value in options.items() if key in PROFILE_OPTIONS and value}
+        with self._lock:
+            profile = self._profiles.setdefault(model, {})
+            profile['options'] = options
+            if tuned is not None:
+                profile['tuned'] = tuned
+            if not options and 'tuned' not in profile:
+                del self._profiles[model]
+            self._save()
+
+    def _save(self) -> None:
+        # 先写入临时文件再替换，写入中途退出不会损坏原文件
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(self._profiles, f, ensure_ascii=False, indent=2)
+        os.replace(temporary, self.path)
+
+def tune_record(trials: List[TuneTrial], best: TuneTrial, objective: str) -> Dict[str, Any]:
+    """保存在模型配置中的自动调优记录"""
+    return {'objective': objective, 'tuned_at': time.time(), 'best': best.options,
+            'trials': [trial.to_dict() for trial in trials]}
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from ollama_engine import DEFAULT_SERVER_URL
+    from ollama_transport import StreamTransport
+
+    parser = argparse.ArgumentParser(description="Ollama AI Chat Tool 模型参数配置")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('show', help="显示所有模型的参数配置")
+    tune_parser = subparsers.add_parser('tune', help="自动调优num_thread和num_batch并保存")
+    tune_parser.add_argument('--model', required=True)
+    tune_parser.add_argument('--server', default=DEFAULT_SERVER_URL, help="Ollama服务器地址，多个地址用逗号分隔")
+    tune_parser.add_argument('--objective', choices=[OBJECTIVE_TOKENS_PER_SECOND, OBJECTIVE_TTFT],
+                             default=OBJECTIVE_TOKENS_PER_SECOND)
+    tune_parser.add_argument('--threads', help="逗号分隔的num_thread候选值，默认按CPU核心数选择")
+    tune_parser.add_argument('--batches', help="逗号分隔的num_batch候选值")
+    tune_parser.add_argument('--dry-run', action='store_true', help="只输出结果，不保存")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    profiles = ModelProfiles()
+    if args.command == 'show':
+        print(json.dumps({model: profiles.get(model) for model in profiles.models()},
+                         ensure_ascii=False, indent=2))
+        return 0
+
+    def parse_values(text: Optional[str]) -> Optional[List[int]]:
+        return [int(value) for value in text.split(',') if value.strip()] if text else None
+
+    grid = tune_grid(parse_values(args.threads), parse_values(args.batches))
+    finished = threading.Event()
+    outcome: Dict[str, Any] = {}
+
+    def on_done(request_id: int, trials: List[TuneTrial]) -> None:
+        outcome['trials'] = trials
+        finished.set()
+
+    def on_error(request_id: int, error: Exception) -> None:
+        outcome['error'] = error
+        finished.set()
+
+    transport = StreamTransport()
+    print(f"测试 {len(grid)} 个参数组合...", file=sys.stderr)
+    transport.tune(args.server, args.model, on_done, on_error, grid=grid,
+                   on_trial=lambda request_id, trial: print(trial.describe(), file=sys.stderr),
+                   base_options=profiles.get(args.model))
+    try:
+        finished.wait()
+    finally:
+        transport.close()
+    if 'error' in outcome:
+        logger.error(f"自动调优时出错: {str(outcome['error'])}")
+        return 1
+    best = pick_best(outcome['trials'], args.objective)
+    if best is None:
+        logger.error("所有参数组合都测试失败")
+        return 1
+    print(f"最佳组合: {best.describe()}")
+    if not args.dry_run:
+        profiles.set(args.model, dict(profiles.get(args.model), **best.options),
+                     tune_record(outcome['trials'], best, args.objective))
+        print(f"已保存到 {profiles.path}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,361 @@
+# Ollama AI Chat Tool 的本地文档检索：把本地文件切分成片段，通过Ollama的/api/embed计算向量，
+# 向量保存在内存映射的NumPy矩阵中，文件内容没有变化时不再重新计算；
+# 发送消息时按问题检索最相似的几个片段，只把这些片段放进提示词
+#
+# 需要安装NumPy（pip install numpy）和一个嵌入模型（ollama pull nomic-embed-text）
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import importlib.util
+from typing import List, Dict, Optional, Any, Tuple, Iterator
+
+# NumPy在第一次打开索引时才导入，不占用启动时间
+NUMPY_AVAILABLE = importlib.util.find_spec('numpy') is not None
+
+DOCUMENT_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".ollama_chat_tool", "documents")
+DEFAULT_EMBED_MODEL = "nomic-embed-text"
+CHUNK_CHARS = 1500  # 每个片段的最大字符数
+CHUNK_OVERLAP = 200  # 相邻片段重叠的字符数，避免句子被切断后检索不到
+EMBED_BATCH_SIZE = 32  # 每个/api/embed请求包含的片段数
+EMBED_CONCURRENCY = 4  # 同时进行的/api/embed请求数
+RAG_TOP_K = 4  # 每条消息注入的片段数
+RAG_MIN_SCORE = 0.3  # 余弦相似度低于该值的片段不注入，问题与文档无关时提示词不会变长
+VECTOR_GROWTH_ROWS = 1024  # 向量文件空间不足时至少扩展的行数
+COMPACT_DEAD_RATIO = 0.5  # 已删除的向量超过该比例时重写向量文件
+MAX_DOCUMENT_BYTES = 5 * 1024 * 1024  # 超过该大小的文件不索引
+# 按纯文本读取的文件类型
+DOCUMENT_SUFFIXES = ('.txt', '.md', '.markdown', '.rst', '.py', '.js', '.ts', '.java', '.c', '.cpp', '.h',
+                     '.go', '.rs', '.json', '.yaml', '.yml', '.toml', '.ini', '.cfg', '.csv', '.html',
+                     '.xml', '.sql', '.sh')
+
+logger = logging.getLogger(__name__)
+
+def chunk_text(text: str, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """把文本切分成不超过size个字符的片段，优先在空行处切分，其次在换行处"""
+    chunks: List[str] = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # 在片段的后半部分寻找合适的切分位置
+            for separator in ("\n\n", "\n", " "):
+                cut = text.rfind(separator, start + size // 2, end)
+                if cut > 0:
+                    end = cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+def content_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_document(path: str) -> str:
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+def iter_documents(source: str) -> Iterator[str]:
+    """一个来源（文件或文件夹）中可以索引的文件，跳过隐藏目录"""
+    if os.path.isfile(source):
+        yield os.path.abspath(source)
+        return
+    for root, directories, files in os.walk(source):
+        directories[:] = sorted(name for name in directories if not name.startswith('.'))
+        for name in sorted(files):
+            if name.lower().endswith(DOCUMENT_SUFFIXES):
+                yield os.path.abspath(os.path.join(root, name))
+
+def build_rag_prompt(prompt: str, chunks: List[Dict[str, Any]]) -> str:
+    """把检索到的片段放在问题前面，标注来源文件"""
+    if not chunks:
+        return prompt
+    parts = ["请参考下面的资料回答问题，资料与问题无关时忽略资料。", ""]
+    for number, chunk in enumerate(chunks, 1):
+        parts += [f"[{number}] {os.path.basename(chunk['path'])}", chunk['text'], ""]
+    parts += [f"问题：{prompt}"]
+    return "\n".join(parts)
+
+class FileChange:
+    """需要重新索引的文件"""
+    __slots__ = ('path', 'hash', 'size', 'mtime')
+
+    def __init__(self, path: str, hash: str, size: int, mtime: float) -> None:
+        self.path = path
+        self.hash = hash
+        self.size = size
+        self.mtime = mtime
+
+class DocumentIndex:
+    """文档片段的向量索引
+
+    片段文本和文件信息保存在SQLite中，向量保存在vectors.f32中（按行存放的float32矩阵，
+    通过numpy.memmap访问，已经归一化，点积即余弦相似度）。删除的片段只标记为无效，
+    无效的行过多时重写整个文件。可以在任意线程调用。
+    """
+
+    def __init__(self, directory: str = DOCUMENT_INDEX_DIR) -> None:
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("文档检索需要安装NumPy: pip install numpy")
+        import numpy as np
+        self._np = np
+        self.directory = directory
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self.vector_path = os.path.join(directory, "vectors.f32")
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite3"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY);"
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY, hash TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL,"
+            " indexed REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " row INTEGER PRIMARY KEY, path TEXT NOT NULL, seq INTEGER NOT NULL, text TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path);"
+        )
+        self._db.commit()
+        self.dimension = int(self.setting('dimension', '0'))
+        self.rows = int(self.setting('rows', '0'))  # 已使用的行数（包括已删除的行）
+        self._vectors: Optional[Any] = None
+        self._live = np.zeros(0, dtype=bool)
+        self._open_vectors()
+
+    def setting(self, key: str, default: str = "") -> str:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+            self._db.commit()
+
+    def _open_vectors(self) -> None:
+        """映射向量文件，并按chunks表标记有效的行"""
+        np = self._np
+        self._vectors = None
+        capacity = 0
+        if self.dimension and os.path.exists(self.vector_path):
+            capacity = os.path.getsize(self.vector_path) // (4 * self.dimension)
+        if capacity:
+            self._vectors = np.memmap(self.vector_path, dtype=np.float32, mode='r+',
+                                      shape=(capacity, self.dimension))
+        self._live = np.zeros(capacity, dtype=bool)
+        rows = [row for (row,) in self._db.execute("SELECT row FROM chunks WHERE row < ?", (capacity,))]
+        self._live[rows] = True
+
+    def _reserve(self, count: int) -> None:
+        """保证向量文件还能再写入count行，不够时扩展文件后重新映射"""
+        capacity = len(self._live)
+        if self.rows + count <= capacity:
+            return
+        capacity = max(capacity * 2, self.rows + count, VECTOR_GROWTH_ROWS)
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self.vector_path, 'ab') as f:
+            f.truncate(capacity * self.dimension * 4)
+        self._open_vectors()
+
+    # 来源
+
+    def sources(self) -> List[str]:
+        with self._lock:
+            return [path for (path,) in self._db.execute("SELECT path FROM sources ORDER BY path")]
+
+    def add_source(self, path: str) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO sources VALUES (?)", (os.path.abspath(path),))
+            self._db.commit()
+
+    def remove_source(self, path: str) -> None:
+        """移除来源，其中的文件在下次更新索引时删除"""
+        with self._lock:
+            self._db.execute("DELETE FROM sources WHERE path = ?", (path,))
+            self._db.commit()
+
+    # 增量更新
+
+    def scan(self, embed_model: str) -> Tuple[List[FileChange], List[str]]:
+        """找出需要重新索引的文件和需要删除的文件
+
+        大小和修改时间都没有变化的文件直接跳过；变化了的文件再比较内容哈希，
+        内容相同（例如只是被touch）时只更新记录的修改时间。
+        嵌入模型改变后所有向量都需要重新计算。
+        """
+        if self.setting('embed_model') != embed_model:
+            self.clear()
+            self.set_setting('embed_model', embed_model)
+        with self._lock:
+            known = {path: (file_hash, size, mtime) for path, file_hash, size, mtime
+                     in self._db.execute("SELECT path, hash, size, mtime FROM files")}
+        changed: List[FileChange] = []
+        seen = set()
+        for source in self.sources():
+            for path in iter_documents(source):
+                if path in seen:
+                    continue
+                seen.add(path)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_size > MAX_DOCUMENT_BYTES:
+                        continue
+                    old = known.get(path)
+                    if old is not None and old[1] == stat.st_size and old[2] == stat.st_mtime:
+                        continue
+                    file_hash = content_hash(path)
+                except OSError as e:
+                    logger.warning(f"读取文件 {path} 时出错: {str(e)}")
+                    continue
+                if old is not None and old[0] == file_hash:
+                    with self._lock:
+                        self._db.execute("UPDATE files SET size = ?, mtime = ? WHERE path = ?",
+                                         (stat.st_size, stat.st_mtime, path))
+                        self._db.commit()
+                    continue
+                changed.append(FileChange(path, file_hash, stat.st_size, stat.st_mtime))
+        removed = [path for path in known if path not in seen]
+        return changed, removed
+
+    def replace_file(self, change: FileChange, chunks: List[str], vectors: Any) -> None:
+        """用新的片段和向量替换一个文件的索引，向量先写入磁盘再提交数据库"""
+        np = self._np
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(chunks):
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            if len(chunks) and not self.dimension:
+                self.dimension = vectors.shape[1]
+                self.set_setting('dimension', self.dimension)
+            elif len(chunks) and vectors.shape[1] != self.dimension:
+                raise ValueError(f"向量维度 {vectors.shape[1]} 与索引的维度 {self.dimension} 不一致")
+            self._delete_rows(change.path)
+            start = self.rows
+            if len(chunks):
+                self._reserve(len(chunks))
+                self._vectors[start:start + len(chunks)] = vectors
+                self._vectors.flush()
+                self._live[start:start + len(chunks)] = True
+                self.rows += len(chunks)
+            self._db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)",
+                                 [(start + seq, change.path, seq, text) for seq, text in enumerate(chunks)])
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                             (change.path, change.hash, change.size, change.mtime, time.time()))
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('rows', ?)", (str(self.rows),))
+            self._db.commit()
+
+    def remove_file(self, path: str) -> None:
+        with self._lock:
+            self._delete_rows(path)
+            self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+            self._db.commit()
+
+    def _delete_rows(self, path: str) -> None:
+        rows = [row for (row,) in self._db.execute("SELECT row FROM chunks WHERE path = ?", (path,))]
+        self._live[rows] = False
+        self._db.execute("DELETE FROM chunks WHERE path = ?", (path,))
+
+    @property
+    def dead_ratio(self) -> float:
+        with self._lock:
+            return 1 - int(self._live[:self.rows].sum()) / self.rows if self.rows else 0.0
+
+    def compact(self) -> None:
+        """把有效的向量移动到文件开头，去掉已删除的行"""
+        np = self._np
+        with self._lock:
+            rows = [row for (row,) in self._db.execute("SELECT row FROM chunks ORDER BY row")]
+            if self._vectors is not None and rows:
+                self._vectors[:len(rows)] = self._vectors[np.array(rows)]
+                self._vectors.flush()
+            self._db.execute("CREATE TEMP TABLE remap (old INTEGER PRIMARY KEY, new INTEGER)")
+            self._db.executemany("INSERT INTO temp.remap VALUES (?, ?)",
+                                 [(row, new) for new, row in enumerate(rows)])
+            # 先移到负数再移回，避免与还没有移动的行号冲突
+            self._db.execute("UPDATE chunks SET row = -1 - (SELECT new FROM temp.remap WHERE old = chunks.row)")
+            self._db.execute("UPDATE chunks SET row = -1 - row")
+            self._db.execute("DROP TABLE temp.remap")
+            self.rows = len(rows)
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('rows', ?)", (str(self.rows),))
+            self._db.commit()
+            self._live[:] = False
+            self._live[:self.rows] = True
+
+    def clear(self) -> None:
+        """删除所有文件、片段和向量，保留来源"""
+        with self._lock:
+            self._db.execute("DELETE FROM files")
+            self._db.execute("DELETE FROM chunks")
+            self._db.execute("DELETE FROM meta WHERE key IN ('rows', 'dimension')")
+            self._db.commit()
+            self._vectors = None
+            if os.path.exists(self.vector_path):
+                os.remove(self.vector_path)
+            self.rows = self.dimension = 0
+            self._open_vectors()
+
+    # 检索
+
+    def search(self, query: Any, top_k: int = RAG_TOP_K,
+               min_score: float = RAG_MIN_SCORE) -> List[Dict[str, Any]]:
+        """返回与查询向量最相似的top_k个片段（按相似度从高到低）"""
+        np = self._np
+        with self._lock:
+            if not self.rows or self._vectors is None:
+                return []
+            query = np.asarray(query, dtype=np.float32)
+            if query.shape[0] != self.dimension:
+                raise ValueError(f"查询向量维度 {query.shape[0]} 与索引的维度 {self.dimension} 不一致")
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            scores = self._vectors[:self.rows] @ query
+            scores[~self._live[:self.rows]] = -np.inf
+            count = min(top_k, self.rows)
+            best = np.argpartition(-scores, count - 1)[:count]
+            best = best[np.argsort(-scores[best])]
+            results = []
+            for row in best:
+                score = float(scores[row])
+                if score < min_score:
+                    break
+                path, seq, text = self._db.execute(
+                    "SELECT path, seq, text FROM chunks WHERE row = ?", (int(row),)
+                ).fetchone()
+                results.append({'path': path, 'seq': seq, 'text': text, 'score': score})
+            return results
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            files = self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            chunks = self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        return {'files': files, 'chunks': chunks, 'rows': self.rows, 'dimension': self.dimension,
+                'bytes': len(self._live) * self.dimension * 4}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._vectors = None
+            self._db.close()
+
+class RetrievalSettings:
+    """发送消息时的检索参数"""
+
+    def __init__(self, index: DocumentIndex, embed_model: str = DEFAULT_EMBED_MODEL,
+                 top_k: int = RAG_TOP_K, min_score: float = RAG_MIN_SCORE) -> None:
+        self.index = index
+        self.embed_model = embed_model
+        self.top_k = top_k
+        self.min_score = min_score
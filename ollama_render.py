@@ -0,0 +1,103 @@
+# Ollama AI Chat Tool 的markdown渲染：消息在后台线程中转换为HTML，安装了Pygments时高亮代码块；
+# 流式输出时已经完整的段落只渲染一次，之后只重新渲染最后一段（包括还没有闭合的代码块）
+
+import re
+import html
+import threading
+import importlib.util
+from typing import Optional, Any
+
+# markdown和Pygments在第一次渲染时（在渲染线程中）才导入，不占用启动时间
+HIGHLIGHT_AVAILABLE = importlib.util.find_spec('pygments') is not None
+
+RENDER_WORKERS = 2  # 后台渲染线程数
+MARKDOWN_EXTENSIONS = ['fenced_code', 'tables']
+HIGHLIGHT_STYLE = 'monokai'  # Pygments配色，与深色背景搭配
+HIGHLIGHT_CSS_CLASS = 'codehilite'
+
+# 代码块的开始/结束标记：行首最多3个空格，3个以上的`或~
+FENCE_RE = re.compile(r' {0,3}(`{3,}|~{3,})')
+
+# markdown.Markdown实例不是线程安全的，每个渲染线程使用自己的实例
+_local = threading.local()
+
+def _converter(highlight: bool) -> Any:
+    name = 'highlight' if highlight else 'plain'
+    converter = getattr(_local, name, None)
+    if converter is None:
+        import markdown
+        extensions = list(MARKDOWN_EXTENSIONS)
+        configs = {}
+        if highlight:
+            extensions.append('codehilite')
+            configs['codehilite'] = {'guess_lang': False, 'css_class': HIGHLIGHT_CSS_CLASS}
+        converter = markdown.Markdown(extensions=extensions, extension_configs=configs)
+        setattr(_local, name, converter)
+    return converter
+
+def render_markdown(text: str, highlight: bool = HIGHLIGHT_AVAILABLE) -> str:
+    """把markdown转换为HTML（可在任意线程调用）"""
+    return _converter(highlight and HIGHLIGHT_AVAILABLE).reset().convert(text)
+
+def render_placeholder(text: str) -> str:
+    """渲染完成前显示的纯文本"""
+    return f'<div class="rendering">{html.escape(text)}</div>'
+
+def highlight_css() -> str:
+    """代码高亮的样式表，没有安装Pygments时为空"""
+    if not HIGHLIGHT_AVAILABLE:
+        return ""
+    from pygments.formatters import HtmlFormatter
+    return HtmlFormatter(style=HIGHLIGHT_STYLE).get_style_defs(f'.{HIGHLIGHT_CSS_CLASS}')
+
+class StreamingDocument:
+    """一条正在生成的消息的增量渲染状态
+
+    文本只会在末尾追加，代码块之外的空行之前的内容不会再变化，渲染一次后保存下来；
+    每次只渲染最后一个空行之后的部分。同一时间只能在一个线程中使用。
+    """
+
+    def __init__(self, highlight: bool = HIGHLIGHT_AVAILABLE) -> None:
+        self.highlight = highlight
+        self.reset()
+
+    def reset(self) -> None:
+        self.stable = 0  # 已经渲染并保存的前缀长度
+        self.stable_html = ""
+        self._scanned = 0  # 已经扫描过的位置，总在行首
+        self._boundary = 0  # 最后一个代码块之外的空行的结束位置
+        self._fence: Optional[str] = None  # 当前所在代码块的开始标记，不在代码块中时为None
+        self._seen = ""  # 已经扫描过的文本
+
+    def _scan(self, text: str) -> None:
+        """扫描新增的完整行，记录代码块状态和最后一个可以切分的位置"""
+        while True:
+            end = text.find('\n', self._scanned)
+            if end < 0:
+                return
+            line = text[self._scanned:end]
+            self._scanned = end + 1
+            match = FENCE_RE.match(line)
+            if self._fence is None:
+                if match:
+                    self._fence = match.group(1)
+                elif not line.strip():
+                    self._boundary = self._scanned
+            elif (match and match.group(1)[0] == self._fence[0]
+                  and len(match.group(1)) >= len(self._fence) and not line[match.end():].strip()):
+                self._fence = None
+
+    def render(self, text: str) -> str:
+        if not text.startswith(self._seen):
+            # 已经扫描过的部分发生了变化（例如标签后的分隔符改变），从头开始
+            self.reset()
+        self._scan(text)
+        self._seen = text[:self._scanned]
+        if self._boundary > self.stable:
+            self.stable_html += render_markdown(text[self.stable:self._boundary], self.highlight)
+            self.stable = self._boundary
+        tail = text[self.stable:]
+        if self._fence is not None:
+            # 未闭合的代码块临时补上结束标记，正在输出的代码也按代码块显示
+            tail += ('' if tail.endswith('\n') else '\n') + self._fence
+        return self.stable_html + render_markdown(tail, self.highlight)
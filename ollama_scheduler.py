@@ -0,0 +1,126 @@
+# Ollama AI Chat Tool 的请求调度：每个会话一个先进先出队列，每个服务器/模型有并发上限，
+# 用户发送的消息优先于摘要等后台任务；在传输层的事件循环中使用
+
+import time
+import asyncio
+import itertools
+import threading
+import contextlib
+from collections import deque
+from typing import Dict, Optional, Any, Hashable, AsyncIterator, Set
+
+PRIORITY_INTERACTIVE = 0  # 用户发送的消息
+PRIORITY_BACKGROUND = 1  # 摘要、预热等后台任务
+SLOTS_PER_MODEL = 1  # 每个端点上同一模型同时进行的请求数，与服务器的OLLAMA_NUM_PARALLEL对应
+
+class ScheduledRequest:
+    """调度队列中的一个请求"""
+    __slots__ = ('request_id', 'queue_key', 'slot_key', 'slots', 'priority', 'seq',
+                 'enqueued', 'future', 'granted')
+
+    def __init__(self, request_id: int, queue_key: Hashable, slot_key: Hashable,
+                 slots: int, priority: int, seq: int) -> None:
+        self.request_id = request_id
+        self.queue_key = queue_key
+        self.slot_key = slot_key
+        self.slots = slots
+        self.priority = priority
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self.granted = False
+
+class RequestScheduler:
+    """在传输层的事件循环中决定请求的执行顺序
+
+    同一个会话的请求按提交顺序逐个执行；不同会话之间按优先级和提交顺序选择，
+    前提是目标服务器/模型还有空闲的并发槽位。调度只在事件循环线程中进行，
+    snapshot可以在任意线程中调用。
+    """
+
+    def __init__(self, max_active: int) -> None:
+        self.max_active = max_active
+        self._queues: Dict[Hashable, "deque[ScheduledRequest]"] = {}
+        self._busy_queues: Set[Hashable] = set()
+        self._running: Dict[Hashable, int] = {}
+        self._active = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, request_id: int, queue_key: Optional[Hashable], slot_key: Hashable,
+                   slots: int = SLOTS_PER_MODEL,
+                   priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[float]:
+        """排队等待执行，得到槽位后返回排队时间（秒），退出时释放槽位"""
+        if queue_key is None:
+            queue_key = ('request', request_id)
+        request = ScheduledRequest(request_id, queue_key, slot_key, max(1, slots),
+                                   priority, next(self._seq))
+        with self._lock:
+            self._queues.setdefault(queue_key, deque()).append(request)
+        self._dispatch()
+        try:
+            await request.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if not request.granted:
+                    queue = self._queues.get(queue_key)
+                    if queue is not None and request in queue:
+                        queue.remove(request)
+                        if not queue:
+                            del self._queues[queue_key]
+            if request.granted:
+                self._release(request)
+            self._dispatch()
+            raise
+        try:
+            yield time.monotonic() - request.enqueued
+        finally:
+            self._release(request)
+            self._dispatch()
+
+    def _release(self, request: ScheduledRequest) -> None:
+        with self._lock:
+            self._active -= 1
+            self._running[request.slot_key] -= 1
+            self._busy_queues.discard(request.queue_key)
+
+    def _dispatch(self) -> None:
+        """把空闲的槽位分配给可以执行的请求中优先级最高、提交最早的一个"""
+        with self._lock:
+            while self._active < self.max_active:
+                best: Optional[ScheduledRequest] = None
+                for key, queue in self._queues.items():
+                    if key in self._busy_queues:
+                        continue
+                    head = queue[0]
+                    if self._running.get(head.slot_key, 0) >= head.slots:
+                        continue
+                    if best is None or (head.priority, head.seq) < (best.priority, best.seq):
+                        best = head
+                if best is None:
+                    return
+                queue = self._queues[best.queue_key]
+                queue.popleft()
+                if not queue:
+                    del self._queues[best.queue_key]
+                if best.future.done():
+                    # 请求已被取消，等待中的任务会自己处理
+                    continue
+                self._busy_queues.add(best.queue_key)
+                self._running[best.slot_key] = self._running.get(best.slot_key, 0) + 1
+                self._active += 1
+                best.granted = True
+                best.future.set_result(None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """当前排队和执行中的请求数，以及排队最久的请求已等待的时间（秒）"""
+        now = time.monotonic()
+        with self._lock:
+            waiting = [request for queue in self._queues.values() for request in queue]
+            return {
+                'queued': len(waiting),
+                'queued_interactive': sum(1 for r in waiting if r.priority == PRIORITY_INTERACTIVE),
+                'running': self._active,
+                'oldest_wait': max((now - r.enqueued for r in waiting), default=0.0)
+            }
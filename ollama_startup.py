@@ -0,0 +1,24 @@
+# Ollama AI Chat Tool 的启动计时：使用 --profile-startup 参数运行时记录导入和初始化各阶段的耗时，
+# 页面加载完成后输出到标准错误并退出。单个模块的导入耗时可以用 python -X importtime 查看
+
+import sys
+import time
+from typing import List, Tuple
+
+PROFILE_STARTUP = '--profile-startup' in sys.argv
+
+_marks: List[Tuple[str, float]] = [("程序开始", time.perf_counter())]
+
+def mark(name: str) -> None:
+    """记录一个阶段结束的时间"""
+    if PROFILE_STARTUP:
+        _marks.append((name, time.perf_counter()))
+
+def report() -> str:
+    """每个阶段的耗时和从程序开始的累计时间"""
+    start = _marks[0][1]
+    lines = ["启动耗时:"]
+    for (_, previous), (name, moment) in zip(_marks, _marks[1:]):
+        lines.append(f"  {name:<16} {(moment - previous) * 1000:8.1f} 毫秒"
+                     f"    累计 {(moment - start) * 1000:8.1f} 毫秒")
+    return "\n".join(lines)
@@ -0,0 +1,262 @@
+# Ollama AI Chat Tool 的会话存储：对话保存在SQLite中，流式回答在后台线程中分批增量写入，
+# 支持分页加载历史消息和FTS5全文搜索
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Any
+
+CONVERSATION_DB_PATH = os.path.join(os.path.expanduser("~"), ".ollama_chat_tool", "conversations.sqlite3")
+HISTORY_PAGE_SIZE = 50  # 打开会话或向上滚动时每次加载的消息条数
+CONVERSATION_TITLE_LENGTH = 30  # 用第一条用户消息作为会话标题时截取的长度
+FTS_MIN_QUERY_LENGTH = 3  # trigram分词的最短查询词长度，包含更短的词时使用LIKE
+STREAM_FLUSH_CHARS = 16 * 1024  # 流式回答在内存中累积到该字符数时写入数据库
+STREAM_FLUSH_INTERVAL = 2.0  # 距离上次写入超过该时间（秒）时也写入，程序崩溃时最多丢失这段时间的内容
+
+logger = logging.getLogger(__name__)
+
+class StreamBuffer:
+    """一条正在生成的消息中还没有写入数据库的数据块"""
+    __slots__ = ('chunks', 'chars', 'flushed')
+
+    def __init__(self, now: float) -> None:
+        self.chunks: List[str] = []
+        self.chars = 0
+        self.flushed = now
+
+class ConversationStore:
+    """基于SQLite的会话存储
+
+    WAL模式加synchronous=NORMAL，提交不需要等待磁盘同步。流式回答的数据块先在内存中
+    累积，达到一定大小或间隔时才交给后台线程追加到数据库，避免每个数据块都在界面线程中
+    重写一次越来越长的行；消息完成时一次写入完整内容。
+    全文索引只在消息完成时写入一次，避免流式更新时反复重建索引。
+    """
+
+    def __init__(self, path: str = CONVERSATION_DB_PATH,
+                 flush_interval: float = STREAM_FLUSH_INTERVAL,
+                 flush_chars: int = STREAM_FLUSH_CHARS) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_chars = flush_chars
+        self._lock = threading.Lock()
+        # 同一条消息的append_chunk和finish_message需要在同一个线程中调用（界面线程）
+        self._pending: Dict[int, StreamBuffer] = {}
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-store")
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            " id INTEGER PRIMARY KEY, title TEXT NOT NULL, model TEXT NOT NULL DEFAULT '',"
+            " created REAL NOT NULL, updated REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL, seq INTEGER NOT NULL,"
+            " role TEXT NOT NULL, model TEXT NOT NULL DEFAULT '', content TEXT NOT NULL,"
+            " meta TEXT NOT NULL DEFAULT '{}', done INTEGER NOT NULL DEFAULT 1,"
+            " created REAL NOT NULL,"
+            " UNIQUE (conversation_id, seq));"
+            "CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);"
+        )
+        self.fts_enabled = self._create_fts()
+        self._db.commit()
+
+    def _create_fts(self) -> bool:
+        """创建全文索引表；SQLite不支持FTS5或trigram分词时退回到LIKE搜索"""
+        try:
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts"
+                " USING fts5(content, tokenize='trigram')"
+            )
+            return True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite不支持FTS5全文搜索，使用LIKE代替: {str(e)}")
+            return False
+
+    def create_conversation(self, title: str, model: str = "") -> int:
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO conversations (title, model, created, updated) VALUES (?, ?, ?, ?)",
+                (title[:CONVERSATION_TITLE_LENGTH], model, now, now)
+            )
+            self._db.commit()
+            return cursor.lastrowid
+
+    def append_message(self, conversation_id: int, role: str, content: str,
+                       model: str = "", done: bool = True,
+                       meta: Optional[Dict[str, Any]] = None) -> int:
+        """追加一条消息，返回消息ID；流式回答先以done=False写入，之后逐块追加"""
+        now = time.time()
+        with self._lock:
+            seq = self._db.execute(
+                "SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE conversation_id = ?",
+                (conversation_id,)
+            ).fetchone()[0]
+            cursor = self._db.execute(
+                "INSERT INTO messages (conversation_id, seq, role, model, content, meta, done, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (conversation_id, seq, role, model, content,
+                 json.dumps(meta or {}, ensure_ascii=False), int(done), now)
+            )
+            self._db.execute(
+                "UPDATE conversations SET updated = ?, model = CASE WHEN ? != '' THEN ? ELSE model END"
+                " WHERE id = ?",
+                (now, model, model, conversation_id)
+            )
+            if done:
+                self._index(cursor.lastrowid, content)
+            self._db.commit()
+            return cursor.lastrowid
+
+    def append_chunk(self, message_id: int, text: str, now: Optional[float] = None) -> None:
+        """把一个合并后的数据块追加到正在生成的消息末尾，累积到一定大小或间隔时在后台写入"""
+        now = time.monotonic() if now is None else now
+        buffer = self._pending.get(message_id)
+        if buffer is None:
+            buffer = self._pending[message_id] = StreamBuffer(now)
+        buffer.chunks.append(text)
+        buffer.chars += len(text)
+        if buffer.chars >= self.flush_chars or now - buffer.flushed >= self.flush_interval:
+            self._flush_buffer(message_id, buffer, now)
+
+    def _flush_buffer(self, message_id: int, buffer: StreamBuffer, now: float) -> None:
+        if not buffer.chunks:
+            return
+        text = "".join(buffer.chunks)
+        buffer.chunks.clear()
+        buffer.chars = 0
+        buffer.flushed = now
+        self._writer.submit(self._write_chunk, message_id, text)
+
+    def _write_chunk(self, message_id: int, text: str) -> None:
+        try:
+            with self._lock:
+                # 消息已经完成时finish_message写入了完整内容，不再追加
+                self._db.execute(
+                    "UPDATE messages SET content = content || ? WHERE id = ? AND done = 0",
+                    (text, message_id)
+                )
+                self._db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"保存回答时出错: {str(e)}")
+
+    def flush(self) -> None:
+        """把内存中的数据块全部写入数据库并等待写入完成"""
+        now = time.monotonic()
+        for message_id, buffer in list(self._pending.items()):
+            self._flush_buffer(message_id, buffer, now)
+        self._writer.submit(lambda: None).result()
+
+    def finish_message(self, message_id: int, content: str,
+                       meta: Optional[Dict[str, Any]] = None) -> None:
+        """写入完整的回答和统计信息，并加入全文索引"""
+        self._pending.pop(message_id, None)
+        with self._lock:
+            self._db.execute(
+                "UPDATE messages SET content = ?, meta = ?, done = 1 WHERE id = ?",
+                (content, json.dumps(meta or {}, ensure_ascii=False), message_id)
+            )
+            self._index(message_id, content)
+            self._db.commit()
+
+    def _index(self, message_id: int, content: str) -> None:
+        if self.fts_enabled:
+            self._db.execute(
+                "INSERT OR REPLACE INTO messages_fts (rowid, content) VALUES (?, ?)",
+                (message_id, content)
+            )
+
+    def load_page(self, conversation_id: int, before_seq: Optional[int] = None,
+                  limit: int = HISTORY_PAGE_SIZE) -> List[Dict[str, Any]]:
+        """按时间顺序返回before_seq之前的最近limit条消息，不指定时返回最新的一页"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, seq, role, model, content, meta, done, created FROM messages"
+                " WHERE conversation_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (conversation_id, before_seq if before_seq is not None else 2 ** 62, limit)
+            ).fetchall()
+        return [self._message_dict(row) for row in reversed(rows)]
+
+    def message_seq(self, message_id: int) -> Optional[int]:
+        """消息在会话中的序号，用于从这条消息之前继续分页加载"""
+        with self._lock:
+            row = self._db.execute("SELECT seq FROM messages WHERE id = ?", (message_id,)).fetchone()
+        return row['seq'] if row else None
+
+    @staticmethod
+    def _message_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        message = dict(row)
+        message['meta'] = json.loads(message['meta'] or '{}')
+        message['done'] = bool(message['done'])
+        return message
+
+    def list_conversations(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """按最近更新时间列出会话"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, title, model, created, updated FROM conversations"
+                " ORDER BY updated DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_conversation(self, conversation_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, title, model, created, updated FROM conversations WHERE id = ?",
+                (conversation_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def search(self, query: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """全文搜索所有会话中的消息，返回会话信息和匹配片段"""
+        query = query.strip()
+        if not query:
+            return []
+        with self._lock:
+            if self.fts_enabled and all(len(term) >= FTS_MIN_QUERY_LENGTH for term in query.split()):
+                # 每个词用双引号包起来，避免用户输入被当作FTS5查询语法
+                match = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+                rows = self._db.execute(
+                    "SELECT m.id AS message_id, m.conversation_id, m.seq, c.title, c.updated,"
+                    " snippet(messages_fts, 0, '[', ']', '…', 12) AS snippet"
+                    " FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+                    " JOIN conversations c ON c.id = m.conversation_id"
+                    " WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?",
+                    (match, limit)
+                ).fetchall()
+            else:
+                pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                rows = self._db.execute(
+                    "SELECT m.id AS message_id, m.conversation_id, m.seq, c.title, c.updated,"
+                    " substr(m.content, 1, 80) AS snippet"
+                    " FROM messages m JOIN conversations c ON c.id = m.conversation_id"
+                    " WHERE m.content LIKE ? ESCAPE '\\' ORDER BY c.updated DESC LIMIT ?",
+                    (pattern, limit)
+                ).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_conversation(self, conversation_id: int) -> None:
+        """删除会话及其全部消息和搜索索引"""
+        with self._lock:
+            if self.fts_enabled:
+                self._db.execute(
+                    "DELETE FROM messages_fts WHERE rowid IN"
+                    " (SELECT id FROM messages WHERE conversation_id = ?)", (conversation_id,)
+                )
+            self._db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self._db.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            self._db.commit()
+
+    def close(self) -> None:
+        self.flush()
+        self._writer.shutdown()
+        with self._lock:
+            self._db.close()
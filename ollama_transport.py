@@ -0,0 +1,868 @@
+# Ollama AI Chat Tool 的异步传输层：所有生成请求在同一个专用线程的asyncio事件循环中复用，
+# 每个请求有自己的请求ID，结果通过回调按ID分发，不再为每条消息创建一个线程
+
+import ssl
+import json
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+import concurrent.futures
+from urllib.parse import urlsplit
+from typing import List, Dict, Optional, Any, Tuple, Callable, Awaitable, AsyncIterator, Hashable
+
+from ollama_engine import (CHUNK_FLUSH_INTERVAL, CHUNK_FLUSH_CHARS, CONNECT_TIMEOUT, READ_TIMEOUT,
+                           HTTP_POOL_SIZE, OllamaError, OllamaResponseError, GenerationCancelled,
+                           EndpointConnectError, is_connect_error,
+                           ChatEngine, Endpoint, EndpointPool, Conversation, GenerationMetrics,
+                           GenerationResult, ChunkCoalescer, StreamAccumulator, build_request,
+                           build_complete_request, describe_error_response, model_context_length)
+from ollama_cache import ResponseCache, ModelCatalogue
+from ollama_profiles import TUNE_PROMPT, TUNE_TOKENS, TUNE_RUNS, TuneTrial, tune_grid
+from ollama_rag import (EMBED_BATCH_SIZE, EMBED_CONCURRENCY, COMPACT_DEAD_RATIO, DocumentIndex,
+                        RetrievalSettings, chunk_text, read_document, build_rag_prompt)
+from ollama_scheduler import (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND, SLOTS_PER_MODEL,
+                              RequestScheduler)
+
+TRANSPORT_MAX_STREAMS = 16  # 事件循环中同时进行的请求数上限，超出的请求由调度器排队
+READ_BLOCK_SIZE = 64 * 1024  # 读取非分块响应体时每次读取的字节数
+MODEL_SHOW_CONCURRENCY = 4  # 刷新模型列表时同时进行的/api/show请求数
+MODEL_CATALOGUE_TIMEOUT = 15  # 刷新模型列表的总超时（秒），服务器无响应时不会一直等待
+
+# 连接失败或流在开始输出前中断时，可以换一个端点重试
+ASYNC_FAILOVER_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+logger = logging.getLogger(__name__)
+
+class AsyncResponse:
+    """一个HTTP/1.1响应，响应体按分块编码、Content-Length或读到连接关闭三种方式读取"""
+
+    def __init__(self, reader: asyncio.StreamReader, status_code: int,
+                 headers: Dict[str, str]) -> None:
+        self.reader = reader
+        self.status_code = status_code
+        self.headers = headers
+        self.consumed = False
+        self._body: Optional[bytes] = None
+        self._loop = asyncio.get_running_loop()
+        self._reading = False
+        self._read_started = 0.0
+        self._watchdog: Optional[asyncio.TimerHandle] = None
+        # 有Content-Length时记录还没有读取的字节数，中途停止后再次读取从停下的位置继续
+        self._remaining: Optional[int] = (int(headers['content-length'])
+                                          if 'content-length' in headers else None)
+
+    @property
+    def reusable(self) -> bool:
+        """响应体已完整读取且服务器没有要求关闭连接时，连接可以放回连接池"""
+        return self.consumed and self.headers.get('connection', '').lower() != 'close' and self.framed
+
+    @property
+    def framed(self) -> bool:
+        """响应体有Content-Length或分块编码，不需要读到连接关闭"""
+        return self._remaining is not None or self._chunked
+
+    @property
+    def _chunked(self) -> bool:
+        return 'chunked' in self.headers.get('transfer-encoding', '').lower()
+
+    async def _read(self, coroutine: Any) -> Any:
+        """读取超时由一个定时器检查，不为每一行数据单独创建超时任务"""
+        self._reading = True
+        self._read_started = self._loop.time()
+        if self._watchdog is None:
+            self._watchdog = self._loop.call_at(self._read_started + READ_TIMEOUT, self._check_idle)
+        try:
+            return await coroutine
+        finally:
+            self._reading = False
+
+    def _check_idle(self) -> None:
+        """定时器到期：当前读取已等待超过READ_TIMEOUT时让它抛出超时，否则推迟到它的截止时间"""
+        self._watchdog = None
+        if not self._reading:
+            # 没有进行中的读取，下一次读取时重新启动定时器
+            return
+        deadline = self._read_started + READ_TIMEOUT
+        if self._loop.time() >= deadline:
+            self.reader.set_exception(asyncio.TimeoutError(f"{READ_TIMEOUT}秒内没有收到数据"))
+        else:
+            self._watchdog = self._loop.call_at(deadline, self._check_idle)
+
+    def close(self) -> None:
+        """停止超时定时器，连接放回连接池后不能再影响它的reader"""
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    async def iter_raw(self) -> AsyncIterator[bytes]:
+        """逐块读取响应体，可以多次调用（例如读到最后一行后读完剩余部分）"""
+        if self.consumed:
+            return
+        if self._chunked:
+            while True:
+                size_line = await self._read(self.reader.readuntil(b"\n"))
+                size = int(size_line.split(b";")[0].strip(), 16)
+                if size == 0:
+                    # 跳过可能存在的trailer头
+                    while (await self._read(self.reader.readuntil(b"\n"))).strip():
+                        pass
+                    break
+                data = await self._read(self.reader.readexactly(size + 2))
+                yield data[:-2]
+        elif self._remaining is not None:
+            while self._remaining > 0:
+                data = await self._read(self.reader.readexactly(min(self._remaining, READ_BLOCK_SIZE)))
+                self._remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = await self._read(self.reader.read(READ_BLOCK_SIZE))
+                if not data:
+                    break
+                yield data
+        self.consumed = True
+
+    async def iter_lines(self) -> AsyncIterator[bytes]:
+        """按行读取响应体（NDJSON流）；提前停止时需要调用aclose"""
+        buffer = bytearray()
+        chunks = self.iter_raw()
+        try:
+            async for data in chunks:
+                buffer += data
+                while True:
+                    end = buffer.find(b"\n")
+                    if end < 0:
+                        break
+                    line = bytes(buffer[:end]).rstrip(b"\r")
+                    del buffer[:end + 1]
+                    yield line
+        finally:
+            await chunks.aclose()
+        if buffer:
+            yield bytes(buffer)
+
+    async def read(self) -> bytes:
+        if self._body is None:
+            self._body = b"".join([data async for data in self.iter_raw()])
+        return self._body
+
+    def json(self) -> Any:
+        """解析已读取的响应体（需要先调用read）"""
+        return json.loads(self._body or b"null")
+
+class AsyncHTTPClient:
+    """一个服务器地址的异步HTTP客户端，保留空闲的keep-alive连接，连接总数有上限"""
+
+    def __init__(self, server_url: str, max_connections: int = HTTP_POOL_SIZE) -> None:
+        parts = urlsplit(server_url.rstrip('/'))
+        self.server_url = server_url.rstrip('/')
+        self.host = parts.hostname or 'localhost'
+        self.use_ssl = parts.scheme == 'https'
+        self.port = parts.port or (443 if self.use_ssl else 80)
+        self.base_path = parts.path
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port,
+                                        ssl=ssl.create_default_context() if self.use_ssl else None),
+                CONNECT_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            # 与连接建立后的错误区分开，只有这种错误才把端点标记为不可用
+            raise EndpointConnectError(f"无法连接到 {self.server_url}: {str(e) or type(e).__name__}") from e
+
+    async def _send(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                    method: str, path: str, body: bytes) -> AsyncResponse:
+        host = self.host if self.port in (80, 443) else f"{self.host}:{self.port}"
+        head = (
+            f"{method} {self.base_path}{path} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+        # 状态行和所有响应头共用一个超时
+        return await asyncio.wait_for(self._read_head(reader), READ_TIMEOUT)
+
+    async def _read_head(self, reader: asyncio.StreamReader) -> AsyncResponse:
+        status_line = await reader.readuntil(b"\n")
+        status_code = int(status_line.split()[1])
+        headers: Dict[str, str] = {}
+        while True:
+            line = (await reader.readuntil(b"\n")).strip()
+            if not line:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return AsyncResponse(reader, status_code, headers)
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, path: str,
+                      payload: Optional[Dict[str, Any]] = None) -> AsyncIterator[AsyncResponse]:
+        """发送请求；退出时响应体已读完的连接放回连接池，否则关闭（中途取消时会关闭连接）"""
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b""
+        async with self._slots:
+            response: Optional[AsyncResponse] = None
+            writer: Optional[asyncio.StreamWriter] = None
+            while self._idle and response is None:
+                reader, writer = self._idle.pop()
+                try:
+                    response = await self._send(reader, writer, method, path, body)
+                except ASYNC_FAILOVER_ERRORS:
+                    # 空闲连接可能已被服务器关闭，换一个连接重试
+                    writer.close()
+                    writer = None
+            if response is None:
+                reader, writer = await self._connect()
+                try:
+                    response = await self._send(reader, writer, method, path, body)
+                except BaseException:
+                    writer.close()
+                    raise
+            try:
+                yield response
+            finally:
+                response.close()
+                if response.reusable:
+                    self._idle.append((response.reader, writer))
+                else:
+                    writer.close()
+
+    def close(self) -> None:
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+class AsyncChatEngine(ChatEngine):
+    """ChatEngine的异步版本，端点选择、缓存、故障切换和统计与同步版本相同，
+    只是在事件循环中读取流式响应"""
+
+    def __init__(self, server_url: str, transport: "StreamTransport",
+                 cache: Optional[ResponseCache] = None) -> None:
+        super().__init__(server_url, cache=cache)
+        self.transport = transport
+
+    async def _choose(self, model: str, tried: List[Endpoint],
+                      error: Optional[BaseException] = None) -> Endpoint:
+        # 端点状态刷新是阻塞的HTTP请求，放到线程池中执行，不阻塞其他请求的流
+        future = asyncio.get_running_loop().run_in_executor(None, self.pool.choose_after, model, tried, error)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # 线程中的选择在取消后仍会完成并计入进行中的请求，等它完成后释放
+            future.add_done_callback(self._release_chosen)
+            raise
+
+    def _release_chosen(self, future: "asyncio.Future[Endpoint]") -> None:
+        if not future.cancelled() and future.exception() is None:
+            self.pool.release(future.result())
+
+    async def generate_async(self, model: str, prompt: Optional[str],
+                             messages: Optional[List[Dict[str, Any]]] = None,
+                             context: Optional[List[int]] = None,
+                             options: Optional[Dict[str, Any]] = None,
+                             on_chunk: Optional[Callable[[str], None]] = None,
+                             flush_interval: float = CHUNK_FLUSH_INTERVAL,
+                             flush_chars: int = CHUNK_FLUSH_CHARS,
+                             keep_alive: Optional[str] = None,
+                             extra: Optional[Dict[str, Any]] = None,
+                             on_data: Optional[Callable[[Dict[str, Any]], None]] = None) -> GenerationResult:
+        """与ChatEngine.generate相同，在事件循环中执行；extra见build_request，
+        on_data收到每个原始响应块（网关用它原样转发tool_calls、thinking等字段），缓存命中时不调用
+
+        任务被取消时关闭连接（Ollama检测到连接断开后停止生成），
+        请求已经发出时返回标记为truncated的部分结果，不写入缓存。
+        """
+        loop = asyncio.get_running_loop()
+        path, payload = build_request(model, prompt, messages, context, options, keep_alive, extra)
+        # 缓存键需要模型digest（可能刷新端点），缓存读写是SQLite I/O，都放到线程池中执行，
+        # 不阻塞事件循环中的其他流
+        key = await loop.run_in_executor(None, self._cache_key, model, path, payload)
+        if key:
+            cached = await loop.run_in_executor(None, self.cache.get, key)
+            if cached is not None:
+                return self._replay(model, cached[0], cached[1], on_chunk, flush_interval, flush_chars)
+
+        tried: List[Endpoint] = []
+        last_error: Optional[BaseException] = None
+        while True:
+            endpoint = await self._choose(model, tried, last_error)
+            metrics = GenerationMetrics(model)
+            coalescer = ChunkCoalescer(flush_interval, flush_chars)
+            accumulator = StreamAccumulator(metrics, coalescer, on_chunk, on_data)
+            try:
+                client = self.transport.client(endpoint.url)
+                async with client.request('POST', path, payload) as response:
+                    if response.status_code != 200:
+                        await response.read()
+                        raise OllamaResponseError(describe_error_response(response, model), response.status_code)
+                    lines = response.iter_lines()
+                    try:
+                        async for line in lines:
+                            if accumulator.feed(line):
+                                break
+                    finally:
+                        # 读到最后一行时立即关闭生成器，不留给事件循环回收
+                        await lines.aclose()
+                    if response.framed:
+                        # 读到最后一块后把剩余的部分（分块结束标记）读完，连接才能复用；
+                        # 没有长度信息的响应体要读到连接关闭，不等待
+                        async for _ in response.iter_raw():
+                            pass
+                    text, final_chunk = accumulator.finish()
+            except ASYNC_FAILOVER_ERRORS as e:
+                # 只有连接失败才标记端点不可用，流中途断开时服务器仍然是可达的
+                connect_error = is_connect_error(e)
+                self.pool.release(endpoint, failed=connect_error)
+                if metrics.chunk_count or accumulator.forwarded:
+                    # 已经输出了部分内容，无法透明地切换端点
+                    raise
+                logger.warning(f"端点 {endpoint.url} 请求失败，尝试其他端点: {str(e)}")
+                tried.append(endpoint)
+                last_error = None if connect_error else e
+                continue
+            except asyncio.CancelledError:
+                self.pool.release(endpoint, model, metrics.ttft)
+                text, _ = accumulator.finish()
+                metrics.cancel()
+                return self._finish(None, model, text, None, metrics, coalescer)
+            except BaseException:
+                self.pool.release(endpoint)
+                raise
+            self.pool.release(endpoint, model, metrics.ttft)
+            if key and final_chunk is not None:
+                await loop.run_in_executor(None, self.cache.put, key, model, text, final_chunk)
+            return self._finish(None, model, text, final_chunk, metrics, coalescer)
+
+    async def forward_async(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None,
+                            model: str = "",
+                            consume: Optional[Callable[[AsyncResponse], Awaitable[None]]] = None
+                            ) -> Tuple[Endpoint, AsyncResponse]:
+        """把一个请求发送到负载最低的端点（优先已加载model的端点），返回已读完的响应；
+        连接失败时切换端点，不检查状态码
+
+        指定consume时，收到响应头后由consume读取响应体（例如边读边转发给网关的客户端），
+        不在内存中保留；consume开始后出错不再切换端点。
+        """
+        tried: List[Endpoint] = []
+        last_error: Optional[BaseException] = None
+        while True:
+            endpoint = await self._choose(model, tried, last_error)
+            consuming = False
+            try:
+                client = self.transport.client(endpoint.url)
+                async with client.request(method, path, payload) as response:
+                    if consume is None:
+                        await response.read()
+                    else:
+                        consuming = True
+                        await consume(response)
+            except ASYNC_FAILOVER_ERRORS as e:
+                if consuming:
+                    self.pool.release(endpoint)
+                    raise
+                connect_error = is_connect_error(e)
+                self.pool.release(endpoint, failed=connect_error)
+                logger.warning(f"端点 {endpoint.url} 请求失败，尝试其他端点: {str(e)}")
+                tried.append(endpoint)
+                last_error = None if connect_error else e
+                continue
+            except BaseException:
+                self.pool.release(endpoint)
+                raise
+            self.pool.release(endpoint, model)
+            return endpoint, response
+
+    async def _post_complete(self, model: str, payload: Dict[str, Any],
+                             path: str = '/api/generate') -> Tuple[Endpoint, AsyncResponse]:
+        """发送非流式请求（默认为/api/generate），连接失败时切换端点"""
+        endpoint, response = await self.forward_async('POST', path, payload, model)
+        if response.status_code != 200:
+            raise OllamaResponseError(describe_error_response(response, model), response.status_code)
+        return endpoint, response
+
+    async def complete_async(self, model: str, prompt: str,
+                             keep_alive: Optional[str] = None,
+                             options: Optional[Dict[str, Any]] = None) -> str:
+        """与ChatEngine.complete相同，在事件循环中执行"""
+        _, response = await self._post_complete(
+            model, build_complete_request(model, prompt, keep_alive, options)
+        )
+        return response.json().get('response', '')
+
+    async def warm_up_async(self, model: str, keep_alive: Optional[str] = None,
+                            options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """发送不带提示词的请求让Ollama加载模型，返回加载耗时和/api/ps中该模型的驻留信息"""
+        start = time.perf_counter()
+        endpoint, response = await self._post_complete(
+            model, build_complete_request(model, "", keep_alive, options)
+        )
+        result: Dict[str, Any] = {
+            'endpoint': endpoint.url,
+            'elapsed': time.perf_counter() - start,
+            'load_duration': response.json().get('load_duration', 0) / 1e9,
+            'running': None
+        }
+        try:
+            async with self.transport.client(endpoint.url).request('GET', '/api/ps') as ps:
+                await ps.read()
+            if ps.status_code == 200:
+                for running in ps.json().get('models', []):
+                    name = running.get('name') or running.get('model', '')
+                    if name in (model, f"{model}:latest"):
+                        result['running'] = running
+        except ASYNC_FAILOVER_ERRORS as e:
+            logger.warning(f"读取 {endpoint.url} 的已加载模型时出错: {str(e)}")
+        return result
+
+    async def embed_async(self, model: str, inputs: List[str]) -> List[List[float]]:
+        """用/api/embed计算一批文本的向量"""
+        _, response = await self._post_complete(model, {'model': model, 'input': inputs}, '/api/embed')
+        embeddings = response.json().get('embeddings') or []
+        if len(embeddings) != len(inputs):
+            raise OllamaResponseError(f"模型 {model} 返回了 {len(embeddings)} 个向量，请求了 {len(inputs)} 个")
+        return embeddings
+
+    async def ingest_async(self, index: DocumentIndex, model: str,
+                           on_progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """增量更新文档索引：只处理内容有变化的文件，片段分批并发计算向量
+
+        每个文件完成后立即写入索引，中途停止时已经完成的文件不需要重新计算。
+        """
+        loop = asyncio.get_running_loop()
+        changed, removed = await loop.run_in_executor(None, index.scan, model)
+        for path in removed:
+            await loop.run_in_executor(None, index.remove_file, path)
+        progress = {'files': len(changed), 'done': 0, 'chunks': 0, 'removed': len(removed), 'failed': 0}
+        if on_progress is not None:
+            on_progress(dict(progress))
+        embed_slots = asyncio.Semaphore(EMBED_CONCURRENCY)
+        file_slots = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+        async def embed_batch(batch: List[str]) -> List[List[float]]:
+            async with embed_slots:
+                return await self.embed_async(model, batch)
+
+        async def ingest_file(change: Any) -> None:
+            async with file_slots:
+                try:
+                    text = await loop.run_in_executor(None, read_document, change.path)
+                    chunks = chunk_text(text)
+                    batches = await asyncio.gather(*(embed_batch(chunks[start:start + EMBED_BATCH_SIZE])
+                                                     for start in range(0, len(chunks), EMBED_BATCH_SIZE)))
+                    vectors = [vector for batch in batches for vector in batch]
+                    await loop.run_in_executor(None, index.replace_file, change, chunks, vectors)
+                    progress['chunks'] += len(chunks)
+                except (OSError, ValueError, OllamaError) as e:
+                    logger.error(f"索引文件 {change.path} 时出错: {str(e)}")
+                    progress['failed'] += 1
+                progress['done'] += 1
+                if on_progress is not None:
+                    on_progress(dict(progress))
+
+        await asyncio.gather(*(ingest_file(change) for change in changed))
+        if changed and progress['failed'] == len(changed):
+            raise OllamaError(f"所有文件都索引失败，请确认已经安装嵌入模型 {model}")
+        if index.dead_ratio > COMPACT_DEAD_RATIO:
+            await loop.run_in_executor(None, index.compact)
+        return progress
+
+    async def retrieve_async(self, retrieval: RetrievalSettings, query: str) -> List[Dict[str, Any]]:
+        """计算问题的向量并在索引中查找最相似的片段"""
+        vectors = await self.embed_async(retrieval.embed_model, [query])
+        return await asyncio.get_running_loop().run_in_executor(
+            None, retrieval.index.search, vectors[0], retrieval.top_k, retrieval.min_score
+        )
+
+    async def tune_async(self, model: str, grid: List[Dict[str, int]],
+                         base_options: Optional[Dict[str, Any]] = None,
+                         on_trial: Optional[Callable[[TuneTrial], None]] = None,
+                         keep_alive: Optional[str] = None) -> List[TuneTrial]:
+        """依次测试每个参数组合：先用该组合加载模型（加载时间不计入结果），
+        再生成TUNE_RUNS次标准提示词，记录平均解码速度和首字延迟"""
+        trials: List[TuneTrial] = []
+        for settings in grid:
+            trial = TuneTrial(settings)
+            options = dict(base_options or {}, **settings)
+            try:
+                loaded = await self.warm_up_async(model, keep_alive, options)
+                trial.load_duration = loaded['load_duration']
+                runs = []
+                for run in range(TUNE_RUNS):
+                    # 每次的提示词开头不同，Ollama不能复用上一次的KV缓存，首字延迟包含完整的提示词处理
+                    result = await self.generate_async(
+                        model, f"[{len(trials)}.{run}] {TUNE_PROMPT}",
+                        options=dict(options, num_predict=TUNE_TOKENS, temperature=0, seed=run),
+                        keep_alive=keep_alive
+                    )
+                    if result.metrics.truncated:
+                        # 生成中途被取消时generate_async返回部分结果，这里需要结束整个调优
+                        raise GenerationCancelled("已停止调优")
+                    runs.append(result.metrics)
+                trial.add_runs(runs)
+            except GenerationCancelled:
+                raise
+            except OllamaError as e:
+                trial.error = str(e)
+            trials.append(trial)
+            if on_trial is not None:
+                on_trial(trial)
+        return trials
+
+    async def _get_json(self, url: str, method: str, path: str,
+                        payload: Optional[Dict[str, Any]] = None) -> Any:
+        async with self.transport.client(url).request(method, path, payload) as response:
+            await response.read()
+        if response.status_code != 200:
+            raise OllamaResponseError(f"{path} 返回状态码 {response.status_code}", response.status_code)
+        return response.json()
+
+    async def tags_async(self, path: str = '/api/tags') -> List[Dict[str, Any]]:
+        """并行读取所有端点的/api/tags并合并（与EndpointPool.list_models相同），
+        每个模型附带所在的端点地址；path为/api/ps时合并各端点已加载的模型"""
+        urls = [endpoint.url for endpoint in self.pool.endpoints]
+        results = await asyncio.gather(*(self._get_json(url, 'GET', path) for url in urls),
+                                       return_exceptions=True)
+        merged: Dict[str, Dict[str, Any]] = {}
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"读取 {url}{path} 时出错: {str(result)}")
+                continue
+            for model in result.get('models', []):
+                entry = merged.setdefault(model['name'], dict(model, endpoints=[]))
+                entry['endpoints'].append(url)
+        if all(isinstance(result, BaseException) for result in results):
+            raise OllamaError("无法连接到Ollama服务，请确保已启动ollama serve命令")
+        return list(merged.values())
+
+    async def list_models_async(self, known: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """合并所有端点的模型列表，并行读取/api/show补充参数量、量化方式和上下文长度；
+        known中digest没有变化的模型不再读取/api/show"""
+        models = await self.tags_async()
+        previous = {model['name']: model for model in known or []}
+        semaphore = asyncio.Semaphore(MODEL_SHOW_CONCURRENCY)
+
+        async def add_details(entry: Dict[str, Any]) -> None:
+            old = previous.get(entry['name'])
+            if old is not None and old.get('digest') == entry.get('digest') and 'context_length' in old:
+                entry['details'] = old.get('details') or entry.get('details') or {}
+                entry['context_length'] = old['context_length']
+                return
+            try:
+                async with semaphore:
+                    show = await self._get_json(entry['endpoints'][0], 'POST', '/api/show',
+                                                {'model': entry['name']})
+            except (*ASYNC_FAILOVER_ERRORS, OllamaError) as e:
+                logger.warning(f"读取模型 {entry['name']} 的详细信息时出错: {str(e)}")
+                return
+            entry['details'] = dict(entry.get('details') or {}, **(show.get('details') or {}))
+            entry['context_length'] = model_context_length(show)
+
+        await asyncio.gather(*(add_details(entry) for entry in models))
+        return models
+
+class StreamTransport:
+    """在一个专用线程中运行asyncio事件循环，所有进行中的请求共享这个循环和每个服务器的连接池
+
+    请求先经过调度器排队，再由事件循环执行。回调在事件循环线程中调用，
+    界面需要自己切换回主线程（例如通过Qt信号）。
+    """
+
+    def __init__(self, max_streams: int = TRANSPORT_MAX_STREAMS,
+                 slots_per_model: int = SLOTS_PER_MODEL) -> None:
+        self.max_streams = max_streams
+        self.slots_per_model = slots_per_model
+        self.scheduler = RequestScheduler(max_streams)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._clients: Dict[str, AsyncHTTPClient] = {}
+        self._tasks: Dict[int, "asyncio.Task[Any]"] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """第一次提交请求时启动事件循环线程"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run_loop, args=(ready,),
+                                            name="ollama-transport", daemon=True)
+            self._thread.start()
+        ready.wait()
+
+    def _run_loop(self, ready: threading.Event) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(ready.set)
+        self._loop.run_forever()
+
+    def run_coroutine(self, coroutine: Any) -> "concurrent.futures.Future[Any]":
+        """在事件循环中运行一个协程（例如网关服务器），可在任意线程调用"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def call_soon(self, callback: Callable[..., None], *args: Any) -> None:
+        """在事件循环线程中调用callback（可在任意线程调用）"""
+        self.start()
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def client(self, server_url: str) -> AsyncHTTPClient:
+        """获取服务器地址对应的异步客户端（只在事件循环线程中调用）"""
+        key = server_url.rstrip('/')
+        client = self._clients.get(key)
+        if client is None:
+            client = AsyncHTTPClient(key)
+            self._clients[key] = client
+        return client
+
+    @property
+    def active_requests(self) -> int:
+        return len(self._tasks)
+
+    def queue_status(self) -> Dict[str, Any]:
+        """排队和执行中的请求数，以及排队最久的请求已等待的时间（可在任意线程调用）"""
+        return self.scheduler.snapshot()
+
+    def _spawn(self, make_coroutine: Callable[[int], Any],
+               on_done: Callable[[int, Any], None],
+               on_error: Callable[[int, Exception], None]) -> int:
+        """在事件循环中运行一个任务，返回可用于取消的请求ID"""
+        self.start()
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            # close()会把self._loop置为None，schedule运行时仍使用提交时的事件循环
+            loop = self._loop
+
+        async def run() -> None:
+            try:
+                result = await make_coroutine(request_id)
+            except asyncio.CancelledError:
+                # 在排队或选择端点时被取消，请求还没有发送
+                on_error(request_id, GenerationCancelled("已停止生成"))
+            except Exception as e:
+                on_error(request_id, e)
+            else:
+                on_done(request_id, result)
+
+        def finished(task: "asyncio.Task[None]") -> None:
+            self._tasks.pop(request_id, None)
+            if task.cancelled():
+                # 任务在第一次运行之前就被取消（提交后立即取消），run没有机会处理
+                on_error(request_id, GenerationCancelled("已停止生成"))
+
+        def schedule() -> None:
+            task = loop.create_task(run())
+            task.add_done_callback(finished)
+            self._tasks[request_id] = task
+
+        loop.call_soon_threadsafe(schedule)
+        return request_id
+
+    def _submit(self, make_coroutine: Callable[[int, float], Any],
+                on_done: Callable[[int, Any], None],
+                on_error: Callable[[int, Exception], None],
+                server_url: str, model: str, priority: int,
+                queue_key: Optional[Hashable] = None) -> int:
+        """经过调度器排队后运行一个任务，协程得到请求ID和排队时间"""
+        # 并发上限按端点池中的端点数计算，每个端点上同一模型最多slots_per_model个请求
+        slots = self.slots_per_model * len(EndpointPool.for_servers(server_url).endpoints)
+
+        async def scheduled(request_id: int) -> Any:
+            async with self.scheduler.slot(request_id, queue_key, (server_url, model),
+                                           slots, priority) as waited:
+                return await make_coroutine(request_id, waited)
+
+        return self._spawn(scheduled, on_done, on_error)
+
+    def generate(self, server_url: str, model: str, prompt: str,
+                 on_chunk: Callable[[int, str], None],
+                 on_done: Callable[[int, GenerationResult], None],
+                 on_error: Callable[[int, Exception], None],
+                 cache: Optional[ResponseCache] = None,
+                 conversation: Optional[Conversation] = None,
+                 priority: int = PRIORITY_INTERACTIVE,
+                 queue_key: Optional[Hashable] = None,
+                 retrieval: Optional[RetrievalSettings] = None, **kwargs: Any) -> int:
+        """提交一个流式生成请求，返回请求ID；其他参数与ChatEngine.generate相同
+
+        指定conversation时，同一会话的请求按顺序执行：轮到该请求时才读取对话历史，
+        成功完成后立即记录这一轮，因此连续发送的消息能看到前一个回答。
+        queue_key相同的请求也按提交顺序逐个执行。
+        指定retrieval时先检索文档，把相关片段放进这一次的提示词；对话历史中只记录原始问题。
+        """
+        engine = AsyncChatEngine(server_url, self, cache=cache)
+
+        async def run_generation(request_id: int, waited: float) -> GenerationResult:
+            request_kwargs = dict(kwargs)
+            if conversation is not None:
+                request_kwargs.update(conversation.request_kwargs())
+            sources: List[Dict[str, Any]] = []
+            if retrieval is not None:
+                try:
+                    sources = await engine.retrieve_async(retrieval, prompt)
+                except (OllamaError, ValueError) as e:
+                    raise OllamaError(f"检索文档时出错: {str(e)}")
+            result = await engine.generate_async(
+                model, build_rag_prompt(prompt, sources), on_chunk=lambda text: on_chunk(request_id, text),
+                **request_kwargs
+            )
+            result.metrics.queue_wait = waited
+            result.sources = sources
+            if conversation is not None and not result.metrics.truncated:
+                conversation.record_turn(prompt, result.text, result.final_chunk)
+            return result
+
+        if conversation is not None:
+            queue_key = ('conversation', id(conversation))
+        return self._submit(run_generation, on_done, on_error, server_url, model, priority, queue_key)
+
+    def complete(self, server_url: str, model: str, prompt: str,
+                 on_done: Callable[[int, str], None],
+                 on_error: Callable[[int, Exception], None],
+                 priority: int = PRIORITY_BACKGROUND, keep_alive: Optional[str] = None,
+                 options: Optional[Dict[str, Any]] = None) -> int:
+        """提交一个非流式生成请求（摘要等后台任务，默认低优先级），返回请求ID"""
+        engine = AsyncChatEngine(server_url, self)
+        return self._submit(lambda request_id, waited: engine.complete_async(model, prompt, keep_alive, options),
+                            on_done, on_error, server_url, model, priority)
+
+    def warm_up(self, server_url: str, model: str,
+                on_done: Callable[[int, Dict[str, Any]], None],
+                on_error: Callable[[int, Exception], None],
+                keep_alive: Optional[str] = None,
+                options: Optional[Dict[str, Any]] = None) -> int:
+        """提交一个预热请求（后台优先级）：加载模型并设置keep_alive，返回请求ID
+
+        预热与该模型的对话请求共用并发槽位，预热期间发送的消息会在模型加载完成后执行。
+        """
+        engine = AsyncChatEngine(server_url, self)
+        return self._submit(lambda request_id, waited: engine.warm_up_async(model, keep_alive, options),
+                            on_done, on_error, server_url, model, PRIORITY_BACKGROUND)
+
+    def tune(self, server_url: str, model: str,
+             on_done: Callable[[int, List[TuneTrial]], None],
+             on_error: Callable[[int, Exception], None],
+             grid: Optional[List[Dict[str, int]]] = None,
+             on_trial: Optional[Callable[[int, TuneTrial], None]] = None,
+             base_options: Optional[Dict[str, Any]] = None,
+             keep_alive: Optional[str] = None) -> int:
+        """提交一个自动调优任务（后台优先级），每测试完一个组合调用on_trial，返回请求ID
+
+        整个调优过程占用该模型的一个并发槽位，测试期间该模型的其他请求排队等待，不影响测量结果。
+        """
+        engine = AsyncChatEngine(server_url, self)
+
+        def run_tune(request_id: int, waited: float) -> Any:
+            report = (lambda trial: on_trial(request_id, trial)) if on_trial is not None else None
+            return engine.tune_async(model, grid or tune_grid(), base_options, report, keep_alive)
+
+        return self._submit(run_tune, on_done, on_error, server_url, model, PRIORITY_BACKGROUND)
+
+    def ingest(self, server_url: str, index: DocumentIndex, model: str,
+               on_done: Callable[[int, Dict[str, Any]], None],
+               on_error: Callable[[int, Exception], None],
+               on_progress: Optional[Callable[[int, Dict[str, Any]], None]] = None) -> int:
+        """提交一个文档索引更新任务（后台优先级），返回请求ID；任务占用嵌入模型的一个并发槽位"""
+        engine = AsyncChatEngine(server_url, self)
+
+        def run_ingest(request_id: int, waited: float) -> Any:
+            report = (lambda progress: on_progress(request_id, progress)) if on_progress is not None else None
+            return engine.ingest_async(index, model, report)
+
+        return self._submit(run_ingest, on_done, on_error, server_url, model, PRIORITY_BACKGROUND)
+
+    def forward(self, server_url: str, method: str, path: str, payload: Optional[Dict[str, Any]],
+                on_done: Callable[[int, AsyncResponse], None],
+                on_error: Callable[[int, Exception], None],
+                model: str = "", scheduled: bool = False,
+                consume: Optional[Callable[[AsyncResponse], Awaitable[None]]] = None) -> int:
+        """把一个请求原样转发到端点池，返回请求ID；scheduled为True时（例如计算向量）
+        与该模型的其他请求一起经过调度器排队；consume见AsyncChatEngine.forward_async"""
+        engine = AsyncChatEngine(server_url, self)
+
+        async def run_forward(request_id: int, waited: float = 0.0) -> AsyncResponse:
+            _, response = await engine.forward_async(method, path, payload, model, consume)
+            return response
+
+        if scheduled:
+            return self._submit(run_forward, on_done, on_error, server_url, model, PRIORITY_INTERACTIVE)
+        return self._spawn(run_forward, on_done, on_error)
+
+    def tags(self, server_url: str,
+             on_done: Callable[[int, List[Dict[str, Any]]], None],
+             on_error: Callable[[int, Exception], None],
+             path: str = '/api/tags') -> int:
+        """读取端点池中所有端点的模型并合并，返回请求ID；不读取/api/show，也不写入模型目录。
+        path为/api/ps时合并各端点已加载的模型"""
+        engine = AsyncChatEngine(server_url, self)
+
+        async def run_tags(request_id: int) -> List[Dict[str, Any]]:
+            return await engine.tags_async(path)
+
+        return self._spawn(run_tags, on_done, on_error)
+
+    def list_models(self, server_url: str,
+                    on_done: Callable[[int, List[Dict[str, Any]]], None],
+                    on_error: Callable[[int, Exception], None],
+                    catalogue: Optional[ModelCatalogue] = None,
+                    known: Optional[List[Dict[str, Any]]] = None) -> int:
+        """刷新模型列表并写入catalogue，返回请求ID；不经过调度器，不占用模型的并发槽位"""
+        engine = AsyncChatEngine(server_url, self)
+
+        async def refresh(request_id: int) -> List[Dict[str, Any]]:
+            try:
+                models = await asyncio.wait_for(engine.list_models_async(known), MODEL_CATALOGUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise OllamaError("连接 Ollama 服务超时，请检查服务器地址")
+            if catalogue is not None:
+                await asyncio.get_running_loop().run_in_executor(None, catalogue.put, server_url, models)
+            return models
+
+        return self._spawn(refresh, on_done, on_error)
+
+    def cancel(self, request_id: int) -> None:
+        """取消一个请求：正在读取的流会立即关闭连接，排队中的请求不再发送"""
+        loop = self._loop
+        if loop is None:
+            return
+
+        def cancel_task() -> None:
+            task = self._tasks.get(request_id)
+            if task is not None:
+                task.cancel()
+
+        loop.call_soon_threadsafe(cancel_task)
+
+    def close(self) -> None:
+        """取消所有请求并停止事件循环"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+
+        async def shutdown() -> None:
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                # 等被取消的任务运行完（关闭连接并调用回调）再停止事件循环
+                await asyncio.wait(tasks, timeout=CONNECT_TIMEOUT)
+            for client in self._clients.values():
+                client.close()
+            # 结束中途停止迭代、还没有被回收的异步生成器（例如读到最后一行后的响应体），
+            # 否则停止事件循环时它们的清理任务会被丢弃
+            await loop.shutdown_asyncgens()
+            loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop)
+        thread.join(timeout=CONNECT_TIMEOUT * 2)
@@ -0,0 +1,42 @@
+# 测试使用本地模拟服务器（ollama_fake_server），不需要Ollama和图形界面
+
+import os
+import sys
+import threading
+from typing import Any, Callable, Iterator
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ollama_fake_server import FakeOllamaServer, FakeServerConfig
+from ollama_transport import StreamTransport
+
+@pytest.fixture
+def fake_server() -> Iterator[FakeOllamaServer]:
+    server = FakeOllamaServer(FakeServerConfig(
+        models=['fake-llama:7b', 'nomic-embed-text'], tokens_per_second=0,
+        first_token_latency=0.0, response_tokens=20, seed=1
+    )).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def transport() -> Iterator[StreamTransport]:
+    transport = StreamTransport()
+    yield transport
+    transport.close()
+
+def wait_callback(submit: Callable[[Callable[[int, Any], None], Callable[[int, Any], None]], int],
+                  timeout: float = 10) -> Any:
+    """调用传输层的回调接口并等待结果，出错时返回异常对象"""
+    finished = threading.Event()
+    outcome = []
+
+    def resolve(request_id: int, result: Any) -> None:
+        outcome.append(result)
+        finished.set()
+
+    submit(resolve, resolve)
+    assert finished.wait(timeout), "请求没有完成"
+    return outcome[0]
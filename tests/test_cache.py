@@ -0,0 +1,34 @@
+from ollama_cache import ResponseCache, cache_key, is_deterministic
+
+def test_is_deterministic():
+    assert not is_deterministic(None)
+    assert not is_deterministic({'temperature': 0.7})
+    assert is_deterministic({'temperature': 0})
+    assert is_deterministic({'seed': 42})
+
+def test_cache_key_covers_options():
+    payload = {'model': 'fake-llama:7b', 'prompt': "hi", 'options': {'seed': 1}}
+    assert cache_key("sha256:1", '/api/generate', payload) == cache_key("sha256:1", '/api/generate', dict(payload))
+    assert cache_key("sha256:1", '/api/generate', payload) != cache_key("sha256:2", '/api/generate', payload)
+    assert cache_key("sha256:1", '/api/generate', payload) != cache_key(
+        "sha256:1", '/api/generate', {**payload, 'options': {'seed': 2}})
+
+def test_put_and_get():
+    cache = ResponseCache(':memory:')
+    assert cache.get("missing") is None
+    cache.put("key", 'fake-llama:7b', "你好", {'done': True, 'eval_count': 2})
+    assert cache.get("key") == ("你好", {'done': True, 'eval_count': 2})
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+    cache.close()
+
+def test_evicts_least_recently_used():
+    cache = ResponseCache(':memory:', max_bytes=250)
+    for key in ("a", "b"):
+        cache.put(key, 'fake-llama:7b', "x" * 100, {})
+    cache.get("a")
+    cache.put("c", 'fake-llama:7b', "x" * 100, {})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()['bytes'] <= 250
+    cache.close()
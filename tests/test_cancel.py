@@ -0,0 +1,73 @@
+import time
+
+from conftest import wait_callback
+from ollama_engine import (CHAT_MODE_CHAT, Conversation, EndpointPool, GenerationCancelled,
+                           GenerationResult)
+
+def test_cancel_while_choosing_endpoint_releases_slot(fake_server, transport):
+    pool = EndpointPool.for_servers(fake_server.url)
+    choose_after = pool.choose_after
+
+    def slow_choose(*args):
+        time.sleep(0.3)
+        return choose_after(*args)
+
+    pool.choose_after = slow_choose
+
+    def submit(done, error):
+        request_id = transport.generate(fake_server.url, 'fake-llama:7b', "hello",
+                                        lambda request_id, text: None, done, error)
+        time.sleep(0.1)
+        transport.cancel(request_id)
+        return request_id
+
+    assert isinstance(wait_callback(submit), GenerationCancelled)
+    time.sleep(0.4)
+    assert pool.endpoints[0].outstanding == 0
+
+def test_cancel_immediately_after_submit_reports_cancellation(fake_server, transport):
+    def submit(done, error):
+        request_id = transport.generate(fake_server.url, 'fake-llama:7b', "hello",
+                                        lambda request_id, text: None, done, error)
+        transport.cancel(request_id)
+        return request_id
+
+    assert isinstance(wait_callback(submit), GenerationCancelled)
+    time.sleep(0.1)
+    assert transport.active_requests == 0
+
+def test_close_reports_cancellation_of_pending_requests(fake_server, transport):
+    def submit(done, error):
+        request_id = transport.generate(fake_server.url, 'fake-llama:7b', "hello",
+                                        lambda request_id, text: None, done, error)
+        transport.close()
+        return request_id
+
+    assert isinstance(wait_callback(submit), GenerationCancelled)
+
+def test_cancel_mid_stream_returns_partial_text(fake_server, transport):
+    fake_server.config.tokens_per_second = 20
+    fake_server.config.response_tokens = 200
+    conversation = Conversation(CHAT_MODE_CHAT)
+    chunks = []
+
+    def submit(done, error):
+        def on_chunk(request_id, text):
+            chunks.append(text)
+            transport.cancel(request_id)
+
+        return transport.generate(fake_server.url, 'fake-llama:7b', "hello", on_chunk, done, error,
+                                  conversation=conversation, flush_interval=0)
+
+    result = wait_callback(submit)
+    assert isinstance(result, GenerationResult)
+    assert result.metrics.truncated
+    assert result.text and result.text == "".join(chunks)
+    assert len(result.text.split()) < 200
+    assert conversation.context_manager.messages == []
+
+    # 服务器在下一次写入时发现连接已断开，停止生成
+    deadline = time.monotonic() + 5
+    while fake_server.stats.aborted == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert fake_server.stats.aborted == 1
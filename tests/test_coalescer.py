@@ -0,0 +1,19 @@
+from ollama_engine import ChunkCoalescer
+
+def test_flush_by_interval():
+    coalescer = ChunkCoalescer(flush_interval=0.05, flush_chars=1000)
+    assert coalescer.add("a", now=1.0) == "a"
+    assert coalescer.add("b", now=1.01) is None
+    assert coalescer.add("c", now=1.02) is None
+    assert coalescer.add("d", now=1.06) == "bcd"
+    assert coalescer.flush() is None
+    assert (coalescer.received_chunks, coalescer.emitted_chunks, coalescer.merged_chunks) == (4, 2, 2)
+
+def test_flush_by_chars():
+    coalescer = ChunkCoalescer(flush_interval=10.0, flush_chars=4)
+    assert coalescer.add("ab", now=0.0) is None
+    assert coalescer.add("cd", now=0.0) == "abcd"
+    assert coalescer.add("e", now=0.0) is None
+    # 流结束时剩余的文本由flush取出
+    assert coalescer.flush() == "e"
+    assert coalescer.merged_chunks == 1
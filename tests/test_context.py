@@ -0,0 +1,74 @@
+from ollama_engine import (CHAT_MODE_CHAT, CHAT_MODE_GENERATE, ContextManager, Conversation,
+                           estimate_tokens)
+
+def add_turns(manager, count, text="x" * 40):
+    for i in range(count):
+        manager.add('user', f"{i} {text}")
+        manager.add('assistant', f"{i} {text}")
+
+def test_window_is_stable_until_over_budget():
+    manager = ContextManager(budget=200, low_watermark=0.5)
+    add_turns(manager, 3)
+    assert manager.window_start == 0
+    assert manager.window_tokens <= 200
+    assert len(manager.build_messages()) == 6
+
+def test_trim_moves_to_low_watermark_at_a_user_message():
+    manager = ContextManager(budget=200, low_watermark=0.5)
+    manager.set_system_prompt("You are helpful.")
+    add_turns(manager, 10)
+    fixed = estimate_tokens(manager.system_prompt)
+    assert 0 < manager.window_start
+    assert manager.window_tokens - fixed <= 200 - fixed
+    assert manager.messages[manager.window_start]['role'] == 'user'
+
+    # 只有再次超出预算时窗口起点才会移动
+    start = manager.window_start
+    manager.add('user', "short")
+    assert manager.window_start == start
+
+    messages = manager.build_messages()
+    assert messages[0] == {'role': 'system', 'content': "You are helpful."}
+    assert messages[1:] == manager.messages[manager.window_start:]
+    assert manager.pending_summary() == manager.messages[:manager.window_start]
+
+def test_single_message_larger_than_budget_is_kept():
+    manager = ContextManager(budget=50)
+    manager.set_system_prompt("system")
+    manager.add('user', "hello")
+    manager.add('assistant', "y" * 1000)
+    # 最后一条消息总是保留，系统提示词也不会被移出
+    assert manager.window_start == len(manager.messages) - 1
+    messages = manager.build_messages()
+    assert [message['role'] for message in messages] == ['system', 'assistant']
+    assert messages[-1]['content'] == "y" * 1000
+
+def test_apply_summary():
+    manager = ContextManager(budget=200, low_watermark=0.5)
+    manager.set_system_prompt("system")
+    add_turns(manager, 10)
+    pending = manager.pending_summary()
+    assert pending
+    manager.apply_summary(" earlier turns ", manager.window_start)
+    assert manager.pending_summary() == []
+    assert manager.build_messages()[0]['content'] == "system\n\n以下是之前对话的摘要：\nearlier turns"
+
+    # 摘要生成期间对话被清空时丢弃摘要
+    manager.clear()
+    manager.apply_summary("stale", len(pending))
+    assert manager.summary == ""
+
+def test_record_turn_keeps_generate_context_within_budget():
+    conversation = Conversation(CHAT_MODE_GENERATE, budget=100)
+    conversation.record_turn("hi", "hello", {'context': [1, 2, 3]})
+    assert conversation.request_kwargs() == {'context': [1, 2, 3]}
+
+    conversation.record_turn("more", "text", {'context': list(range(101))})
+    assert conversation.request_kwargs() == {'context': None}
+
+def test_record_turn_chat_mode():
+    conversation = Conversation(CHAT_MODE_CHAT)
+    conversation.record_turn("hi", "hello")
+    assert conversation.request_kwargs() == {'messages': [
+        {'role': 'user', 'content': "hi"}, {'role': 'assistant', 'content': "hello"}
+    ]}
@@ -0,0 +1,110 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import ollama_transport
+from conftest import wait_callback
+from ollama_engine import (CONNECT_TIMEOUT, ENDPOINT_RETRY_DELAY, ChatEngine, EndpointPool,
+                           GenerationResult, OllamaError)
+
+class SlowLoadHandler(BaseHTTPRequestHandler):
+    """接受连接并正常返回模型列表，但生成请求迟迟不返回响应头（模拟大模型加载）"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps({'models': [{'name': 'fake-llama:7b'}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(2)
+
+@pytest.fixture
+def slow_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowLoadHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+def generate(transport, server_url):
+    return wait_callback(lambda done, error: transport.generate(
+        server_url, 'fake-llama:7b', "hello", lambda request_id, text: None, done, error
+    ))
+
+def test_stream_drop_does_not_mark_endpoint_down(fake_server, transport):
+    fake_server.config.drop_rate = 1.0
+    assert isinstance(generate(transport, fake_server.url), Exception)
+    endpoint = EndpointPool.for_servers(fake_server.url).endpoints[0]
+    assert endpoint.available
+    assert endpoint.outstanding == 0
+
+    fake_server.config.drop_rate = 0.0
+    result = generate(transport, fake_server.url)
+    assert isinstance(result, GenerationResult)
+    assert not result.metrics.truncated
+
+def test_sync_stream_drop_does_not_mark_endpoint_down(fake_server):
+    engine = ChatEngine(fake_server.url)
+    fake_server.config.drop_rate = 1.0
+    with pytest.raises(Exception):
+        engine.generate('fake-llama:7b', "hello")
+    fake_server.config.drop_rate = 0.0
+    assert engine.generate('fake-llama:7b', "hello").text
+    assert engine.pool.endpoints[0].available
+
+def test_choose_falls_back_to_least_recently_failed(fake_server):
+    pool = EndpointPool([fake_server.url, "http://127.0.0.1:9"])
+    pool.refresh(force=True)
+    healthy, unreachable = pool.endpoints
+    assert not unreachable.available
+
+    healthy.mark_down()
+    unreachable.down_until = time.monotonic() + ENDPOINT_RETRY_DELAY * 2
+    endpoint = pool.choose('fake-llama:7b')
+    assert endpoint is healthy
+    pool.release(endpoint)
+
+    with pytest.raises(OllamaError):
+        pool.choose('fake-llama:7b', exclude=[healthy, unreachable])
+
+def test_unreachable_server_reports_connection_error(transport):
+    result = generate(transport, "http://127.0.0.1:9")
+    assert isinstance(result, OllamaError)
+    assert EndpointPool.for_servers("http://127.0.0.1:9").endpoints[0].outstanding == 0
+
+def test_header_timeout_fails_over_without_marking_down(slow_server, fake_server, transport, monkeypatch):
+    monkeypatch.setattr(ollama_transport, 'READ_TIMEOUT', 0.5)
+    pool = EndpointPool.for_servers(f"{slow_server},{fake_server.url}")
+    slow, healthy = pool.endpoints
+    # 让慢的端点先被选中
+    healthy.outstanding += 1
+    try:
+        result = generate(transport, f"{slow_server},{fake_server.url}")
+    finally:
+        healthy.outstanding -= 1
+    assert isinstance(result, GenerationResult)
+    assert slow.available and slow.outstanding == 0
+
+    # 只有这一个端点时返回超时错误，而不是“无法连接”
+    result = generate(transport, slow_server)
+    assert isinstance(result, TimeoutError)
+    assert EndpointPool.for_servers(slow_server).endpoints[0].available
+
+def test_sync_header_timeout_does_not_mark_down(slow_server):
+    engine = ChatEngine(slow_server)
+    endpoint = engine.pool.endpoints[0]
+    endpoint.client.timeout = (CONNECT_TIMEOUT, 0.5)
+    with pytest.raises(Exception) as info:
+        engine.generate('fake-llama:7b', "hello")
+    assert not isinstance(info.value, OllamaError)
+    assert endpoint.available and endpoint.outstanding == 0
@@ -0,0 +1,185 @@
+import json
+import time
+import threading
+import http.client
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import wait_callback
+from ollama_fake_server import FakeOllamaServer, FakeServerConfig
+from ollama_gateway import OllamaGateway, merge_chunks, openai_options
+
+# 带思考过程和工具调用的/api/chat流
+TOOL_CHAT_CHUNKS = [
+    {'model': 'tool-model', 'message': {'role': 'assistant', 'content': '', 'thinking': "Need the "}, 'done': False},
+    {'model': 'tool-model', 'message': {'role': 'assistant', 'content': '', 'thinking': "weather."}, 'done': False},
+    {'model': 'tool-model', 'message': {'role': 'assistant', 'content': '', 'tool_calls': [
+        {'function': {'name': 'get_weather', 'arguments': {'city': 'Paris'}}}]}, 'done': False},
+    {'model': 'tool-model', 'message': {'role': 'assistant', 'content': "Checking."}, 'done': False},
+    {'model': 'tool-model', 'message': {'role': 'assistant', 'content': ''}, 'done': True,
+     'done_reason': 'stop', 'eval_count': 4},
+]
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """返回工具调用和/api/pull进度的上游服务器；pull在第一行之后等待server.release"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps({'models': [{'name': 'tool-model', 'model': 'tool-model'}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        if self.path == '/api/chat':
+            for chunk in TOOL_CHAT_CHUNKS:
+                self._write(chunk)
+        else:
+            self._write({'status': "pulling manifest"})
+            self.server.release.wait(5)
+            self._write({'status': "success"})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write(self, data):
+        line = json.dumps(data).encode() + b"\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+@pytest.fixture
+def upstream():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    server.daemon_threads = True
+    server.release = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def upstream_gateway(upstream, transport):
+    gateway = OllamaGateway(transport, f"http://127.0.0.1:{upstream.server_address[1]}", port=0)
+    gateway.start()
+    yield gateway
+    gateway.stop()
+
+@pytest.fixture
+def gateway(fake_server, transport):
+    gateway = OllamaGateway(transport, fake_server.url, port=0)
+    gateway.start()
+    yield gateway
+    gateway.stop()
+
+def request(gateway, path, body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    with urllib.request.urlopen(urllib.request.Request(gateway.url + path, data=data), timeout=10) as response:
+        return response.headers.get('Content-Type'), response.read().decode('utf-8')
+
+def test_openai_options():
+    assert openai_options({'stop': "\n", 'max_tokens': 5, 'temperature': None}) == {
+        'stop': ["\n"], 'num_predict': 5
+    }
+    assert openai_options({'stop': ["a", "b"]}) == {'stop': ["a", "b"]}
+
+def test_native_generate_stream(gateway):
+    content_type, body = request(gateway, '/api/generate', {'model': 'fake-llama:7b', 'prompt': "hi"})
+    lines = [json.loads(line) for line in body.splitlines()]
+    assert content_type == 'application/x-ndjson'
+    assert lines[-1]['done'] and not any(line['done'] for line in lines[:-1])
+    assert "".join(line.get('response', '') for line in lines)
+
+def test_openai_chat_completion(gateway):
+    _, body = request(gateway, '/v1/chat/completions', {
+        'model': 'fake-llama:7b', 'messages': [{'role': 'user', 'content': "hi"}]
+    })
+    completion = json.loads(body)
+    assert completion['choices'][0]['message']['content']
+    assert completion['usage']['completion_tokens'] == 20
+
+def test_openai_stream_ends_with_done(gateway):
+    content_type, body = request(gateway, '/v1/chat/completions', {
+        'model': 'fake-llama:7b', 'messages': [{'role': 'user', 'content': "hi"}], 'stream': True
+    })
+    events = [event for event in body.split("\n\n") if event]
+    assert content_type == 'text/event-stream'
+    assert events[-1] == "data: [DONE]"
+    assert json.loads(events[-2][len("data: "):])['choices'][0]['finish_reason'] == 'stop'
+
+def test_models_are_merged_across_the_pool(fake_server, transport):
+    other = FakeOllamaServer(FakeServerConfig(models=['other-model:1b'])).start()
+    gateway = OllamaGateway(transport, f"{fake_server.url},{other.url}", port=0)
+    gateway.start()
+    try:
+        _, body = request(gateway, '/v1/models')
+        assert {model['id'] for model in json.loads(body)['data']} == {
+            'fake-llama:7b', 'nomic-embed-text', 'other-model:1b'
+        }
+        _, body = request(gateway, '/api/tags')
+        assert 'other-model:1b' in {model['name'] for model in json.loads(body)['models']}
+    finally:
+        gateway.stop()
+        other.stop()
+
+def test_set_server_url(gateway, fake_server):
+    gateway.set_server_url(fake_server.url + "/")
+    time.sleep(0.1)
+    _, body = request(gateway, '/gateway/status')
+    assert json.loads(body)['server_url'] == fake_server.url + "/"
+
+def test_merge_chunks():
+    merged = merge_chunks(TOOL_CHAT_CHUNKS)
+    assert merged['message'] == {
+        'role': 'assistant', 'content': "Checking.", 'thinking': "Need the weather.",
+        'tool_calls': [{'function': {'name': 'get_weather', 'arguments': {'city': 'Paris'}}}]
+    }
+    assert merged['done'] and merged['eval_count'] == 4
+
+def test_native_stream_keeps_upstream_fields(upstream_gateway):
+    _, body = request(upstream_gateway, '/api/chat', {
+        'model': 'tool-model', 'messages': [{'role': 'user', 'content': "weather?"}], 'tools': []
+    })
+    lines = [json.loads(line) for line in body.splitlines()]
+    assert [line['message'] for line in lines] == [chunk['message'] for chunk in TOOL_CHAT_CHUNKS]
+    assert lines[-1]['done_reason'] == 'stop'
+
+    _, body = request(upstream_gateway, '/api/chat', {
+        'model': 'tool-model', 'messages': [{'role': 'user', 'content': "weather?"}], 'stream': False
+    })
+    assert json.loads(body)['message'] == merge_chunks(TOOL_CHAT_CHUNKS)['message']
+
+def test_forward_streams_progress(upstream, upstream_gateway):
+    connection = http.client.HTTPConnection(upstream_gateway.host, upstream_gateway.port, timeout=5)
+    connection.request('POST', '/api/pull', json.dumps({'model': 'tool-model'}))
+    response = connection.getresponse()
+    assert response.getheader('Transfer-Encoding') == 'chunked'
+    # 上游还没有结束时就能读到第一行进度
+    assert json.loads(response.readline()) == {'status': "pulling manifest"}
+    upstream.release.set()
+    assert json.loads(response.read()) == {'status': "success"}
+    connection.close()
+
+def test_running_models_are_merged_across_the_pool(fake_server, transport):
+    other = FakeOllamaServer(FakeServerConfig(models=['other-model:1b'], tokens_per_second=0,
+                                              first_token_latency=0.0, response_tokens=5)).start()
+    gateway = OllamaGateway(transport, f"{fake_server.url},{other.url}", port=0)
+    gateway.start()
+    try:
+        for server, model in ((fake_server, 'fake-llama:7b'), (other, 'other-model:1b')):
+            wait_callback(lambda done, error: transport.warm_up(server.url, model, done, error))
+        _, body = request(gateway, '/api/ps')
+        assert {model['name'] for model in json.loads(body)['models']} == {'fake-llama:7b', 'other-model:1b'}
+    finally:
+        gateway.stop()
+        other.stop()
@@ -0,0 +1,19 @@
+import pytest
+
+from conftest import wait_callback
+from ollama_engine import OllamaResponseError
+
+def warm_up(transport, server_url, keep_alive):
+    return wait_callback(lambda done, error: transport.warm_up(
+        server_url, 'fake-llama:7b', done, error, keep_alive=keep_alive
+    ))
+
+@pytest.mark.parametrize('keep_alive', ["5m", "30m", "2h", "-1m", -1, 0, None])
+def test_valid_keep_alive(fake_server, transport, keep_alive):
+    assert not isinstance(warm_up(transport, fake_server.url, keep_alive), Exception)
+
+def test_keep_alive_without_unit_is_rejected(fake_server, transport):
+    # Ollama用time.ParseDuration解析字符串，"-1"没有单位会返回400
+    error = warm_up(transport, fake_server.url, "-1")
+    assert isinstance(error, OllamaResponseError)
+    assert "missing unit" in str(error)
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from ollama_fake_server import fake_embedding
+from ollama_rag import DocumentIndex, chunk_text
+
+def index_changes(index, embed_model='nomic-embed-text'):
+    changed, removed = index.scan(embed_model)
+    for change in changed:
+        with open(change.path, encoding='utf-8') as f:
+            chunks = chunk_text(f.read())
+        index.replace_file(change, chunks, [fake_embedding(chunk) for chunk in chunks])
+    for path in removed:
+        index.remove_file(path)
+    return changed, removed
+
+@pytest.fixture
+def documents(tmp_path):
+    directory = tmp_path / "docs"
+    directory.mkdir()
+    (directory / "cats.txt").write_text("cats purr and sleep in the sun", encoding='utf-8')
+    (directory / "rust.txt").write_text("rust compiler borrow checker lifetimes", encoding='utf-8')
+    return directory
+
+def test_scan_and_search(tmp_path, documents):
+    index = DocumentIndex(str(tmp_path / "index"))
+    index.add_source(str(documents))
+    changed, removed = index_changes(index)
+    assert len(changed) == 2 and not removed
+
+    results = index.search(fake_embedding("borrow checker"), top_k=1)
+    assert os.path.basename(results[0]['path']) == "rust.txt"
+    assert index.stats()['files'] == 2
+    index.close()
+
+def test_rescan_is_incremental(tmp_path, documents):
+    index = DocumentIndex(str(tmp_path / "index"))
+    index.add_source(str(documents))
+    index_changes(index)
+    assert index_changes(index) == ([], [])
+
+    (documents / "cats.txt").write_text("dogs bark at the mail carrier", encoding='utf-8')
+    os.remove(documents / "rust.txt")
+    changed, removed = index_changes(index)
+    assert [os.path.basename(change.path) for change in changed] == ["cats.txt"]
+    assert [os.path.basename(path) for path in removed] == ["rust.txt"]
+    assert index.search(fake_embedding("borrow checker"), top_k=1, min_score=0.5) == []
+    assert index.dead_ratio > 0
+    index.compact()
+    assert index.dead_ratio == 0
+    assert "dogs" in index.search(fake_embedding("dogs bark"), top_k=1)[0]['text']
+    index.close()
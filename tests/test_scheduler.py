@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from ollama_scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, RequestScheduler
+
+async def run_requests(scheduler, requests, started=None):
+    """按顺序提交请求，返回得到槽位的顺序；第一个请求占住槽位直到其余请求都已排队"""
+    order = []
+    release = asyncio.Event()
+
+    async def run(request_id, queue_key, slot_key, priority=PRIORITY_INTERACTIVE, slots=1):
+        async with scheduler.slot(request_id, queue_key, slot_key, slots=slots, priority=priority):
+            order.append(request_id)
+            if started is not None:
+                started.set()
+            await release.wait()
+
+    tasks = []
+    for request in requests:
+        tasks.append(asyncio.create_task(run(*request)))
+        await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(*tasks)
+    return order
+
+def test_interactive_requests_run_before_background():
+    async def main():
+        scheduler = RequestScheduler(max_active=1)
+        return await run_requests(scheduler, [
+            (1, 'a', 'model'),
+            (2, 'b', 'model', PRIORITY_BACKGROUND),
+            (3, 'c', 'model', PRIORITY_BACKGROUND),
+            (4, 'd', 'model', PRIORITY_INTERACTIVE),
+        ])
+    assert asyncio.run(main()) == [1, 4, 2, 3]
+
+def test_same_conversation_runs_in_submission_order():
+    async def main():
+        scheduler = RequestScheduler(max_active=4)
+        # 同一会话的后台请求也不能越过之前提交的请求，即使有其他空闲槽位
+        return await run_requests(scheduler, [
+            (1, 'conversation', 'model-a', PRIORITY_BACKGROUND, 4),
+            (2, 'conversation', 'model-a', PRIORITY_INTERACTIVE, 4),
+            (3, 'conversation', 'model-b', PRIORITY_INTERACTIVE, 4),
+        ])
+    assert asyncio.run(main()) == [1, 2, 3]
+
+def test_slot_and_active_limits():
+    async def main():
+        scheduler = RequestScheduler(max_active=3)
+        release = asyncio.Event()
+
+        async def run(request_id, slot_key):
+            async with scheduler.slot(request_id, None, slot_key, slots=2):
+                await release.wait()
+
+        tasks = [asyncio.create_task(run(i, 'model-a')) for i in range(3)]
+        tasks.append(asyncio.create_task(run(3, 'model-b')))
+        tasks.append(asyncio.create_task(run(4, 'model-b')))
+        await asyncio.sleep(0.01)
+        # model-a最多两个，model-b占用剩下的一个全局槽位
+        snapshot = scheduler.snapshot()
+        release.set()
+        await asyncio.gather(*tasks)
+        return snapshot, scheduler.snapshot()
+    busy, idle = asyncio.run(main())
+    assert busy['running'] == 3 and busy['queued'] == 2
+    assert idle == {'queued': 0, 'queued_interactive': 0, 'running': 0, 'oldest_wait': 0.0}
+
+def test_cancel_while_queued_frees_nothing_and_keeps_dispatching():
+    async def main():
+        scheduler = RequestScheduler(max_active=1)
+        release = asyncio.Event()
+        order = []
+
+        async def run(request_id):
+            async with scheduler.slot(request_id, None, 'model'):
+                order.append(request_id)
+                await release.wait()
+
+        first = asyncio.create_task(run(1))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(run(2))
+        later = asyncio.create_task(run(3))
+        await asyncio.sleep(0)
+        assert scheduler.snapshot()['queued'] == 2
+
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert scheduler.snapshot()['queued'] == 1
+        assert scheduler.snapshot()['running'] == 1
+
+        release.set()
+        await asyncio.gather(first, later)
+        return order, scheduler.snapshot()
+    order, snapshot = asyncio.run(main())
+    assert order == [1, 3]
+    assert snapshot['running'] == 0 and snapshot['queued'] == 0
+
+def test_cancel_running_request_releases_slot():
+    async def main():
+        scheduler = RequestScheduler(max_active=1)
+        started = asyncio.Event()
+        running = asyncio.create_task(run_requests(scheduler, [(1, None, 'model')], started))
+        await started.wait()
+        running.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await running
+        return await run_requests(scheduler, [(2, None, 'model')])
+    assert asyncio.run(main()) == [2]
@@ -0,0 +1,72 @@
+from ollama_store import ConversationStore
+
+def test_streamed_message_is_searchable_after_finish():
+    store = ConversationStore(':memory:')
+    conversation_id = store.create_conversation("hash maps", 'fake-llama:7b')
+    store.append_message(conversation_id, 'user', "explain collisions")
+    message_id = store.append_message(conversation_id, 'assistant', "", done=False)
+    store.append_chunk(message_id, "open addressing ")
+    store.append_chunk(message_id, "and chaining")
+    assert not store.search("chaining")
+
+    store.finish_message(message_id, "open addressing and chaining", {'tokens': 5})
+    assert [result['conversation_id'] for result in store.search("chaining")] == [conversation_id]
+    last = store.load_page(conversation_id)[-1]
+    assert last['done'] and last['meta'] == {'tokens': 5}
+
+def test_load_page_returns_older_messages_in_order():
+    store = ConversationStore(':memory:')
+    conversation_id = store.create_conversation("long")
+    for number in range(7):
+        store.append_message(conversation_id, 'user', f"message {number}")
+    newest = store.load_page(conversation_id, limit=3)
+    assert [message['seq'] for message in newest] == [4, 5, 6]
+    older = store.load_page(conversation_id, before_seq=newest[0]['seq'], limit=3)
+    assert [message['content'] for message in older] == ["message 1", "message 2", "message 3"]
+
+def test_delete_conversation_removes_messages_and_index():
+    store = ConversationStore(':memory:')
+    kept = store.create_conversation("kept")
+    deleted = store.create_conversation("deleted")
+    store.append_message(kept, 'user', "shared words here")
+    store.append_message(deleted, 'user', "shared words here")
+
+    store.delete_conversation(deleted)
+    assert store.get_conversation(deleted) is None
+    assert store.load_page(deleted) == []
+    assert {result['conversation_id'] for result in store.search("shared")} == {kept}
+    assert [conversation['id'] for conversation in store.list_conversations()] == [kept]
+
+def written_content(store, conversation_id):
+    """等后台线程写完已提交的数据块（不写入仍在内存中的部分），返回数据库中的内容"""
+    store._writer.submit(lambda: None).result()
+    return store.load_page(conversation_id)[-1]['content']
+
+def test_streamed_chunks_are_written_in_batches():
+    store = ConversationStore(':memory:', flush_interval=2.0, flush_chars=10)
+    conversation_id = store.create_conversation("batches")
+    message_id = store.append_message(conversation_id, 'assistant', "", done=False)
+    store.append_chunk(message_id, "one ", now=0.0)
+    store.append_chunk(message_id, "two ", now=0.5)
+    assert written_content(store, conversation_id) == ""
+
+    # 累积到flush_chars或超过flush_interval时写入
+    store.append_chunk(message_id, "three ", now=1.0)
+    assert written_content(store, conversation_id) == "one two three "
+    store.append_chunk(message_id, "four ", now=3.5)
+    assert written_content(store, conversation_id) == "one two three four "
+
+    store.append_chunk(message_id, "five", now=3.6)
+    store.flush()
+    assert written_content(store, conversation_id) == "one two three four five"
+    store.close()
+
+def test_finish_replaces_buffered_chunks():
+    store = ConversationStore(':memory:')
+    conversation_id = store.create_conversation("finish")
+    message_id = store.append_message(conversation_id, 'assistant', "", done=False)
+    store.append_chunk(message_id, "partial ")
+    store.finish_message(message_id, "partial answer")
+    store.flush()
+    assert store.load_page(conversation_id)[-1]['content'] == "partial answer"
+    store.close()
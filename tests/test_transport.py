@@ -0,0 +1,110 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import ollama_transport
+from conftest import wait_callback
+from ollama_cache import ResponseCache
+from ollama_engine import GenerationResult
+
+class ContentLengthHandler(BaseHTTPRequestHandler):
+    """用Content-Length（而不是分块编码）返回整个NDJSON流的服务器"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        models = [{'name': 'fake-llama:7b', 'model': 'fake-llama:7b'}]
+        self._send(json.dumps({'models': models}).encode())
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        lines = [{'response': word, 'done': False} for word in ("one ", "two ", "three")]
+        lines.append({'response': "", 'done': True, 'done_reason': 'stop', 'eval_count': 3})
+        self._send(b"".join(json.dumps(line).encode() + b"\n" for line in lines))
+
+    def _send(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StallingHandler(ContentLengthHandler):
+    """输出一行后停止发送数据，但不关闭连接"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        line = json.dumps({'response': "one ", 'done': False}).encode() + b"\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+        time.sleep(3)
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@pytest.fixture
+def content_length_server():
+    server = serve(ContentLengthHandler)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+def test_generate_with_content_length_body(content_length_server, transport, monkeypatch):
+    monkeypatch.setattr(ollama_transport, 'READ_TIMEOUT', 2)
+    for _ in range(2):
+        # 第二次请求复用第一次的连接
+        result = wait_callback(lambda done, error: transport.generate(
+            content_length_server, 'fake-llama:7b', "hello", lambda request_id, text: None, done, error
+        ), timeout=5)
+        assert isinstance(result, GenerationResult)
+        assert result.text == "one two three"
+
+def test_cache_access_runs_off_the_event_loop(fake_server, transport):
+    cache = ResponseCache(':memory:')
+    threads = []
+    for name in ('get', 'put'):
+        method = getattr(cache, name)
+
+        def record(*args, method=method):
+            threads.append(threading.current_thread())
+            return method(*args)
+
+        setattr(cache, name, record)
+
+    results = [wait_callback(lambda done, error: transport.generate(
+        fake_server.url, 'fake-llama:7b', "hello", lambda request_id, text: None, done, error,
+        cache=cache, options={'seed': 1}
+    )) for _ in range(2)]
+    assert not results[0].metrics.cached and results[1].metrics.cached
+    assert results[1].text == results[0].text
+    assert len(threads) == 3
+    assert transport._thread not in threads
+    cache.close()
+
+def test_stalled_stream_times_out(transport, monkeypatch):
+    monkeypatch.setattr(ollama_transport, 'READ_TIMEOUT', 0.5)
+    server = serve(StallingHandler)
+    try:
+        start = time.monotonic()
+        chunks = []
+        result = wait_callback(lambda done, error: transport.generate(
+            f"http://127.0.0.1:{server.server_address[1]}", 'fake-llama:7b', "hello",
+            lambda request_id, text: chunks.append(text), done, error, flush_interval=0
+        ), timeout=5)
+        assert isinstance(result, TimeoutError)
+        assert chunks == ["one "]
+        assert time.monotonic() - start < 2.5
+    finally:
+        server.shutdown()
+        server.server_close()